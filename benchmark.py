@@ -0,0 +1,247 @@
+# Benchmark of the recording analyses: runs the trial analyses over the audio files shipped with the repo
+# and reports latency distributions, throughput per core and peak memory.
+#
+# Run it inside the experiment's Docker container:
+#
+# bash docker/run python benchmark.py                    # compare against the saved baseline
+# bash docker/run python benchmark.py --save-baseline    # (re)write the baseline
+# bash docker/run python benchmark.py --pitch-conversion # scalar vs vectorised freq2midi/midi2freq
+#
+# The baseline (benchmark_baseline.json) records the machine it was measured on; comparisons between
+# different machines are only indicative. The exit code is 1 if a case regressed beyond --tolerance.
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BASELINE_PATH = "benchmark_baseline.json"
+PERCENTILES = [50, 95, 99]
+TOLERANCE = 0.2  # relative slowdown of p50/p95 latency, or drop in throughput, reported as a regression
+
+AUDIO_FILES = (
+    ["audio_5notes.wav", os.path.join("input", "silence_1s.wav")]
+    + sorted(glob.glob(os.path.join("input", "melodies-mmb24", "*", "*.wav")))
+)
+PRESCREEN_TARGET_PITCHES = [61.0, 63.6]  # a 2-note prescreen melody (one interval of 2.6 semitones)
+
+
+def load_experiment():
+    from psynet.experiment import import_local_experiment
+    module = import_local_experiment()["module"]
+    package = module.__package__
+    return (
+        module,
+        importlib.import_module(f"{package}.pre_screens"),
+        importlib.import_module(f"{package}.sing.analysis"),
+    )
+
+
+def main_task_melody(audio_file, melody_catalog):
+    # the reference recordings are named after their melody (e.g. input/melodies-mmb24/2/western2.wav);
+    # the other files are analysed against the first melody
+    name = os.path.splitext(os.path.basename(audio_file))[0].strip().lower()
+    for entry in melody_catalog.iter_entries():
+        if entry["melody"].replace("_", "").lower() == name:
+            return entry
+    return melody_catalog.entry(0)
+
+
+def get_cases(experiment, pre_screens):
+    """
+    Returns ``{case: [(fn, audio_file, args), ...]}``: one job per audio file and case, where
+    ``fn(audio_file, output_plot, *args)`` is the analysis of the corresponding trial class.
+    """
+    melody_catalog = experiment.melody_catalog
+    return {
+        "prescreen_feedback_note_count": [
+            (pre_screens.analyze_performance_feedback_recording, audio_file, (PRESCREEN_TARGET_PITCHES, "note_count"))
+            for audio_file in AUDIO_FILES
+        ],
+        "prescreen_feedback_full": [
+            (pre_screens.analyze_performance_feedback_recording, audio_file, (PRESCREEN_TARGET_PITCHES, "full"))
+            for audio_file in AUDIO_FILES
+        ],
+        "prescreen_test_2notes": [
+            (pre_screens.analyze_performance_test_recording, audio_file, (PRESCREEN_TARGET_PITCHES,))
+            for audio_file in AUDIO_FILES
+        ],
+        "main_7notes": [
+            (experiment.analyze_singing_recording, audio_file, (main_task_melody(audio_file, melody_catalog), "high"))
+            for audio_file in AUDIO_FILES
+        ],
+    }
+
+
+def run_job(fn, audio_file, args):
+    # runs in a worker process; the peak memory of the worker comes from the timings of the analysis
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        output = fn(audio_file, os.path.join(folder, "plot.png"), *args)
+        return time.perf_counter() - start, output["timings"]["total"]["max_rss_mb"]
+
+
+def run_case(pool, jobs, repeats, warmup):
+    for fn, audio_file, args in jobs[:warmup]:
+        pool.result(pool.submit(run_job, fn, audio_file, args))
+
+    start = time.perf_counter()
+    futures = [
+        pool.submit(run_job, fn, audio_file, args, timeout=None)
+        for _ in range(repeats)
+        for fn, audio_file, args in jobs
+    ]
+    results = [future.result() for future in futures]
+    wall = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results])
+    result = {"n": len(latencies), "mean": round(float(latencies.mean()), 4)}
+    for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        result[f"p{p}"] = round(float(value), 4)
+    result["max"] = round(float(latencies.max()), 4)
+    result["throughput_per_core"] = round(len(latencies) / wall / max(pool.num_workers, 1), 3)
+    result["peak_rss_mb"] = round(max(rss for _, rss in results), 1)
+    return result
+
+
+def benchmark_pitch_conversion(audio_file="audio_5notes.wav", number=20):
+    # compares the scalar and vectorised pitch conversions on the full Praat pitch track of a recording
+    import timeit
+    import parselmouth
+    from sing import melodies
+
+    f0 = parselmouth.Sound(audio_file).to_pitch().selected_array["frequency"]
+    midi = melodies.freq2midi_array(f0)
+    print(f"Pitch track of {audio_file}: {len(f0)} frames, {np.mean(f0 > 0):.0%} voiced")
+
+    cases = [
+        ("freq2midi", lambda: [melodies.freq2midi(x) for x in f0], lambda: melodies.freq2midi_array(f0)),
+        ("midi2freq", lambda: [melodies.midi2freq(x) for x in midi], lambda: melodies.midi2freq_array(midi)),
+    ]
+    for name, scalar, vectorised in cases:
+        scalar_time = min(timeit.repeat(scalar, number=number, repeat=5)) / number
+        vectorised_time = min(timeit.repeat(vectorised, number=number, repeat=5)) / number
+        print(
+            f"  {name:<10} scalar {scalar_time * 1e3:8.3f} ms   vectorised {vectorised_time * 1e3:8.3f} ms   "
+            f"speed-up {scalar_time / vectorised_time:6.1f}x"
+        )
+
+
+def machine_info(analysis):
+    import sing4me
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sing4me": getattr(sing4me, "__version__", None),
+        "cache_version": analysis.CACHE_VERSION,
+    }
+
+
+def compare(results, baseline, tolerance):
+    # returns the list of regressions of results against the baseline
+    regressions = []
+    for case, result in results.items():
+        old = baseline["cases"].get(case)
+        if old is None:
+            continue
+        for key in ["p50", "p95"]:
+            if result[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{case}: {key} latency {old[key]:.3f} s -> {result[key]:.3f} s")
+        if result["throughput_per_core"] < old["throughput_per_core"] * (1 - tolerance):
+            regressions.append(
+                f"{case}: throughput per core {old['throughput_per_core']:.2f} -> "
+                f"{result['throughput_per_core']:.2f} analyses/s"
+            )
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'case':<32}{'n':>5}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}{'per core/s':>12}{'peak RSS':>10}")
+    for case, r in results.items():
+        print(
+            f"{case:<32}{r['n']:>5}{r['p50']:>8.3f}{r['p95']:>8.3f}{r['p99']:>8.3f}{r['max']:>8.3f}"
+            f"{r['throughput_per_core']:>12.2f}{r['peak_rss_mb']:>8.0f}MB"
+        )
+        old = (baseline or {}).get("cases", {}).get(case)
+        if old is not None:
+            print(
+                f"{'  baseline':<32}{old['n']:>5}{old['p50']:>8.3f}{old['p95']:>8.3f}{old['p99']:>8.3f}"
+                f"{old['max']:>8.3f}{old['throughput_per_core']:>12.2f}{old['peak_rss_mb']:>8.0f}MB"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recording analyses.")
+    parser.add_argument("--case", action="append", help="only run these cases")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--repeats", type=int, default=5, help="number of times every file is analysed")
+    parser.add_argument("--warmup", type=int, default=2, help="number of untimed analyses per case")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="path of the baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative change reported as regression")
+    parser.add_argument("--pitch-conversion", action="store_true", help="only benchmark freq2midi/midi2freq")
+    args = parser.parse_args(argv)
+
+    if args.pitch_conversion:
+        benchmark_pitch_conversion()
+        return 0
+
+    experiment, pre_screens, analysis = load_experiment()
+    # no result cache, so that every run measures the analysis itself
+    analysis.configure(num_workers=0, cache_path=None)
+    pool = analysis.AnalysisEngine(num_workers=args.workers, max_pending=2 * args.workers)
+
+    cases = get_cases(experiment, pre_screens)
+    if args.case:
+        unknown = set(args.case) - set(cases)
+        if unknown:
+            parser.error(f"Unknown cases: {sorted(unknown)}; choose from {sorted(cases)}")
+        cases = {case: jobs for case, jobs in cases.items() if case in args.case}
+
+    print(f"Benchmarking {len(AUDIO_FILES)} files x {args.repeats} repeats with {args.workers} workers", flush=True)
+    results = {}
+    try:
+        for case, jobs in cases.items():
+            results[case] = run_case(pool, jobs, args.repeats, args.warmup)
+            print(f"  {case} done", flush=True)
+    finally:
+        pool.shutdown()
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    info = machine_info(analysis)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"machine": info, "settings": vars(args), "cases": results}, file, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    if baseline["machine"] != info:
+        print(f"Warning: the baseline was measured on a different setup: {baseline['machine']}")
+    if baseline["settings"]["workers"] != args.workers:
+        print(f"Warning: the baseline was measured with {baseline['settings']['workers']} workers")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
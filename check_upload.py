@@ -0,0 +1,98 @@
+# Accuracy check of the compressed recording upload (sing/upload.py): runs the analyses of benchmark.py on the
+# audio files shipped with the repo and on the WAV files the server decodes from their compressed upload,
+# and compares the outputs.
+#
+# Run it inside the experiment's Docker container:
+#
+# bash docker/run python check_upload.py
+#
+# The upload is simulated in python (FFT resampling instead of the resampler of the browser); test_upload.py
+# checks the path of an upload through the recording control. A file passes if
+# flags, labels and counts are identical and numbers (pitches, intervals and errors, in semitones) differ by
+# at most --tolerance; the raw note list of sing.analyze and the plot are not compared.
+# The exit code is 1 if a file fails.
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+
+import benchmark
+
+TOLERANCE = 0.1  # semitones
+IGNORED_KEYS = {"raw", "plot", "save_plot", "timings"}
+
+
+def compare(original, decoded, tolerance, path="output"):
+    """
+    Returns the differences between two analysis outputs as ``(path, original, decoded)`` tuples,
+    and the largest difference between their numbers.
+    """
+    if isinstance(original, dict) and isinstance(decoded, dict):
+        differences, max_difference = [], 0.0
+        for key in sorted(set(original) | set(decoded)):
+            if key in IGNORED_KEYS:
+                continue
+            found, largest = compare(original.get(key), decoded.get(key), tolerance, f"{path}.{key}")
+            differences += found
+            max_difference = max(max_difference, largest)
+        return differences, max_difference
+    if isinstance(original, (list, tuple)) and isinstance(decoded, (list, tuple)) and len(original) == len(decoded):
+        differences, max_difference = [], 0.0
+        for i, (x, y) in enumerate(zip(original, decoded)):
+            found, largest = compare(x, y, tolerance, f"{path}[{i}]")
+            differences += found
+            max_difference = max(max_difference, largest)
+        return differences, max_difference
+    if isinstance(original, float) and isinstance(decoded, (int, float)) and not isinstance(decoded, bool):
+        difference = abs(original - decoded)
+        return ([(path, original, decoded)] if difference > tolerance else []), difference
+    return ([] if original == decoded else [(path, original, decoded)]), 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the compressed upload leaves the analyses unchanged.")
+    parser.add_argument("--case", action="append", help="only check these cases of benchmark.py")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="largest accepted difference (semitones)")
+    args = parser.parse_args(argv)
+
+    experiment, pre_screens, analysis = benchmark.load_experiment()
+    upload = importlib.import_module(f"{experiment.__package__}.sing.upload")
+    analysis.configure(num_workers=0, cache_path=None)
+
+    cases = benchmark.get_cases(experiment, pre_screens)
+    if args.case:
+        cases = {case: jobs for case, jobs in cases.items() if case in args.case}
+
+    num_failed = 0
+    with tempfile.TemporaryDirectory() as folder:
+        decoded_files = {}
+        for audio_file in benchmark.AUDIO_FILES:
+            data = upload.simulate_upload(audio_file)
+            decoded_files[audio_file] = os.path.join(folder, f"{len(decoded_files)}.wav")
+            with open(decoded_files[audio_file], "wb") as file:
+                file.write(upload.to_wav(*upload.decode(data, max_frames=None)))
+            size = os.path.getsize(audio_file)
+            print(
+                f"{audio_file:<44}{size / 1024:8.1f} kB, upload {len(data) / 1024:6.1f} kB ({len(data) / size:.1%}),"
+                f" stored {os.path.getsize(decoded_files[audio_file]) / 1024:6.1f} kB"
+            )
+
+        for case, jobs in cases.items():
+            print(f"\n{case}")
+            for fn, audio_file, fn_args in jobs:
+                original = fn(audio_file, os.path.join(folder, "plot.png"), *fn_args)
+                decoded = fn(decoded_files[audio_file], os.path.join(folder, "plot.png"), *fn_args)
+                differences, max_difference = compare(original, decoded, args.tolerance)
+                num_failed += bool(differences)
+                print(f"  {'FAIL' if differences else 'ok':<6}{audio_file:<44} max difference {max_difference:.4f}")
+                for path, x, y in differences:
+                    print(f"        {path}: {x!r} -> {y!r}")
+
+    print(f"\n{num_failed} failed")
+    return 1 if num_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
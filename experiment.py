@@ -2,16 +2,21 @@ from markupsafe import Markup
 import random
 import json
 
+from flask import Blueprint, Response, abort, request, send_file, send_from_directory
+from flask_login import login_required
+
 import psynet.experiment
 from psynet.asset import ExperimentAsset, Asset, LocalStorage, DebugStorage, FastFunctionAsset, S3Storage  # noqa
 from psynet.consent import NoConsent, MainConsent, OpenScienceConsent, AudiovisualConsent
-from psynet.modular_page import ModularPage, AudioRecordControl
+from psynet.modular_page import ModularPage, AudioPrompt, AudioRecordControl
 from psynet.js_synth import JSSynth, Note, HarmonicTimbre, InstrumentTimbre
 
 from psynet.page import InfoPage, SuccessfulEndPage, join
-from psynet.timeline import Event, ProgressDisplay, ProgressStage, Timeline, CodeBlock, conditional
+from psynet.timeline import Event, ProgressDisplay, ProgressStage, Timeline, CodeBlock, PreDeployRoutine, conditional
+from psynet.participant import Participant
 from psynet.trial.static import StaticNode, StaticTrial, StaticTrialMaker
 from psynet.trial.audio import AudioRecordTrial
+from psynet.trial.main import Trial
 from psynet.prescreen import AntiphaseHeadphoneTest
 
 import warnings
@@ -22,6 +27,19 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 from sing4me import singing_extract as sing
 from sing4me import melodies
 from .params import singing_2intervals
+from .sing import analysis
+from .sing import plots
+from .sing import timing
+from .sing import stimuli
+from .sing import catalog
+from .sing import allocation
+from .sing import synth
+from .sing import assets
+from .sing import prefetch
+from .sing import provisional
+from .sing import readiness
+from .sing import upload
+from .sing.melodies import REGISTER_SHIFTS, get_melody
 
 # experiment
 from .instructions import welcome, requirements_mic
@@ -79,15 +97,11 @@ TIME_ESTIMATE_TRIAL = TIME_ESTIMATE_LISTENING_TRIAL + TIME_ESTIMATE_SINGING_TRIA
 
 
 
-# singing
-roving_width = 2.5
-roving_mean = dict(
-    default=55,
-    low=49,
-    high=61
-)
+# singing (the melody settings shared with the stimulus bank are in sing/stimuli.py)
+roving_width = stimuli.ROVING_WIDTH
+roving_mean = stimuli.ROVING_MEAN
 
-NUM_NOTES = 7
+NUM_NOTES = stimuli.PRACTICE["num_notes"]
 NUM_INT = NUM_NOTES - 1
 SYLLABLE = "TA"
 TIME_AFTER_SINGING = 1.5
@@ -96,8 +110,21 @@ REFERENCE_MODE = "pitch_mode"  # pitch_mode vs previous_note vs first_note
 MAX_ABS_INT_ERROR_ALLOWED = 5.5  # set to 999 if NUM_INT > 2
 MAX_INT_SIZE = 999
 MAX_MELODY_PITCH_RANGE = 999  # deactivated
-MAX_INTERVAL2REFERENCE = 5
+MAX_INTERVAL2REFERENCE = stimuli.PRACTICE["max_interval2reference"]
 SAVE_PLOT = True # decide if we save the plot of the singing performance or not
+DEFER_PLOT = False  # render plots on request (/analysis_plot/<trial_id>) instead of during the analysis
+
+# analyses (see sing/analysis.py): they run in psynet's async post-trial jobs, one at a time per rq worker process
+ANALYSIS_WORKER_PROCESSES = 1  # number of rq worker processes, i.e. of analyses running in parallel
+# process pool of every web process for the deferred plots (DEFER_PLOT)
+ANALYSIS_NUM_WORKERS = 2  # number of plots rendered in parallel
+ANALYSIS_MAX_PENDING = 8  # number of plots allowed to queue before new requests get a 503
+# time the stages of sing.analyze (audio loading, bandpass, Praat pitch, segmentation) on their re-implementation
+# in sing/stages.py after every analysis, for timing_report.py; this adds their time to every analysis
+ANALYSIS_PROFILE_STAGES = False
+analysis.configure(
+    num_workers=ANALYSIS_NUM_WORKERS, max_pending=ANALYSIS_MAX_PENDING, profile_stages=ANALYSIS_PROFILE_STAGES
+)
 
 # timbre
 if IS_PIANO:
@@ -118,6 +145,15 @@ else:
     note_duration_tonejs = 0.8
     note_silence_tonejs = 0
 
+# play the melodies from audio files rendered once on the server (see sing/synth.py) instead of synthesising
+# them in the browser; only for the harmonic timbre
+PRERENDER_STIMULI = False
+STIMULUS_MAX_AGE = 365 * 24 * 3600  # rendered files are named by content hash, so browsers can keep them
+
+# upload the singing recordings resampled to 16 kHz and losslessly compressed (see sing/upload.py); check the
+# analyses with check_upload.py before enabling it
+COMPRESS_UPLOADS = False
+
 pitch_duration = note_duration_tonejs + note_silence_tonejs
 
 
@@ -144,94 +180,105 @@ melody_duration, singing_duration = estimate_time_per_trial(
 # Stimuli
 ########################################################################################################################
 
-def generate_random_melody(mel_id, roving_mean, roving_width, max_interval2reference, num_notes):
-    # Function to generate melodies based on a reference_pitch, max_interval2reference, and number of notes (currently not implemented)
-
-    # sample reference pitch
-    reference_pitch = melodies.sample_reference_pitch(
-        roving_mean,
-        roving_width,
-    )
-    # sample pitches
-    target_pitches = melodies.sample_absolute_pitches(
-        reference_pitch=reference_pitch,
-        max_interval2reference=max_interval2reference,
-        num_pitches=num_notes
-    )
-
-    # Round each element in the target_pitches list to the nearest integer
-    target_pitches = [round(pitch) for pitch in target_pitches]
-
-    # get intervals
-    target_intervals = melodies.convert_absolute_pitches_to_interval_sequence(target_pitches, "previous_note")
-    # get intervals from pitch to reference pitch
-    target_intervals2reference = melodies.convert_absolute_pitches_to_intervals2reference(
-        target_pitches, reference_pitch
-    )
-    return dict(
-        melody_id="Melody_" + str(mel_id),
-        # reference_pitch=reference_pitch,
-        target_pitches=target_pitches,
-        target_intervals=target_intervals,
-        # target_intervals2reference=target_intervals2reference
-    )
-
 # NUM_RAND_MELODIES = 5
 
 # nodes_random = [
 #     StaticNode(
 #         definition={
-#             "melody": generate_random_melody(i, roving_mean["high"], roving_width, MAX_INTERVAL2REFERENCE, NUM_NOTES)
+#             "melody": stimuli.generate_random_melody(i, roving_mean["high"], roving_width, MAX_INTERVAL2REFERENCE, NUM_NOTES)
 #         },
 #     )
 #     for i in range(1, (NUM_RAND_MELODIES + 1))
 # ]
 
 
-# we generate the stimulus (and nodes) by importing the melodies from a json file
+# we generate the stimulus (and nodes) from the melodies in a json file, through its catalog (see sing/catalog.py),
+# which is built once per version of the file and then read lazily
 path_json = "melodies.json"
 
-with open(path_json, 'r') as file:
-    melodies_data = json.load(file)
+melody_catalog = catalog.open_catalog(path_json)
+
+
+def nodes():
+    # called by psynet when it sets up the networks at deploy time, so the nodes are not created on import
+    return [
+        StaticNode(definition=definition)
+        for definition in melody_catalog.iter_node_definitions()
+    ]
 
-melodies_list = melodies_data['melodies']
-    
-nodes = [
-    StaticNode(
-        definition={
-            "melody": {
-                "set_id": melody["set"],
-                "melody_id": melody["melody"],
-                "target_pitches": melody["target_pitches"],
-            }
-        },
-    )
-    for melody in melodies_list
-]
 
-NUM_MELODIES = len(nodes)
+NUM_MELODIES = len(melody_catalog)
+
+# reference recordings of the melodies, processed into cacheable assets (see sing/assets.py)
+reference_audio = assets.open_reference_audio()
+reference_audio_files = {asset["file"] for asset in reference_audio["melodies"].values()}
 TRIALS_PER_PARTICIPANT = NUM_MELODIES
-TRIALS_PER_PARTICIPANT_PRACTICE = 2
-
-# generate random melodies for the practice phase
-nodes_practice = [
-    StaticNode(
-        definition={
-            "melody": generate_random_melody(i, roving_mean["high"], roving_width, MAX_INTERVAL2REFERENCE, NUM_NOTES)
-        },
-    )
-    for i in range(1, (TRIALS_PER_PARTICIPANT_PRACTICE + 1))
-]
+TRIALS_PER_PARTICIPANT_PRACTICE = stimuli.PRACTICE["num_melodies"]
+
+# random melodies for the practice phase, generated once by `python -m sing.stimuli build` (see sing/stimuli.py)
+stimulus_bank = stimuli.load()
+assert len(stimulus_bank["practice"]) == TRIALS_PER_PARTICIPANT_PRACTICE
+assert all(len(x["melody"]["target_pitches"]) == NUM_NOTES for x in stimulus_bank["practice"])
+
+
+def nodes_practice():
+    return [
+        StaticNode(definition=definition)
+        for definition in stimulus_bank["practice"]
+    ]
+
+
+# stores which version of the stimulus bank each participant saw
+record_stimulus_bank = CodeBlock(
+    lambda participant: participant.var.set("stimulus_bank", stimulus_bank["checksum"])
+)
 
 
 ########################################################################################################################
 # experiment parts
 ########################################################################################################################
 
+def stimulus_url(target_pitches, render=True):
+    # URL of the pre-rendered melody, or None if the melodies are synthesised by JSSynth; a melody that was not
+    # rendered before deployment (see render_stimuli) is rendered now, or gets None with render=False
+    if not PRERENDER_STIMULI or IS_PIANO:
+        return None
+    if render:
+        filename = synth.render_stimulus(target_pitches, TIMBRE["default"], note_duration_tonejs, note_silence_tonejs)
+    else:
+        filename = synth.stimulus_file(target_pitches, TIMBRE["default"], note_duration_tonejs, note_silence_tonejs)
+    return None if filename is None else f"/stimulus_audio/{filename}"
+
+
+def render_stimuli():
+    # pre-deployment routine: renders the practice and main melodies in every register (PRERENDER_STIMULI), so
+    # that no page has to render one while the participant waits
+    if not PRERENDER_STIMULI or IS_PIANO:
+        return
+    definitions = [*stimulus_bank["practice"], *melody_catalog.iter_node_definitions()]
+    for definition in definitions:
+        for register in REGISTER_SHIFTS:
+            stimulus_url(get_melody(definition["melody"]["target_pitches"]).in_register(register).pitches)
+
+
+def melody_prompt(text, target_pitches):
+    # the melody as a pre-rendered audio file (PRERENDER_STIMULI) or synthesised by JSSynth in the browser
+    url = stimulus_url(target_pitches)
+    if url is not None:
+        return AudioPrompt(url, text)
+    return JSSynth(
+        text,
+        [Note(pitch) for pitch in target_pitches],
+        timbre=TIMBRE,
+        default_duration=note_duration_tonejs,
+        default_silence=note_silence_tonejs,
+    )
+
+
 def create_listen_trial(show_current_trial, time_estimate, target_pitches, melody_duration):
     listen_page = ModularPage(
         "listen_page",
-        JSSynth(
+        melody_prompt(
             Markup(
                 f"""
                 <h3>Listen to the melody</h3>
@@ -239,12 +286,10 @@ def create_listen_trial(show_current_trial, time_estimate, target_pitches, melod
                 Press <b><b>Next</b></b> when you are ready to start singing the melody.<br>
                 <hr>
                 {show_current_trial}<br><br>
+                {prefetch.trial_gap_script(stimulus_url(target_pitches))}
                 """
                 ),
-            [Note(pitch) for pitch in target_pitches],
-            timbre=TIMBRE,
-            default_duration=note_duration_tonejs,
-            default_silence=note_silence_tonejs,
+            target_pitches,
             ),
             events={
                 "promptStart": Event(is_triggered_by="trialStart", delay=1.5),
@@ -264,10 +309,17 @@ def create_listen_trial(show_current_trial, time_estimate, target_pitches, melod
     return listen_page
 
 
-def create_singing_trial(show_current_trial, target_pitches, time_estimate, melody_duration, singing_duration):
+def create_singing_trial(
+        show_current_trial, target_pitches, time_estimate, melody_duration, singing_duration, prefetch_urls=(),
+        provisional_feedback=False,
+):
+    # provisional_feedback: shows the note count computed in the browser once the recording ends
+    provisional_script = (
+        provisional.note_count_script(singing_2intervals, len(target_pitches)) if provisional_feedback else ""
+    )
     singing_page = ModularPage(
         "singing_page",
-            JSSynth(
+            melody_prompt(
                 Markup(
                     f"""
                 <h3>Sing back the melody</h3>
@@ -275,14 +327,14 @@ def create_singing_trial(show_current_trial, target_pitches, time_estimate, melo
                 Sing each note clearly using the syllable '{SYLLABLE}' and leave silent gaps between notes.<br><br>
                 <hr>
                 {show_current_trial}<br><br>
+                {prefetch.trial_end_script(prefetch_urls)}
+                {provisional_script}
+                {upload.compression_script() if COMPRESS_UPLOADS else ""}
                 """
                 ),
-                [Note(pitch) for pitch in target_pitches],
-                timbre=TIMBRE,
-                default_duration=note_duration_tonejs,
-                default_silence=note_silence_tonejs,
+                target_pitches,
             ),
-            control=AudioRecordControl(
+            control=(upload.CompressedAudioRecordControl if COMPRESS_UPLOADS else AudioRecordControl)(
                 duration=singing_duration,
                 show_meter=True,
                 controls=False,
@@ -306,9 +358,87 @@ def create_singing_trial(show_current_trial, target_pitches, time_estimate, melo
     return singing_page
 
 
-class SingingTrial(AudioRecordTrial, StaticTrial):
+@timing.timed_analysis
+def analyze_singing_recording(audio_file, output_plot, melody, register):
+    # analysis of a singing trial; kept outside the trial class so that reanalyze.py can run it offline
+    # (with output_plot=None, which skips the plot)
+    save_plot = SAVE_PLOT and output_plot is not None
+
+    # convert to right register
+    target_melody = get_melody(melody['target_pitches']).in_register(register)
+    target_pitches = list(target_melody.pitches)
+
+    raw = analysis.analyze(
+        audio_file,
+        singing_2intervals,
+        target_pitches=target_pitches,
+        output_plot=output_plot,
+        save_plot=save_plot and not DEFER_PLOT,
+    )
+    if save_plot and DEFER_PLOT:
+        with timing.stage("plot_spec"):
+            plot = plots.plot_spec(audio_file, singing_2intervals, target_pitches)
+    else:
+        plot = None
+    sung_pitches = [x["median_f0"] for x in raw]
+    sung_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
+        sung_pitches,
+        "previous_note"
+    )
+    target_intervals = list(target_melody.intervals("previous_note"))
+    # sung_intervals2reference = melodies.convert_absolute_pitches_to_intervals2reference(
+    #     sung_pitches,
+    #     reference_pitch
+    # )
+    with timing.stage("compute_stats"):
+        stats = sing.compute_stats(
+            sung_pitches,
+            target_pitches,
+            sung_intervals,
+            target_intervals
+        )
+
+    # check if failed based on number of sung pitches
+    num_sung_pitches = stats["num_sung_pitches"]
+    num_target_pitches = stats["num_target_pitches"]
+    correct_num_notes = num_sung_pitches == num_target_pitches
+
+    if correct_num_notes:
+        failed = False
+        reason = "All good"
+    else:
+        failed = True
+        reason = f"Wrong number of sung notes: {num_sung_pitches}  sung out of {num_target_pitches} notes in melody"
+
+    # convert back to high register
+    if register == "low":
+        target_pitches = list(get_melody(melody['target_pitches']).pitches)
+        sung_pitches = [(i + 12) for i in sung_pitches]
+        # reference_pitch = reference_pitch + 12
+
+    return {
+        "failed": failed,
+        "reason": reason,
+        "register": register,
+        # "reference_pitch": reference_pitch,
+        "target_pitches": target_pitches,
+        "num_target_pitches": len(target_pitches),
+        "target_intervals": target_intervals,
+        "sung_pitches": sung_pitches,
+        "num_sung_pitches": len(sung_pitches),
+        "sung_intervals": sung_intervals,
+        # "sung_intervals2reference": sung_intervals2reference,
+        "raw": raw,
+        "save_plot": SAVE_PLOT,
+        "plot": plot,
+        "stats": stats,
+    }
+
+
+class SingingTrial(readiness.NotifiedFeedbackTrial, plots.DeferredPlotTrial, AudioRecordTrial, StaticTrial):
 
     num_pages = 1
+    analysis_config = singing_2intervals
     time_estimate = TIME_ESTIMATE_TRIAL
     accumulate_answers = True
 
@@ -317,10 +447,9 @@ class SingingTrial(AudioRecordTrial, StaticTrial):
         melody = self.definition
 
         # convert to right register
-        if self.participant.var.register == "high":
-            target_pitches = melody['melody']['target_pitches']
-        else:
-            target_pitches = [(i - 12) for i in melody['melody']['target_pitches']]
+        target_pitches = get_melody(melody['melody']['target_pitches']).in_register(
+            self.participant.var.register
+        ).pitches
 
         if self.trial_maker_id == "sing_practice":
             total_num_trials = TRIALS_PER_PARTICIPANT_PRACTICE
@@ -343,88 +472,48 @@ class SingingTrial(AudioRecordTrial, StaticTrial):
             target_pitches,
             TIME_ESTIMATE_SINGING_TRIAL,
             melody_duration,
-            singing_duration
+            singing_duration,
+            self.var.get("prefetch_urls", default=[]),
+            provisional_feedback=self.gives_feedback(experiment, participant),
             )
         
         return [listening_page, singing_page]
 
-    def analyze_recording(self, audio_file: str, output_plot: str):
-
-        melody = self.definition
+    def next_stimulus_urls(self):
+        # URLs of the pre-rendered audio of the melodies the participant can get next, so that the browser loads
+        # them while the participant sings this one; empty without PRERENDER_STIMULI. Nothing is rendered here:
+        # melodies that were not rendered before deployment (see render_stimuli) are not prefetched
+        if not PRERENDER_STIMULI or IS_PIANO:
+            return []
+        urls = [
+            stimulus_url(get_melody(definition["melody"]["target_pitches"]).in_register(
+                self.participant.var.register
+            ).pitches, render=False)
+            for definition in self.next_node_candidates()
+        ]
+        return [url for url in urls if url is not None]
 
-        # convert to right register
-        if self.participant.var.register == "high":
-            target_pitches =  melody['melody']['target_pitches']
-            # reference_pitch =  melody['melody']['reference_pitch']
+    def next_node_candidates(self):
+        # definitions of the nodes the participant can get next: the other practice melodies, or the other melodies
+        # of the current set of the main task (see MainSingingTrialMaker); the audio of those already sung is in
+        # the browser cache, so they are not looked up in the database
+        if self.trial_maker_id == "sing_practice":
+            definitions = stimulus_bank["practice"]
         else:
-            target_pitches = [(i - 12) for i in melody['melody']['target_pitches']]
-            # reference_pitch = melody['melody']['reference_pitch'] - 12
+            set_id = self.participant.var.get(MainSingingTrialMaker.set_var, default=None)
+            if set_id is None:
+                return []
+            definitions = melody_catalog.iter_node_definitions(melody_catalog.rows(set_id))
+        melody_id = self.definition["melody"]["melody_id"]
+        return [definition for definition in definitions if definition["melody"]["melody_id"] != melody_id]
 
-        raw = sing.analyze(
+    def analyze_recording(self, audio_file: str, output_plot: str):
+        return analyze_singing_recording(
             audio_file,
-            singing_2intervals,
-            target_pitches=target_pitches,
-            plot_options=sing.PlotOptions(
-                save=SAVE_PLOT, path=output_plot, format="png"
-            ),
-        )
-        raw = [
-            {key: melodies.as_native_type(value) for key, value in x.items()} for x in raw
-        ]
-        sung_pitches = [x["median_f0"] for x in raw]
-        sung_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
-            sung_pitches,
-            "previous_note"
-        )
-        target_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
-            target_pitches,
-            "previous_note"
-        )
-        # sung_intervals2reference = melodies.convert_absolute_pitches_to_intervals2reference(
-        #     sung_pitches,
-        #     reference_pitch
-        # )
-        stats = sing.compute_stats(
-            sung_pitches,
-            target_pitches,
-            sung_intervals,
-            target_intervals
+            output_plot,
+            self.definition["melody"],
+            self.participant.var.register,
         )
-
-        # check if failed based on number of sung pitches
-        num_sung_pitches = stats["num_sung_pitches"]
-        num_target_pitches = stats["num_target_pitches"]
-        correct_num_notes = num_sung_pitches == num_target_pitches
-
-        if correct_num_notes:
-            failed = False
-            reason = "All good"
-        else:
-            failed = True
-            reason = f"Wrong number of sung notes: {num_sung_pitches}  sung out of {num_target_pitches} notes in melody"
-
-        # convert back to high register
-        if self.participant.var.register == "low":
-            target_pitches = [(i + 12) for i in target_pitches]
-            sung_pitches = [(i + 12) for i in sung_pitches]
-            # reference_pitch = reference_pitch + 12
-
-        return {
-            "failed": failed,
-            "reason": reason,
-            "register": self.participant.var.register,
-            # "reference_pitch": reference_pitch,
-            "target_pitches": target_pitches,
-            "num_target_pitches": len(target_pitches),
-            "target_intervals": target_intervals,
-            "sung_pitches": sung_pitches,
-            "num_sung_pitches": len(sung_pitches),
-            "sung_intervals": sung_intervals,
-            # "sung_intervals2reference": sung_intervals2reference,
-            "raw": raw,
-            "save_plot": SAVE_PLOT,
-            "stats": stats,
-        }
     
 class SingingTrialPractice(SingingTrial):
 
@@ -432,9 +521,14 @@ class SingingTrialPractice(SingingTrial):
         return True
 
     def show_feedback(self, experiment, participant):
+        # the feedback page is the last page of the trial for the gap measured on the next listening page
+        return prefetch.mark_trial_end(self.feedback_page())
+
+    def feedback_page(self):
         output_analysis = self.analysis
         num_sung_pitches = len(output_analysis["sung_pitches"])
         num_target_pitches = len(output_analysis["target_pitches"])
+        provisional.compare(self, num_sung_pitches)
 
         if num_sung_pitches == num_target_pitches:
             return InfoPage(
@@ -488,12 +582,27 @@ class SingingTrialPractice(SingingTrial):
                 time_estimate=2
             )
 
-class StaticTrialMakerPractice(StaticTrialMaker):
+class PrefetchTrialMaker:
+    # computes the stimulus URLs to prefetch once, when the trial is created, and stores them in the trial var
+    # "prefetch_urls"; show_trial runs every time the page is generated, so it only reads them
+    def prepare_trial(self, experiment, participant):
+        trial, trial_status = super().prepare_trial(experiment, participant)
+        if trial is not None:
+            trial.var.prefetch_urls = trial.next_stimulus_urls()
+        return trial, trial_status
+
+
+class StaticTrialMakerPractice(PrefetchTrialMaker, StaticTrialMaker):
     performance_check_type = "performance"
     performance_threshold = 0
     give_end_feedback_passed = False
 
 
+class MainSingingTrialMaker(PrefetchTrialMaker, allocation.SetBalancedTrialMaker, StaticTrialMaker):
+    # presents the melodies in blocks of one set, balancing trials across sets and melodies
+    pass
+
+
 practice_singing = join(
     InfoPage("We can now start with the main singing task. But first, we will start with a short practice.", time_estimate=2),
     InfoPage(
@@ -544,7 +653,7 @@ main_singing = join(
         ),
         time_estimate=3
     ),
-    StaticTrialMaker(
+    MainSingingTrialMaker(
         id_="main_singing",
         trial_class=SingingTrial,
         nodes=nodes,
@@ -552,7 +661,7 @@ main_singing = join(
         max_trials_per_participant=TRIALS_PER_PARTICIPANT,
         recruit_mode="n_participants",
         allow_repeated_nodes=False,
-        balance_across_nodes=True,
+        balance_across_nodes=False,  # balanced by set and node in MainSingingTrialMaker
         target_n_participants=NUM_PARTICIPANTS,
         check_performance_at_end=False,
         check_performance_every_trial=False,
@@ -560,6 +669,55 @@ main_singing = join(
 )
 
 
+########################################################################################################################
+# Routes
+########################################################################################################################
+
+extra_routes = Blueprint("extra_routes", __name__)
+
+
+@extra_routes.route("/analysis_plot/<int:trial_id>", methods=["GET"])
+@login_required
+def analysis_plot(trial_id):
+    # plots of trials analysed with DEFER_PLOT are rendered in the background on first request (202 until they
+    # are ready) and then kept in the plot store
+    trial = Trial.query.get(trial_id)
+    if trial is None or not isinstance(trial, plots.DeferredPlotTrial) or trial.deferred_plot is None:
+        abort(404)
+    try:
+        path = trial.request_plot()
+    except analysis.AnalysisQueueFull:
+        return Response("The analysis queue is full.", status=503, headers={"Retry-After": "10"})
+    if path is None:
+        return Response("The plot is being rendered.", status=202, headers={"Retry-After": "2"})
+    return send_file(path, mimetype="image/png")
+
+
+@extra_routes.route("/stimulus_audio/<filename>", methods=["GET"])
+def stimulus_audio(filename):
+    # melodies rendered by melody_prompt (PRERENDER_STIMULI); the names are content hashes, so they never change
+    return send_from_directory(synth.STIMULUS_FOLDER, filename, max_age=STIMULUS_MAX_AGE)
+
+
+@extra_routes.route("/reference_audio/<filename>", methods=["GET"])
+def reference_audio_file(filename):
+    # reference recordings listed in reference_audio["melodies"]; their names contain a hash of their content,
+    # and the version folder they are served from is never modified once installed
+    if filename not in reference_audio_files:
+        abort(404)
+    return send_from_directory(reference_audio["folder"], filename, max_age=STIMULUS_MAX_AGE)
+
+
+@extra_routes.route("/sing_ready/<int:participant_id>", methods=["GET"])
+def sing_ready(participant_id):
+    # token identifying the readiness notifications of the participant and their last notification, for wait
+    # pages that subscribed after it was published; only served to the participant themselves
+    participant = Participant.query.get(participant_id)
+    if participant is None or participant.unique_id != request.args.get("unique_id"):
+        abort(403)
+    return Response(readiness.catch_up(participant_id), mimetype="application/json")
+
+
 ########################################################################################################################
 # Timeline
 ########################################################################################################################
@@ -576,12 +734,15 @@ class Exp(psynet.experiment.Experiment):
         "description": "This is a singing experiment. You will listen to melodies and sing them back as accurately as possible.",
         "contact_email_on_error": "computational.audition+online_running_manu@gmail.com",
         "organization_name": "Max Planck Institute for Empirical Aesthetics",
-        "show_reward": False
+        "show_reward": False,
+        "num_dynos_worker": ANALYSIS_WORKER_PROCESSES,
     }
 
     if DEBUG:
         timeline = Timeline(
             NoConsent(),
+            PreDeployRoutine("render_stimuli", render_stimuli),
+            record_stimulus_bank,
             CodeBlock(lambda participant: participant.var.set("register", "low")),  # set singing register to low
             welcome(),
             practice_singing,
@@ -594,6 +755,8 @@ class Exp(psynet.experiment.Experiment):
             MainConsent(),
             AudiovisualConsent(),
             OpenScienceConsent(),
+            PreDeployRoutine("render_stimuli", render_stimuli),
+            record_stimulus_bank,
             welcome(),
             requirements_mic(),
             mic_test(),
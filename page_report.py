@@ -0,0 +1,208 @@
+# Summarises the metrics the experiment pages store with their responses, one report per command:
+#
+#   trial-gaps   the gaps between two singing trials measured in the browser (see sing/prefetch.py),
+#                split by whether the audio of the next melody was already in the browser cache
+#   provisional  how often the note count shown provisionally by the browser agreed with the count of the
+#                server analysis (see sing/provisional.py), per trial maker
+#   readiness    the wait pages notified when a recording is uploaded or analysed (see sing/readiness.py): how
+#                they continued, how long they waited and the time from the notification to the next page
+#
+# From the database of the experiment (inside the experiment's Docker container):
+#
+# bash docker/run python page_report.py trial-gaps
+# bash docker/run python page_report.py provisional --trial-maker sing_practice
+# bash docker/run python page_report.py readiness
+#
+# With --json, the summary is also written to a JSON file, e.g. ``page_report.py trial-gaps --json gaps.json``.
+
+import argparse
+import json
+import os
+import sys
+
+LISTEN_PAGE = "listen_page"  # label of the listening page of the singing trials (see experiment.py)
+TRIAL_GAP_METRICS = ["inter_trial_gap", "server_time", "page_load_time"]
+PROVISIONAL_TRIAL_MAKERS = ["sing_practice", "singing_performance_feedback"]  # trials with provisional feedback
+WAIT_PAGE_TYPE = "NotifiedWaitPage"  # page_type of the responses of sing.readiness.NotifiedWaitPage
+READINESS_METRICS = ["readiness_waited", "readiness_delivery"]
+
+
+def summarize_percentiles(groups, percentiles):
+    """
+    Summarises ``groups``, a dictionary ``{group: {metric: values}}``, as ``{group: {metric: summary}}``,
+    where each summary holds ``n`` and the percentiles as ``p50``, ``p95``, ...
+    """
+    import numpy as np
+
+    return {
+        group: {
+            metric: dict(
+                n=len(values),
+                **{f"p{p}": float(x) for p, x in zip(percentiles, np.percentile(values, percentiles))},
+            )
+            for metric, values in metrics.items()
+        }
+        for group, metrics in groups.items()
+    }
+
+
+def print_percentiles(summary, percentiles):
+    group_width = max(len(group) for group in summary) + 2
+    metric_width = max(len(metric) for metrics in summary.values() for metric in metrics) + 2
+    print(f"  {'':<{group_width}}{'metric':<{metric_width}}{'n':>6}" + "".join(f"{f'p{p}':>9}" for p in percentiles))
+    for group, metrics in sorted(summary.items()):
+        for metric, s in metrics.items():
+            print(
+                f"  {group:<{group_width}}{metric:<{metric_width}}{s['n']:>6}"
+                + "".join(f"{s[f'p{p}']:>9.3f}" for p in percentiles)
+            )
+
+
+def trial_gaps_from_database():
+    from psynet.experiment import import_local_experiment
+    from psynet.timeline import Response
+    import_local_experiment()
+
+    query = Response.query.filter(Response.question == LISTEN_PAGE).order_by(Response.id)
+    for response in query.yield_per(500):
+        metadata = response.metadata or {}
+        if metadata.get("inter_trial_gap") is not None:
+            yield metadata
+
+
+def group_trial_gaps(records):
+    groups = {}
+    for metadata in records:
+        cached = metadata.get("audio_cached")
+        group = "JSSynth" if cached is None else ("audio cached" if cached else "audio not cached")
+        for metric in TRIAL_GAP_METRICS:
+            if metadata.get(metric) is not None:
+                groups.setdefault(group, {}).setdefault(metric, []).append(metadata[metric])
+    return groups
+
+
+def trial_gaps(args, percentiles):
+    summary = summarize_percentiles(group_trial_gaps(trial_gaps_from_database()), percentiles)
+    if not summary:
+        print("No trial gaps found.")
+        return None
+    print_percentiles(summary, percentiles)
+    return summary
+
+
+def provisional_counts_from_database(trial_makers):
+    from psynet.experiment import import_local_experiment
+    from psynet.trial.main import Trial
+    import_local_experiment()
+
+    query = (
+        Trial.query
+        .filter(Trial.trial_maker_id.in_(trial_makers))
+        .filter(Trial.complete.is_(True))
+        .order_by(Trial.id)
+    )
+    for trial in query.yield_per(500):
+        vars_ = trial.vars or {}
+        if vars_.get("provisional_num_sung_pitches") is not None:
+            yield trial.trial_maker_id, vars_
+
+
+def count_provisional(records):
+    """
+    Summarises ``(trial_maker_id, vars)`` records as ``{trial_maker_id: {"n": ..., "agree": ...}}``,
+    where ``agree`` is the fraction of trials whose provisional count agreed with the analysis.
+    """
+    counts = {}
+    for trial_maker_id, vars_ in records:
+        n, agree = counts.get(trial_maker_id, (0, 0))
+        counts[trial_maker_id] = (n + 1, agree + bool(vars_["provisional_agrees"]))
+    return {trial_maker_id: {"n": n, "agree": agree / n} for trial_maker_id, (n, agree) in counts.items()}
+
+
+def provisional(args, percentiles):
+    summary = count_provisional(provisional_counts_from_database(args.trial_maker or PROVISIONAL_TRIAL_MAKERS))
+    if not summary:
+        print("No provisional note counts found.")
+        return None
+    print(f"  {'trial maker':<32}{'n':>6}{'agree':>8}")
+    for trial_maker_id, s in sorted(summary.items()):
+        print(f"  {trial_maker_id:<32}{s['n']:>6}{s['agree']:>8.1%}")
+    return summary
+
+
+def readiness_from_database():
+    from dallinger import db
+    from psynet.experiment import import_local_experiment
+    from psynet.timeline import Response
+    from sqlalchemy import func, or_
+    import_local_experiment()
+
+    # the responses of the wait pages and of the page shown right after one (with notify_to_render)
+    previous_page_type = func.lag(Response.page_type).over(
+        partition_by=Response.participant_id, order_by=Response.id
+    )
+    pages = db.session.query(Response.id, previous_page_type.label("previous_page_type")).subquery()
+    query = (
+        Response.query
+        .join(pages, Response.id == pages.c.id)
+        .filter(or_(Response.page_type == WAIT_PAGE_TYPE, pages.c.previous_page_type == WAIT_PAGE_TYPE))
+        .order_by(Response.id)
+    )
+    for response in query.yield_per(500):
+        metadata = response.metadata or {}
+        if "readiness_transport" in metadata or "notify_to_render" in metadata:
+            yield metadata
+
+
+def group_readiness(records):
+    groups = {}
+    for metadata in records:
+        if "notify_to_render" in metadata:
+            groups.setdefault("render", {}).setdefault("notify_to_render", []).append(metadata["notify_to_render"])
+            continue
+        for metric in READINESS_METRICS:
+            if metadata.get(metric) is not None:
+                groups.setdefault(metadata["readiness_transport"], {}).setdefault(metric, []).append(metadata[metric])
+    return groups
+
+
+def readiness(args, percentiles):
+    summary = summarize_percentiles(group_readiness(readiness_from_database()), percentiles)
+    if not summary:
+        print("No notified wait pages found.")
+        return None
+    print_percentiles(summary, percentiles)
+    return summary
+
+
+def main(argv=None):
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--json", help="also write the summary to this JSON file")
+    parser = argparse.ArgumentParser(description="Summarise the metrics stored with the page responses.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "trial-gaps", parents=[options], help="gaps between two singing trials"
+    ).set_defaults(report=trial_gaps)
+    provisional_parser = commands.add_parser(
+        "provisional", parents=[options], help="agreement of the provisional note counts"
+    )
+    provisional_parser.add_argument(
+        "--trial-maker", action="append", choices=PROVISIONAL_TRIAL_MAKERS, help="only these trial makers"
+    )
+    provisional_parser.set_defaults(report=provisional)
+    commands.add_parser(
+        "readiness", parents=[options], help="notified wait pages"
+    ).set_defaults(report=readiness)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sing import timing
+
+    summary = args.report(args, timing.PERCENTILES)
+    if summary and args.json:
+        with open(args.json, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
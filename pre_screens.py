@@ -1,8 +1,7 @@
-import numpy as np
 from markupsafe import Markup
 from dominate import tags
 
-from psynet.page import InfoPage, ModularPage, wait_while
+from psynet.page import InfoPage, ModularPage
 from psynet.modular_page import PushButtonControl, AudioPrompt, RadioButtonControl, AudioMeterControl, \
     AudioRecordControl
 from psynet.trial.audio import AudioRecordTrial
@@ -15,14 +14,20 @@ from psynet.trial import compile_nodes_from_directory
 from .params import singing_2intervals
 from sing4me import singing_extract as sing
 from .sing import melodies
+from .sing import analysis
+from .sing import plots
+from .sing import timing
+from .sing import onsets
+from .sing import stimuli
+from .sing import performance
+from .sing import variables
+from .sing import provisional
+from .sing import readiness
+from .sing import upload
 from .sing.melodies import convert_interval_sequence_to_absolute_pitches, sample_reference_pitch, sample_interval_sequence
 
-roving_width = 2.5
-roving_mean = dict(
-    default=55,
-    low=49,
-    high=61
-)
+roving_width = stimuli.ROVING_WIDTH
+roving_mean = stimuli.ROVING_MEAN
 
 
 # volume test for tone js
@@ -182,13 +187,13 @@ def recording_example():
                 ],
             ),
         ),
-        wait_while(
-            lambda participant: not participant.assets["singing_record_example"].deposited,
+        readiness.wait_until_deposited(
+            "singing_record_example",
             expected_wait=5.0,
             log_message="Waiting for the recording to finish uploading",
         ),
         PageMaker(
-            lambda participant: ModularPage(
+            lambda participant: readiness.with_render_metric(ModularPage(
                 "playback",
                 AudioPrompt(
                     participant.assets["singing_record_example"],
@@ -202,7 +207,7 @@ def recording_example():
                         """
                     ),
                 ),
-            ),
+            )),
             time_estimate=5,
         ),
     )
@@ -216,14 +221,22 @@ performance_trial_time_estimate = 8
 duration_melody = 2.5
 duration_recording = 3.5
 save_plot_prescreen = True
+defer_plot_prescreen = False  # render plots on request instead of during the analysis (see sing/plots.py)
+compress_uploads_prescreen = False  # compressed recording upload (see sing/upload.py and check_upload.py)
 
 # tests
 num_trials_test = 8
 num_trials_feedback = 2
 performance_threshold = 5  # this determines when we fail people in the main performance test
 
-roving_mean_low = 49
-roving_mean_high = 61
+roving_mean_low = stimuli.PERFORMANCE_TEST["roving_mean"]["low"]
+roving_mean_high = stimuli.PERFORMANCE_TEST["roving_mean"]["high"]
+# end the test once pass/fail can no longer change and, for participants who pass, the register is settled
+# (see performance.register_estimate)
+early_stop_register = False
+# also end the test once a sequential test settles pass/fail (see performance.sprt_outcome), with these error rates
+sequential_test = False
+sequential_test_settings = performance.SPRT
 
 # timbre
 note_duration_tonejs = 0.8
@@ -239,45 +252,142 @@ TIMBRE = dict(
     )
 )
 
-nodes_singing_performance_test = [
-    StaticNode(
-        definition={
-            "interval": interval,
-            "target_pitches": melodies.convert_interval_sequence_to_absolute_pitches(
-                intervals=[interval],
-                reference_pitch=melodies.sample_reference_pitch(
-                    roving_mean[register],
-                    roving_width
-                ),
-                reference_mode="previous_note",
-            ),
-        },
+# generated once by `python -m sing.stimuli build` (see sing/stimuli.py), so that all workers share the same nodes;
+# the nodes are created by psynet when it sets up the networks at deploy time
+def nodes_singing_performance_test():
+    return [
+        StaticNode(definition=definition)
+        for definition in stimuli.load()["performance_test"]
+    ]
+
+
+def nodes_singing_performance_test2():
+    return [
+        StaticNode(definition=definition)
+        for definition in stimuli.load()["performance_test2"]
+    ]
+
+
+@timing.timed_analysis
+def analyze_performance_test_recording(audio_file, output_plot, target_pitches):
+    # analysis of a singing performance test trial (also used offline by reanalyze.py, with output_plot=None,
+    # which skips the plot)
+    save_plot = save_plot_prescreen and output_plot is not None
+    raw = analysis.analyze(
+        audio_file,
+        singing_2intervals,
+        target_pitches=target_pitches,
+        output_plot=output_plot,
+        save_plot=save_plot and not defer_plot_prescreen,
     )
-    for interval in [-1.3, -2.6, 1.3, 2.6]
-    for register in ["low", "high"]
-]
-
-nodes_singing_performance_test2 = [
-    StaticNode(
-        definition={
-            "interval": interval,
-            "target_pitches": melodies.convert_interval_sequence_to_absolute_pitches(
-                intervals=[interval],
-                reference_pitch=melodies.sample_reference_pitch(
-                    roving_mean[register],
-                    roving_width
-                ),
-                reference_mode="previous_note",
-            ),
-        },
+    if save_plot and defer_plot_prescreen:
+        with timing.stage("plot_spec"):
+            plot = plots.plot_spec(audio_file, singing_2intervals, target_pitches)
+    else:
+        plot = None
+    sung_pitches = [x["median_f0"] for x in raw]
+    sung_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
+        sung_pitches,
+        "previous_note"
     )
-    for interval in [-1.3, -2.6, 1.3, 2.6]
-    for register in ["low", "high"]
-]
-
+    target_intervals = list(melodies.get_melody(target_pitches).intervals("first_note"))
+    with timing.stage("compute_stats"):
+        stats = sing.compute_stats(
+            sung_pitches,
+            target_pitches,
+            sung_intervals,
+            target_intervals
+        )
 
-class SingingPerformanceTestTrial(AudioRecordTrial, StaticTrial):
+    # failing criteria
+    correct_num_notes = stats["num_sung_pitches"] == stats["num_target_pitches"]
+    max_interval_error_ok = stats["max_abs_interval_error"] < 3
+    direction_accuracy_ok = stats["direction_accuracy"] == 100
+
+    failed_options = [
+        correct_num_notes,
+        max_interval_error_ok,
+        direction_accuracy_ok
+    ]
+    reasons = [
+        "Wrong number of sung notes",
+        "max interval error is larger than 3",
+        "direction accuyracy is wrong"
+    ]
+    if False in failed_options:
+        failed = True
+        index = failed_options.index(False)
+        reason = reasons[index]
+    else:
+        failed = False
+        reason = "All good"
+
+    return {
+        "failed": failed,
+        "reason": reason,
+        "target_pitches": target_pitches,
+        "target_intervals": target_intervals,
+        "sung_pitches": sung_pitches,
+        "sung_intervals": sung_intervals,
+        "raw": raw,
+        # "stats": stats,
+        "mean_pitch_diffs": stats["mean_pitch_diffs"],
+        "max_abs_pitch_error": stats["max_abs_pitch_error"],
+        "mean_interval_diff": stats["mean_interval_diff"],
+        "max_abs_interval_error": stats["max_abs_interval_error"],
+        "direction_accuracy": stats["direction_accuracy"],
+        "plot": plot,
+    }
+
+
+@timing.timed_analysis
+def analyze_performance_feedback_recording(audio_file, output_plot, target_pitches, analysis_mode="full"):
+    # analysis of a singing performance feedback trial (also used offline by reanalyze.py)
+    # with analysis_mode="note_count", the notes are only counted from the energy envelope (see sing/onsets.py);
+    # output_plot=None skips the plot
+    save_plot = save_plot_prescreen and output_plot is not None
+    if analysis_mode == "note_count":
+        notes = onsets.count_notes(audio_file, singing_2intervals)
+        num_sung_pitches = notes["num_sung_pitches"]
+        plot = None
+    elif analysis_mode == "full":
+        raw = analysis.analyze(
+            audio_file,
+            singing_2intervals,
+            target_pitches=target_pitches,
+            output_plot=output_plot,
+            save_plot=save_plot and not defer_plot_prescreen,
+        )
+        if save_plot and defer_plot_prescreen:
+            with timing.stage("plot_spec"):
+                plot = plots.plot_spec(audio_file, singing_2intervals, target_pitches)
+        else:
+            plot = None
+        num_sung_pitches = len(raw)
+    else:
+        raise ValueError(f"Unrecognized analysis_mode: {analysis_mode}.")
+
+    if num_sung_pitches >= 1:
+        correct_num_notes = True
+        failed = False
+    else:
+        correct_num_notes = False
+        failed = True
+
+    return {
+        "failed": failed,
+        "correct_num_notes": correct_num_notes,
+        "num_sung_pitches": num_sung_pitches,
+        "analysis_mode": analysis_mode,
+        "plot": plot,
+    }
+
+
+class SingingPerformanceTestTrial(
+    performance.PerformanceStatsTrial, plots.DeferredPlotTrial, AudioRecordTrial, StaticTrial
+):
     time_estimate = performance_trial_time_estimate
+    analysis_config = singing_2intervals
 
     def show_trial(self, experiment, participant):
         # count trials
@@ -295,6 +405,7 @@ class SingingPerformanceTestTrial(AudioRecordTrial, StaticTrial):
                     <i>leave a silent gap between the notes</i>
                     <br><br>
                     {show_current_trial}
+                    {upload.compression_script() if compress_uploads_prescreen else ""}
                     """
                 ),
                 [Note(pitch) for pitch in self.definition["target_pitches"]],
@@ -302,7 +413,7 @@ class SingingPerformanceTestTrial(AudioRecordTrial, StaticTrial):
                 default_duration=note_duration_tonejs,
                 default_silence=note_silence_tonejs,
             ),
-            control=AudioRecordControl(
+            control=(upload.CompressedAudioRecordControl if compress_uploads_prescreen else AudioRecordControl)(
                 duration=duration_recording,
                 show_meter=False,
                 controls=False,
@@ -324,75 +435,14 @@ class SingingPerformanceTestTrial(AudioRecordTrial, StaticTrial):
         )
 
     def analyze_recording(self, audio_file: str, output_plot: str):
-        raw = sing.analyze(
-            audio_file,
-            singing_2intervals,
-            target_pitches=self.definition["target_pitches"],
-            plot_options=sing.PlotOptions(
-                save=save_plot_prescreen, path=output_plot, format="png"
-            ),
-        )
-        raw = [
-            {key: melodies.as_native_type(value) for key, value in x.items()} for x in raw
-        ]
-        sung_pitches = [x["median_f0"] for x in raw]
-        sung_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
-            sung_pitches,
-            "previous_note"
-        )
-        target_intervals = melodies.convert_absolute_pitches_to_interval_sequence(
-            self.definition["target_pitches"],
-            "first_note"
-        )
-        stats = sing.compute_stats(
-            sung_pitches,
-            self.definition["target_pitches"],
-            sung_intervals,
-            target_intervals
-        )
+        return analyze_performance_test_recording(audio_file, output_plot, self.definition["target_pitches"])
 
-        # failing criteria
-        correct_num_notes = stats["num_sung_pitches"] == stats["num_target_pitches"]
-        max_interval_error_ok = stats["max_abs_interval_error"] < 3
-        direction_accuracy_ok = stats["direction_accuracy"] == 100
-
-        failed_options = [
-            correct_num_notes,
-            max_interval_error_ok,
-            direction_accuracy_ok
-        ]
-        reasons = [
-            "Wrong number of sung notes",
-            "max interval error is larger than 3",
-            "direction accuyracy is wrong"
-        ]
-        if False in failed_options:
-            failed = True
-            index = failed_options.index(False)
-            reason = reasons[index]
-        else:
-            failed = False
-            reason = "All good"
-
-        return {
-            "failed": failed,
-            "reason": reason,
-            "target_pitches": self.definition["target_pitches"],
-            "target_intervals": target_intervals,
-            "sung_pitches": sung_pitches,
-            "sung_intervals": sung_intervals,
-            "raw": raw,
-            # "stats": stats,
-            "mean_pitch_diffs": stats["mean_pitch_diffs"],
-            "max_abs_pitch_error": stats["max_abs_pitch_error"],
-            "mean_interval_diff": stats["mean_interval_diff"],
-            "max_abs_interval_error": stats["max_abs_interval_error"],
-            "direction_accuracy": stats["direction_accuracy"],
-        }
-
-
-class SingingPerformanceFeedbackTrial(AudioRecordTrial, StaticTrial):
+class SingingPerformanceFeedbackTrial(
+        readiness.NotifiedFeedbackTrial, plots.DeferredPlotTrial, AudioRecordTrial, StaticTrial
+):
     time_estimate = performance_trial_time_estimate
+    analysis_config = singing_2intervals
+    analysis_mode = "full"  # "note_count" only counts the notes from the energy envelope (see test_onsets.py)
     wait_for_feedback = True
 
     def show_trial(self, experiment, participant):
@@ -411,6 +461,8 @@ class SingingPerformanceFeedbackTrial(AudioRecordTrial, StaticTrial):
                     <i>leave a silent gap between the notes</i>
                     <br><br>
                     {show_current_trial}
+                    {upload.compression_script() if compress_uploads_prescreen else ""}
+                    {provisional.note_count_script(self.analysis_config, len(self.definition["target_pitches"]))}
                     """
                 ),
                 [Note(pitch) for pitch in self.definition["target_pitches"]],
@@ -418,7 +470,7 @@ class SingingPerformanceFeedbackTrial(AudioRecordTrial, StaticTrial):
                 default_duration=note_duration_tonejs,
                 default_silence=note_silence_tonejs,
             ),
-            control=AudioRecordControl(
+            control=(upload.CompressedAudioRecordControl if compress_uploads_prescreen else AudioRecordControl)(
                 duration=duration_recording,
                 show_meter=False,
                 controls=False,
@@ -445,6 +497,7 @@ class SingingPerformanceFeedbackTrial(AudioRecordTrial, StaticTrial):
     def show_feedback(self, experiment, participant):
         output_analysis = self.analysis
         num_sung_pitches = output_analysis["num_sung_pitches"]
+        provisional.compare(self, num_sung_pitches)
 
         if num_sung_pitches == 2:
             return InfoPage(
@@ -499,32 +552,9 @@ class SingingPerformanceFeedbackTrial(AudioRecordTrial, StaticTrial):
             )
 
     def analyze_recording(self, audio_file: str, output_plot: str):
-        raw = sing.analyze(
-            audio_file,
-            singing_2intervals,
-            target_pitches=self.definition["target_pitches"],
-            plot_options=sing.PlotOptions(
-                save=save_plot_prescreen, path=output_plot, format="png"
-            ),
+        return analyze_performance_feedback_recording(
+            audio_file, output_plot, self.definition["target_pitches"], self.analysis_mode
         )
-        raw = [
-            {key: melodies.as_native_type(value) for key, value in x.items()} for x in raw
-        ]
-        sung_pitches = [x["median_f0"] for x in raw]
-
-        if len(sung_pitches) >= 1:
-            correct_num_notes = True
-            failed = False
-        else:
-            correct_num_notes = False
-            failed = True
-
-        return {
-            "failed": failed,
-            "correct_num_notes": correct_num_notes,
-            "num_sung_pitches": len(sung_pitches),
-        }
-
 
 class SingingPerformanceFeedbackTrialMaker(StaticTrialMaker):
     performance_check_type = "performance"
@@ -537,43 +567,77 @@ class SingingPerformanceTestTrialMaker(StaticTrialMaker):
     give_end_feedback_passed = True
     end_performance_check_waits = True
 
+    def prepare_trial(self, experiment, participant):
+        # with early stopping, the register estimate is updated before every trial from the analyses finished
+        # so far; the participant is locked first, as the analyses update the statistics in parallel
+        if not (early_stop_register or sequential_test):
+            return super().prepare_trial(experiment, participant)
+        participant = performance.lock_participant(participant.id)
+        stats = participant.var.get(performance.stats_var(self.id), default=None) or performance.empty_stats()
+        estimate = performance.register_estimate(stats, roving_mean_low, roving_mean_high)
+        decision = self.early_decision(stats, estimate)
+        if decision is not None:
+            variables.set_vars(
+                participant, register_estimate=estimate, **{performance.decision_var(self.id): decision}
+            )
+            return None, "exit"
+        variables.set_vars(participant, register_estimate=estimate)
+        return super().prepare_trial(experiment, participant)
+
+    @staticmethod
+    def settled_outcome(stats):
+        # "pass" if the threshold is reached, "fail" if it cannot be reached even if all remaining trials succeed
+        score = stats["score"]
+        num_remaining = num_trials_test - len(stats["trial_ids"])
+        if score >= performance_threshold:
+            return "pass"
+        if score + num_remaining < performance_threshold:
+            return "fail"
+        return None
+
+    def early_decision(self, stats, estimate):
+        # the outcome if the test can end before its last trial, otherwise None
+        num_trials = len(stats["trial_ids"])
+        outcome = self.settled_outcome(stats)
+        llr = None
+        if outcome is None and sequential_test:
+            outcome, llr = performance.sprt_outcome(stats["score"], num_trials, **sequential_test_settings)
+        if outcome is None or num_trials >= num_trials_test:
+            return None
+        if outcome == "pass" and not estimate["register_settled"]:
+            # participants who pass still need a register for the main task
+            return None
+        return {"outcome": outcome, "num_trials": num_trials, "score": stats["score"], "llr": llr}
+
     def performance_check(self, experiment, participant, participant_trials):
-        score = 0
-        list_max_abs_interval_error = []
-        list_direction_accuracy = []
-        list_sung_pitches = []
-
-        for trial in participant_trials:
-            # list_max_abs_pitch_diff.append(trial.analysis["max_abs_pitch_error"])
-            list_max_abs_interval_error.append(trial.analysis["max_abs_interval_error"])
-            list_direction_accuracy.append(trial.analysis["direction_accuracy"])
-            list_sung_pitches.append(trial.analysis["sung_pitches"])
-            if not trial.analysis["failed"]:
-                score += 1
-        passed = score >= performance_threshold
-
-        # store variables in particaipnt table
-        participant.var.set("singing_performance", score)
-        participant.var.set("list_max_abs_interval_error", list_max_abs_interval_error)
-        participant.var.set("list_direction_accuracy", list_direction_accuracy)
+        # running statistics updated as each analysis finished (see sing/performance.py)
+        participant = performance.lock_participant(participant.id)
+        stats = performance.get_stats(participant, self.id, participant_trials)
+        score = stats["score"]
+        decision = participant.var.get(performance.decision_var(self.id), default=None)
+        if decision is not None:
+            # the test ended early; trials analysed after the decision do not change it
+            passed = decision["outcome"] == "pass"
+        else:
+            passed = score >= performance_threshold
 
         # determine register
-        flat_list_sung_pitches = [x for xs in list_sung_pitches for x in xs]
-        median_pitch = np.median(flat_list_sung_pitches)
-        distance_to_low_register = abs(median_pitch - roving_mean_low)
-        distance_to_high_register = abs(median_pitch - roving_mean_high)
-
-        if distance_to_low_register < distance_to_high_register:
-            predicted_register = "low"
-        elif distance_to_low_register > distance_to_high_register:
-            predicted_register = "high"
-        else:
-            predicted_register = "undefined"
+        median_pitch, distance_to_low_register, distance_to_high_register, predicted_register = (
+            performance.predict_register(stats["sung_pitches"], roving_mean_low, roving_mean_high)
+        )
 
-        participant.var.set("sung_median_pitch", median_pitch)
-        participant.var.set("distance_to_low_register", distance_to_low_register)
-        participant.var.set("distance_to_high_register", distance_to_high_register)
-        participant.var.set("predicted_register", predicted_register)
+        # store variables in particaipnt table, in one update (see sing/variables.py)
+        variables.set_vars(
+            participant,
+            singing_performance=score,
+            list_max_abs_interval_error=stats["list_max_abs_interval_error"],
+            list_direction_accuracy=stats["list_direction_accuracy"],
+            register_estimate=performance.register_estimate(stats, roving_mean_low, roving_mean_high),
+            sung_median_pitch=median_pitch,
+            distance_to_low_register=distance_to_low_register,
+            distance_to_high_register=distance_to_high_register,
+            predicted_register=predicted_register,
+        )
 
         return {"score": score, "passed": passed}
 
@@ -0,0 +1,234 @@
+# Re-runs the analysis of every recorded trial, e.g. after changing params.singing_2intervals.
+#
+# Run it inside the experiment's Docker container, with the database of the experiment available:
+#
+# bash docker/run python reanalyze.py --output reanalysis
+#
+# Results are written as Parquet files (one file per chunk of trials) to the output folder.
+# Running the same command again resumes: trials already analysed in the output folder are skipped
+# (trials that failed with an error are tried again and appear twice, the later row is the valid one).
+# No plots are rendered, whatever SAVE_PLOT is set to in the experiment.
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+TRIAL_MAKERS = [
+    "main_singing",
+    "sing_practice",
+    "singing_performance_test",
+    "singing_performance_feedback",
+]
+
+
+def load_experiment():
+    from psynet.experiment import import_local_experiment
+    module = import_local_experiment()["module"]
+    package = module.__package__
+    return (
+        module,
+        importlib.import_module(f"{package}.pre_screens"),
+        importlib.import_module(f"{package}.sing.analysis"),
+    )
+
+
+def get_job(experiment, pre_screens, trial):
+    # returns the analysis function of the trial and its arguments (besides audio_file and output_plot)
+    if trial.trial_maker_id in ["main_singing", "sing_practice"]:
+        register = trial.participant.var.register
+        return experiment.analyze_singing_recording, (trial.definition["melody"], register)
+    if trial.trial_maker_id == "singing_performance_test":
+        return pre_screens.analyze_performance_test_recording, (trial.definition["target_pitches"],)
+    if trial.trial_maker_id == "singing_performance_feedback":
+        return pre_screens.analyze_performance_feedback_recording, (
+            trial.definition["target_pitches"],
+            pre_screens.SingingPerformanceFeedbackTrial.analysis_mode,
+        )
+    raise ValueError(f"No analysis defined for trial maker {trial.trial_maker_id}")
+
+
+def run_job(fn, audio_file, args):
+    # runs in a worker process; output_plot=None skips the plot
+    start = time.perf_counter()
+    output = fn(audio_file, None, *args)
+    return output, time.perf_counter() - start
+
+
+def to_row(info, output=None, duration=None, error=None):
+    # flattens an analysis into one row: numbers and strings become columns, lists and dicts are stored as JSON
+    row = dict(info)
+    row["status"] = "error" if error else "ok"
+    row["error"] = error
+    row["duration_sec"] = duration
+    for key, value in (output or {}).items():
+        if key == "raw":
+            continue
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        row[key] = value
+    row["raw"] = json.dumps((output or {}).get("raw"))
+    return row
+
+
+class OutputFolder:
+    """
+    Folder of Parquet files ``part-00000.parquet``, ``part-00001.parquet``, ...
+    New rows are buffered and written as a new part every ``chunk_size`` rows.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buffer = []
+        os.makedirs(path, exist_ok=True)
+        self.parts = sorted(f for f in os.listdir(path) if f.startswith("part-") and f.endswith(".parquet"))
+
+    def done_trial_ids(self, trial_makers):
+        # trials of ``trial_makers`` already analysed; trials that failed with an error are tried again
+        ids = set()
+        for part in self.parts:
+            df = pd.read_parquet(os.path.join(self.path, part), columns=["trial_id", "trial_maker_id", "status"])
+            done = (df["status"] == "ok") & df["trial_maker_id"].isin(trial_makers)
+            ids.update(int(x) for x in df.loc[done, "trial_id"])
+        return ids
+
+    def add(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        name = f"part-{len(self.parts):05d}.parquet"
+        tmp_path = os.path.join(self.path, name + ".tmp")
+        pd.DataFrame(self.buffer).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        self.parts.append(name)
+        self.buffer = []
+
+
+class Progress:
+    def __init__(self, total, num_workers, every=5.0):
+        self.total = total
+        self.num_workers = num_workers
+        self.every = every
+        self.done = 0
+        self.errors = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, error=False):
+        self.done += 1
+        self.errors += int(error)
+        now = time.perf_counter()
+        if now - self.last >= self.every or self.done == self.total:
+            self.last = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float("nan")
+        print(
+            f"{self.done}/{self.total} trials ({self.errors} errors) | "
+            f"{rate:.2f} trials/s, {rate / self.num_workers:.2f} trials/s per worker | "
+            f"elapsed {elapsed:.0f} s, ETA {eta:.0f} s",
+            flush=True,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-analyse all recorded singing trials.")
+    parser.add_argument("--output", default="reanalysis", help="output folder for the Parquet files")
+    parser.add_argument("--trial-maker", action="append", choices=TRIAL_MAKERS, help="only these trial makers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=500, help="number of trials per Parquet file")
+    parser.add_argument(
+        "--profile-stages", action="store_true", help="also time the stages of sing.analyze (see sing/stages.py)"
+    )
+    args = parser.parse_args(argv)
+
+    experiment, pre_screens, analysis = load_experiment()
+    from psynet.trial.main import Trial
+
+    # workers run the analysis inline; the pool below is started before the database is touched,
+    # so that no database connections are shared with the forked workers
+    analysis.configure(num_workers=0, profile_stages=args.profile_stages)
+    pool = analysis.AnalysisEngine(num_workers=args.workers, max_pending=2 * args.workers)
+    pool.result(pool.submit(time.sleep, 0))
+
+    trial_makers = args.trial_maker or TRIAL_MAKERS
+    output = OutputFolder(args.output, args.chunk_size)
+    done = output.done_trial_ids(trial_makers)
+
+    query = (
+        Trial.query
+        .filter(Trial.trial_maker_id.in_(trial_makers))
+        .filter(Trial.complete.is_(True))
+        .order_by(Trial.id)
+    )
+    total = max(query.count() - len(done), 0)
+    print(f"Re-analysing {total} trials ({len(done)} already done) with {args.workers} workers", flush=True)
+    progress = Progress(total, args.workers)
+
+    audio_folder = tempfile.mkdtemp()
+
+    def collect(future, info, audio_file):
+        try:
+            result, duration = future.result()
+            row = to_row(info, result, duration)
+        except Exception as e:
+            row = to_row(info, error=f"{type(e).__name__}: {e}")
+        os.remove(audio_file)
+        output.add(row)
+        progress.update(error=row["status"] == "error")
+
+    try:
+        pending = []
+        for trial in query.yield_per(100):
+            if trial.id in done:
+                continue
+            info = dict(
+                trial_id=trial.id,
+                trial_maker_id=trial.trial_maker_id,
+                participant_id=trial.participant_id,
+                node_id=trial.node_id,
+            )
+            audio_file = os.path.join(audio_folder, f"{trial.id}.wav")
+            try:
+                fn, fn_args = get_job(experiment, pre_screens, trial)
+                trial.recording.export(audio_file)
+            except Exception as e:
+                output.add(to_row(info, error=f"{type(e).__name__}: {e}"))
+                progress.update(error=True)
+                continue
+            pending.append((pool.submit(run_job, fn, audio_file, fn_args, timeout=None), info, audio_file))
+
+            # results are collected in the main process as they finish, so that only it writes to the output
+            still_pending = []
+            for future, info, audio_file in pending:
+                if future.done():
+                    collect(future, info, audio_file)
+                else:
+                    still_pending.append((future, info, audio_file))
+            pending = still_pending
+
+        for future, info, audio_file in pending:
+            collect(future, info, audio_file)
+    finally:
+        output.flush()
+        pool.shutdown()
+        shutil.rmtree(audio_folder, ignore_errors=True)
+
+    print(f"Done. Results are in {args.output}", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# set-aware balanced allocation of static nodes, with per-node and per-set counters kept in memory
+import random
+import threading
+import time
+
+from dallinger import db
+from psynet.trial.main import Trial
+from psynet.utils import get_logger
+from sqlalchemy import func
+
+logger = get_logger()
+
+REFRESH_INTERVAL = 60  # seconds between two rebuilds of the counters from the database
+
+
+class AllocationCounters:
+    """
+    Number of trials per node and per set of one trial maker, kept in memory by every server process.
+
+    The counters are rebuilt from the database (one grouped count query) when they are first needed and then
+    every ``refresh_interval`` seconds, which also picks up the allocations made by the other processes.
+    In between, every allocation made by this process is counted right away.
+
+    Parameters
+    ----------
+
+    trial_maker_id : str
+        The trial maker whose trials are counted.
+
+    refresh_interval : float
+        Seconds between two rebuilds from the database.
+    """
+
+    def __init__(self, trial_maker_id: str, refresh_interval: float = REFRESH_INTERVAL):
+        self.trial_maker_id = trial_maker_id
+        self.refresh_interval = refresh_interval
+        self.node_counts = {}
+        self.set_counts = {}
+        self.node_sets = {}
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, node_sets):
+        """
+        Rebuilds the counters from the (non-failed) trials in the database.
+        ``node_sets`` maps the node ids of the trial maker to their set ids.
+        """
+        rows = (
+            db.session.query(Trial.node_id, func.count(Trial.id))
+            .filter(Trial.trial_maker_id == self.trial_maker_id, Trial.failed.is_(False))
+            .group_by(Trial.node_id)
+            .all()
+        )
+        node_counts = {node_id: 0 for node_id in node_sets}
+        node_counts.update(dict(rows))
+        set_counts = {set_id: 0 for set_id in node_sets.values()}
+        for node_id, count in node_counts.items():
+            if node_id in node_sets:
+                set_counts[node_sets[node_id]] += count
+        with self._lock:
+            self.node_sets = dict(node_sets)
+            self.node_counts = node_counts
+            self.set_counts = set_counts
+            self.refreshed_at = time.monotonic()
+        logger.info(
+            "Rebuilt the allocation counters of %s: %i trials over %i nodes.",
+            self.trial_maker_id, sum(node_counts.values()), len(node_counts),
+        )
+
+    def is_stale(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.refresh_interval
+
+    def add(self, node_id, set_id):
+        with self._lock:
+            self.node_counts[node_id] = self.node_counts.get(node_id, 0) + 1
+            self.set_counts[set_id] = self.set_counts.get(set_id, 0) + 1
+
+    def node_count(self, node_id):
+        return self.node_counts.get(node_id, 0)
+
+    def set_count(self, set_id):
+        return self.set_counts.get(set_id, 0)
+
+
+class SetBalancedTrialMaker:
+    """
+    Mixin for ``StaticTrialMaker`` that presents the nodes in blocks of one set (``get_set_id``, by default the
+    ``set_id`` of the melody in the node definition): a participant stays in a set until they have done all
+    of its nodes, then moves to the set with the fewest trials so far. Within a set, the node with the
+    fewest trials comes first. Ties are broken at random.
+
+    The order comes from in-memory ``AllocationCounters``, which replace the ``balance_across_nodes`` sort of
+    psynet, so ``balance_across_nodes`` should be ``False``. They do not save psynet's own counting: its network
+    query still loads the number of trials of every candidate head node, to check that it has space left.
+    The allocation is counted once the trial is created (``prepare_trial``).
+    """
+    set_var = "melody_set"  # participant variable holding the set of the current block
+
+    @staticmethod
+    def get_set_id(definition):
+        return definition["melody"]["set_id"]
+
+    @property
+    def allocation_counters(self):
+        try:
+            return self._allocation_counters
+        except AttributeError:
+            self._allocation_counters = AllocationCounters(self.id)
+            return self._allocation_counters
+
+    def node_sets(self):
+        """
+        The set of every node of the trial maker. The nodes are created at deploy time, so this is loaded once
+        and only again if a node is missing.
+        """
+        try:
+            return self._node_sets
+        except AttributeError:
+            self._node_sets = self.load_node_sets()
+            return self._node_sets
+
+    def load_node_sets(self):
+        rows = (
+            db.session.query(self.node_class.id, self.node_class.definition)
+            .filter_by(trial_maker_id=self.id, failed=False)
+            .all()
+        )
+        return {node_id: self.get_set_id(definition) for node_id, definition in rows}
+
+    def prioritize_networks(self, networks, participant, experiment):
+        networks = super().prioritize_networks(networks, participant, experiment)
+        if not networks:
+            return networks
+        node_sets = self.node_sets()
+        if any(network.head_id not in node_sets for network in networks):
+            node_sets = self._node_sets = self.load_node_sets()
+        counters = self.allocation_counters
+        if counters.is_stale():
+            counters.refresh(node_sets)
+
+        by_set = {}
+        for network in networks:
+            node_id = network.head_id
+            by_set.setdefault(node_sets[node_id], []).append((counters.node_count(node_id), random.random(), network))
+
+        current_set = participant.var.get(self.set_var, default=None)
+        if current_set not in by_set:
+            current_set = min(by_set, key=lambda set_id: (counters.set_count(set_id), random.random()))
+            participant.var.set(self.set_var, current_set)
+
+        ordered = [network for _, _, network in sorted(by_set[current_set], key=lambda x: x[:2])]
+        ordered_ids = {network.id for network in ordered}
+        # psynet takes the first network; the rest keeps psynet's order
+        return ordered + [network for network in networks if network.id not in ordered_ids]
+
+    def prepare_trial(self, experiment, participant):
+        trial, trial_status = super().prepare_trial(experiment, participant)
+        if trial is not None:
+            node_id = trial.node.id
+            set_id = self.node_sets().get(node_id)
+            self.allocation_counters.add(node_id, set_id)
+            logger.info("Allocated node %i of set %s to participant %i.", node_id, set_id, participant.id)
+        return trial, trial_status
@@ -0,0 +1,272 @@
+# analysis of the recording trials with sing4me, with a result cache and a bounded process pool
+#
+# The analysis of a trial (``analyze``) runs inline in psynet's async post-trial job. rq runs one job at a time
+# per worker process (in a forked work horse), so the analyses that run in parallel are capped by the number of
+# rq worker processes (``num_dynos_worker`` of the experiment config), not by a pool: a pool started in a job
+# would only live as long as the job. The process pool of ``AnalysisEngine`` is for long-lived processes that
+# must not wait for an analysis: the web processes rendering deferred plots (see sing/plots.py) and the offline
+# scripts (benchmark.py, reanalyze.py), each with its own pool.
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import sing4me
+from sing4me import singing_extract as sing
+from . import melodies
+from . import stages
+from . import timing
+from .cache import AnalysisCache, hash_file, hash_params
+
+# default settings, can be changed per experiment with configure()
+NUM_WORKERS = 2  # size of the process pool of each process; 0 runs the jobs inline in the calling process
+MAX_PENDING = 8  # analyses allowed to wait in the queue before submit() starts blocking (backpressure)
+SUBMIT_TIMEOUT = 60  # seconds to wait for a free queue slot before giving up
+RESULT_TIMEOUT = 180  # seconds to wait for a submitted analysis to finish
+CACHE_PATH = os.path.join("analysis_cache", "analysis.sqlite3")  # set to None to disable the result cache
+CACHE_MAX_BYTES = 256 * 1024 ** 2
+CACHE_VERSION = 1  # increase when extract_notes changes, so that old results are not reused
+PROFILE_STAGES = False  # also time the stages of sing.analyze on their re-implementation (see sing/stages.py)
+
+
+class AnalysisQueueFull(RuntimeError):
+    pass
+
+
+def extract_notes(audio_file, config, target_pitches=None, output_plot=None, save_plot=False):
+    """
+    Runs ``sing.analyze`` on a recording and converts the output to native python types.
+    This is the expensive part of every ``analyze_recording`` method (bandpass, Praat pitch, segmentation, plot)
+    and it is what the engine runs in its worker processes.
+
+    Parameters
+    ----------
+
+    audio_file:
+        Path to the recording.
+
+    config:
+        The sing4me analysis parameters, e.g. ``params.singing_2intervals``.
+
+    target_pitches:
+        Optional list of target pitches (MIDI), passed on to ``sing.analyze``.
+
+    output_plot:
+        Path where the plot is written when ``save_plot`` is ``True``.
+
+    save_plot:
+        If ``True``, ``sing.analyze`` saves a plot of the analysis to ``output_plot``.
+
+    Returns
+    -------
+
+    A list of dictionaries, one per detected note.
+    """
+    kwargs = {}
+    if target_pitches is not None:
+        kwargs["target_pitches"] = target_pitches
+    raw = sing.analyze(
+        audio_file,
+        config,
+        plot_options=sing.PlotOptions(
+            save=save_plot, path=output_plot, format="png"
+        ),
+        **kwargs,
+    )
+    return [
+        {key: melodies.as_native_type(value) for key, value in x.items()} for x in raw
+    ]
+
+
+class AnalysisEngine:
+    """
+    Runs analysis jobs in a bounded process pool with a bounded job queue.
+
+    At most ``num_workers`` jobs run at the same time and at most ``max_pending`` further jobs wait in the queue.
+    When the queue is full, ``submit`` blocks until a slot becomes free (backpressure) and raises
+    ``AnalysisQueueFull`` if none frees up within ``timeout`` seconds.
+    The pool is created lazily on the first submission, so importing the experiment does not spawn processes.
+    Every process has its own engine (see the top of this module).
+
+    Parameters
+    ----------
+
+    num_workers : int
+        Number of worker processes. With ``0`` jobs are run inline in the calling process.
+
+    max_pending : int
+        Number of jobs allowed to wait for a free worker.
+    """
+
+    def __init__(self, num_workers: int = NUM_WORKERS, max_pending: int = MAX_PENDING):
+        if num_workers < 0 or max_pending < 0:
+            raise ValueError(f"num_workers and max_pending must not be negative, got {num_workers} and {max_pending}.")
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max(num_workers + max_pending, 1))
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+            return self._executor
+
+    def reset(self):
+        # drop a broken pool; a new one is created on the next submission
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args, timeout: float = SUBMIT_TIMEOUT, **kwargs) -> Future:
+        """
+        Queues ``fn(*args, **kwargs)`` and returns a ``Future`` holding its result.
+        ``fn`` and its arguments must be picklable.
+        """
+        if self.num_workers == 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if not self._slots.acquire(timeout=timeout):
+            raise AnalysisQueueFull(
+                f"No free analysis slot after {timeout} s "
+                f"({self.num_workers} workers, {self.max_pending} pending jobs allowed)"
+            )
+        try:
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self.reset()
+                future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def result(self, future: Future, timeout: float = RESULT_TIMEOUT):
+        """
+        Waits for the result of a ``future`` returned by ``submit``. Only for callers off the request path,
+        such as the offline scripts: a request should keep the future instead.
+        """
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self.reset()
+            raise
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_engine = None
+_cache = None
+_settings = dict(
+    num_workers=NUM_WORKERS,
+    max_pending=MAX_PENDING,
+    cache_path=CACHE_PATH,
+    cache_max_bytes=CACHE_MAX_BYTES,
+    profile_stages=PROFILE_STAGES,
+)
+
+
+def configure(**settings):
+    """
+    Changes the settings (``num_workers``, ``max_pending``, ``cache_path``, ``cache_max_bytes``,
+    ``profile_stages``) of the shared engine and cache. Takes effect for the next analysis; a running engine is shut down.
+    """
+    global _engine, _cache
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise ValueError(f"Unknown analysis settings: {sorted(unknown)}")
+    _settings.update(settings)
+    if _engine is not None:
+        _engine.shutdown(wait=False)
+    _engine = None
+    _cache = None
+
+
+def get_engine():
+    """
+    Returns the engine of this process, used to render deferred plots (see sing/plots.py).
+    """
+    global _engine
+    if _engine is None:
+        _engine = AnalysisEngine(num_workers=_settings["num_workers"], max_pending=_settings["max_pending"])
+    return _engine
+
+
+def get_cache():
+    """
+    Returns the shared result cache, or ``None`` if caching is disabled.
+    """
+    global _cache
+    if _cache is None and _settings["cache_path"] is not None:
+        _cache = AnalysisCache(_settings["cache_path"], max_bytes=_settings["cache_max_bytes"])
+    return _cache
+
+
+def cache_key(audio_file, config, target_pitches=None):
+    """
+    Key of an analysis in the cache: hash of the audio bytes plus hash of the canonicalised
+    analysis parameters, target pitches and analysis version.
+    """
+    params_hash = hash_params(
+        config,
+        target_pitches,
+        CACHE_VERSION,
+        getattr(sing4me, "__version__", None),
+    )
+    return AnalysisCache.make_key(hash_file(audio_file), params_hash)
+
+
+def analyze(audio_file, config, target_pitches=None, output_plot=None, save_plot=False):
+    """
+    Runs ``extract_notes`` in the calling process; see ``extract_notes``.
+    This is called by ``analyze_recording``, which psynet runs in the async post-trial job of the trial,
+    so the analysis holds up that job and not a web request (see the top of this module).
+    Results are looked up in the cache first. When a plot is requested, a cached result is only reused
+    if its plot was stored too; the plot is then copied to ``output_plot``.
+    The stages (cache lookup, extraction, cache store) are recorded in the current ``timing.collect`` timer,
+    if any. With the ``profile_stages`` setting, the extraction is followed by ``stages.time_stages``, which
+    records the breakdown of its stages (audio loading, bandpass, Praat pitch, segmentation).
+    """
+    cache = get_cache()
+    if cache is not None:
+        with timing.stage("cache_lookup"):
+            key = cache_key(audio_file, config, target_pitches)
+            hit = cache.get(key)
+        if hit is not None:
+            raw, plot = hit
+            if not save_plot:
+                return raw
+            if plot is not None:
+                with open(output_plot, "wb") as file:
+                    file.write(plot)
+                return raw
+
+    with timing.stage("extract_with_plot" if save_plot else "extract"):
+        raw = extract_notes(
+            audio_file, config, target_pitches=target_pitches, output_plot=output_plot, save_plot=save_plot
+        )
+    if _settings["profile_stages"]:
+        stages.time_stages(audio_file, config)
+
+    if cache is not None:
+        with timing.stage("cache_store"):
+            plot = None
+            if save_plot and os.path.exists(output_plot):
+                with open(output_plot, "rb") as file:
+                    plot = file.read() or None
+            cache.put(key, raw, plot)
+    return raw
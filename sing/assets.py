@@ -0,0 +1,170 @@
+# asset pipeline for the reference recordings in input/melodies-mmb24/<set>/<melody>.wav
+#
+# Every recording is downmixed to mono, resampled, normalised to a common RMS level, encoded (MP3 if ffmpeg
+# is available, WAV otherwise) and stored in reference_audio/ under a name containing its content hash,
+# e.g. Western_1.3f9a0c2d71e4.mp3. The manifest.json of the folder maps every melody id of melodies.json to
+# its set, file and URL. As the names change with the content, the files can be cached by browsers forever.
+#
+# As for the melody catalogs (see sing/catalog.py), reference_audio/ holds one subfolder per version of the
+# recordings and settings, named after their fingerprint. Build it explicitly with ``python -m sing.assets``
+# or let ``open_reference_audio`` build it on first use. Builds are serialised with a lock file, and a version
+# is installed with a single rename of a complete folder that is never replaced afterwards, so processes
+# starting at the same time build it once, and files that are being served are never moved.
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from . import audio
+from .cache import hash_file, hash_params
+from .catalog import build_lock
+
+ASSETS_VERSION = 2
+SOURCE_FOLDER = os.path.join("input", "melodies-mmb24")
+ASSET_FOLDER = "reference_audio"
+ASSET_URL = "/reference_audio"
+MANIFEST = "manifest.json"
+SETTINGS = dict(
+    sample_rate=22050,
+    target_rms_db=-20.0,
+    max_peak_db=-1.0,
+    format=".mp3",  # falls back to .wav without ffmpeg
+    bitrate="96k",
+)
+
+
+def find_sources(source_folder=SOURCE_FOLDER):
+    """
+    Returns ``{path: (set_id, melody_id)}`` for the recordings in ``source_folder``: ``<n>/<name><n>.wav``
+    is melody ``<Name>_<n>`` of set ``set_<n>``, as in melodies.json. Stray spaces in the names are ignored.
+    """
+    sources = {}
+    for path in sorted(glob.glob(os.path.join(source_folder, "*", "*.wav"))):
+        set_number = os.path.basename(os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0].strip()
+        match = re.fullmatch(r"([A-Za-z]+)_?(\d+)", name)
+        if match is None or match.group(2) != set_number:
+            raise ValueError(f"Unexpected reference recording name: {path}")
+        sources[path] = (f"set_{set_number}", f"{match.group(1).capitalize()}_{set_number}")
+    return sources
+
+
+def fingerprint_sources(sources):
+    return hash_params(ASSETS_VERSION, SETTINGS, {path: hash_file(path) for path in sources})
+
+
+def version_folder(folder, fingerprint):
+    return os.path.join(folder, f"v{ASSETS_VERSION}-{fingerprint[:16]}")
+
+
+def process(path, sample_rate, target_rms_db, max_peak_db):
+    source_rate, samples = audio.read_wav(path)
+    samples = audio.resample(audio.to_mono(samples), source_rate, sample_rate)
+    return audio.normalize_loudness(samples, target_rms_db, max_peak_db)
+
+
+def build_reference_audio(source_folder=SOURCE_FOLDER, folder=ASSET_FOLDER):
+    """
+    Processes the recordings of ``source_folder`` into a version subfolder of ``folder``, writes its manifest
+    and returns the path of the subfolder. The subfolder is written next to its destination and renamed into
+    place once complete; if the same version is already installed, the new build is discarded.
+    Call it while holding ``build_lock(folder)``.
+    """
+    sources = find_sources(source_folder)
+    fingerprint = fingerprint_sources(sources)
+    destination = version_folder(folder, fingerprint)
+    os.makedirs(folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=".build.", dir=folder)
+    try:
+        melodies = {}
+        for path, (set_id, melody_id) in sources.items():
+            samples = process(path, SETTINGS["sample_rate"], SETTINGS["target_rms_db"], SETTINGS["max_peak_db"])
+            wav_path = os.path.join(tmp_folder, "tmp.wav")
+            audio.write_wav(wav_path, SETTINGS["sample_rate"], samples)
+            encoded_path = os.path.join(tmp_folder, "tmp" + SETTINGS["format"])
+            if SETTINGS["format"] != ".wav" and audio.encode(wav_path, encoded_path, SETTINGS["bitrate"]):
+                os.remove(wav_path)
+            else:
+                encoded_path = wav_path
+            extension = os.path.splitext(encoded_path)[1]
+            sha256 = hash_file(encoded_path)
+            filename = f"{melody_id}.{sha256[:12]}{extension}"
+            os.rename(encoded_path, os.path.join(tmp_folder, filename))
+            melodies[melody_id] = {
+                "set_id": set_id,
+                "source": path,
+                "file": filename,
+                "url": f"{ASSET_URL}/{filename}",
+                "sha256": sha256,
+                "duration": round(len(samples) / SETTINGS["sample_rate"], 3),
+            }
+
+        with open(os.path.join(tmp_folder, MANIFEST), "w") as file:
+            json.dump(
+                {
+                    "version": ASSETS_VERSION,
+                    "fingerprint": fingerprint,
+                    "settings": SETTINGS,
+                    "melodies": melodies,
+                },
+                file,
+                indent=2,
+            )
+
+        try:
+            os.rename(tmp_folder, destination)
+        except OSError:
+            if not os.path.exists(os.path.join(destination, MANIFEST)):
+                raise
+            # the same version was installed in the meantime
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    return destination
+
+
+def load_manifest(folder):
+    """
+    Reads the manifest of the version folder ``folder``, with the path of the folder under ``"folder"``.
+    """
+    with open(os.path.join(folder, MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest["version"] != ASSETS_VERSION:
+        raise ValueError(f"Reference audio {folder} has version {manifest['version']}, expected {ASSETS_VERSION}")
+    return dict(manifest, folder=folder)
+
+
+def open_reference_audio(source_folder=SOURCE_FOLDER, folder=ASSET_FOLDER):
+    """
+    Returns the manifest of the version of ``folder`` built from the current recordings and settings,
+    building it first if needed. Only one process builds a given version; the others wait for it.
+    """
+    destination = version_folder(folder, fingerprint_sources(find_sources(source_folder)))
+    if not os.path.exists(os.path.join(destination, MANIFEST)):
+        with build_lock(folder):
+            if not os.path.exists(os.path.join(destination, MANIFEST)):
+                build_reference_audio(source_folder, folder)
+    return load_manifest(destination)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the reference recording assets.")
+    parser.add_argument("--source", default=SOURCE_FOLDER, help="folder of the reference recordings")
+    parser.add_argument("--output", default=ASSET_FOLDER, help="asset folder")
+    args = parser.parse_args(argv)
+
+    with build_lock(args.output):
+        folder = build_reference_audio(args.source, args.output)
+    manifest = load_manifest(folder)
+    for melody_id, asset in manifest["melodies"].items():
+        size = os.path.getsize(os.path.join(folder, asset["file"]))
+        print(f"{melody_id:<12} {asset['set_id']:<6} {asset['file']:<32} {size / 1024:7.1f} kB")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# reading and writing audio files
+import shutil
+import subprocess
+import wave
+
+import numpy as np
+
+
+def read_wav(path):
+    """
+    Reads a PCM WAV file and returns ``(sample_rate, samples)``, where ``samples`` is a float array in [-1, 1]
+    of shape ``(num_frames,)`` for mono or ``(num_frames, num_channels)`` otherwise.
+    Uses the ``wave`` module, which (unlike ``scipy.io.wavfile``) accepts the inconsistent byte-rate headers
+    written by some browser recorders.
+    """
+    with wave.open(path, "rb") as file:
+        sample_rate = file.getframerate()
+        num_channels = file.getnchannels()
+        sample_width = file.getsampwidth()
+        data = file.readframes(file.getnframes())
+
+    if sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2") / 32768
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values >= 1 << 23, values - (1 << 24), values)
+        samples = values / float(1 << 23)
+    elif sample_width == 4:
+        samples = np.frombuffer(data, dtype="<i4") / float(1 << 31)
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+
+    if num_channels > 1:
+        samples = samples.reshape(-1, num_channels)
+    return sample_rate, samples
+
+
+def to_mono(samples):
+    if samples.ndim == 1:
+        return samples
+    return samples.mean(axis=1)
+
+
+def write_wav(path, sample_rate, samples):
+    """
+    Writes ``samples`` (a float array in [-1, 1], mono or ``(num_frames, num_channels)``) as a 16-bit PCM WAV file.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    num_channels = 1 if samples.ndim == 1 else samples.shape[1]
+    data = np.round(np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as file:
+        file.setnchannels(num_channels)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes(data.tobytes())
+
+
+def encode(wav_path, output_path, bitrate="96k"):
+    """
+    Transcodes a WAV file to the format given by the extension of ``output_path`` (e.g. ``.mp3``, ``.ogg``)
+    with ffmpeg. Returns ``False`` (and writes nothing) if ffmpeg is not installed.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return False
+    subprocess.run(
+        [ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", wav_path, "-b:a", bitrate, output_path],
+        check=True,
+    )
+    return True
+
+
+def resample(samples, sample_rate, target_rate):
+    """
+    Band-limited resampling of a mono signal by zero-padding or truncating its spectrum (FFT method),
+    which is exact for the short, whole files resampled here.
+    """
+    if sample_rate == target_rate:
+        return samples
+    num_samples = int(round(len(samples) * target_rate / sample_rate))
+    spectrum = np.fft.rfft(samples)
+    num_bins = num_samples // 2 + 1
+    if num_bins <= len(spectrum):
+        spectrum = spectrum[:num_bins]
+    else:
+        spectrum = np.concatenate([spectrum, np.zeros(num_bins - len(spectrum), dtype=complex)])
+    return np.fft.irfft(spectrum, n=num_samples) * (num_samples / len(samples))
+
+
+def normalize_loudness(samples, target_rms_db=-20.0, max_peak_db=-1.0):
+    """
+    Scales ``samples`` to an RMS level of ``target_rms_db`` dBFS, or less if the peak would exceed ``max_peak_db``.
+    """
+    rms = np.sqrt(np.mean(samples ** 2)) if len(samples) else 0.0
+    peak = np.max(np.abs(samples)) if len(samples) else 0.0
+    if rms == 0:
+        return samples
+    gain = min(10 ** (target_rms_db / 20) / rms, 10 ** (max_peak_db / 20) / peak)
+    return samples * gain
@@ -0,0 +1,133 @@
+# persistent, content-addressed cache for analysis results
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 hex digest of a file's bytes.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def canonicalize(x):
+    """
+    Converts parameters to a canonical form so that equal settings always hash the same,
+    e.g. ``60`` and ``60.0`` or tuples and lists, and numpy scalars and python numbers.
+    """
+    if isinstance(x, dict):
+        return {str(key): canonicalize(value) for key, value in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [canonicalize(value) for value in x]
+    if isinstance(x, bool) or x is None or isinstance(x, str):
+        return x
+    if hasattr(x, "item"):  # numpy scalar
+        return canonicalize(x.item())
+    if isinstance(x, (int, float)):
+        return round(float(x), 9)
+    return str(x)
+
+
+def hash_params(*params):
+    """
+    Returns the sha256 hex digest of the canonical JSON representation of ``params``.
+    """
+    text = json.dumps(canonicalize(list(params)), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    On-disk cache (SQLite) for analysis results, with least-recently-used eviction once the stored
+    results exceed ``max_bytes``. Safe to share between processes.
+
+    Parameters
+    ----------
+
+    path : str
+        Location of the SQLite file; parent folders are created if needed.
+
+    max_bytes : int
+        Maximum total size of the stored results (and plots) before old entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self.connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    plot BLOB,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def make_key(audio_hash: str, params_hash: str):
+        return f"{audio_hash}:{params_hash}"
+
+    def get(self, key: str):
+        """
+        Returns a tuple ``(value, plot)`` or ``None`` if ``key`` is not cached.
+        ``plot`` holds the bytes of the plot or ``None`` if no plot was stored.
+        """
+        with self.connect() as con:
+            row = con.execute("SELECT value, plot FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        value, plot = row
+        return json.loads(value), plot
+
+    def put(self, key: str, value, plot: bytes = None):
+        text = json.dumps(value)
+        size = len(text) + (len(plot) if plot else 0)
+        with self.connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO results (key, value, plot, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, text, plot, size, time.time()),
+            )
+            self.evict(con)
+
+    def evict(self, con):
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_delete = []
+        for key, size in con.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        con.executemany("DELETE FROM results WHERE key = ?", to_delete)
+
+    def clear(self):
+        with self.connect() as con:
+            con.execute("DELETE FROM results")
@@ -0,0 +1,277 @@
+# melody catalogs: melodies.json-style catalogs compiled into an indexed, memory-mapped folder
+#
+# The catalog folder of a source (e.g. melodies.catalog/ for melodies.json) holds one subfolder per version of
+# the source, named after the catalog format and the checksum of the source:
+#   melodies.jsonl  one melody entry per line, as in the source
+#   offsets.npy     byte offset of every line, so that single entries can be read without parsing the rest
+#   pitches.npy     target pitches as a (num_melodies, max_notes) float matrix padded with NaN, memory-mapped
+#   lengths.npy     number of notes of every melody
+#   index.json      version, source checksum and the rows of every set_id and melody_id
+#
+# The node definitions of the trial makers are made from the pitch matrix and the index, without parsing
+# melodies.jsonl.
+#
+# Build it explicitly with ``python -m sing.catalog melodies.json`` (e.g. in the Docker image) or let
+# ``open_catalog`` build it on first use. Builds are serialised with a lock file in the catalog folder, and a
+# version is installed with a single rename of a complete folder that is never replaced afterwards, so processes
+# starting at the same time build it once and never see a partial or swapped catalog.
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from .melodies import Melody
+
+CATALOG_VERSION = 3
+CATALOG_SUFFIX = ".catalog"
+LOCK_FILE = ".lock"
+
+
+def iter_source(path):
+    """
+    Streams the melody entries of a catalog source: either a JSON Lines file with one melody per line
+    or a JSON file like ``melodies.json`` (``{"melodies": [...]}``), which has to be parsed at once.
+    Sources are only read to build the catalog, so large corpora should be JSON Lines files.
+    """
+    if path.endswith(".jsonl"):
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path) as file:
+            yield from json.load(file)["melodies"]
+
+
+def hash_source(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 ** 2), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def default_folder(source):
+    return os.path.splitext(source)[0] + CATALOG_SUFFIX
+
+
+def version_folder(folder, source_sha256):
+    return os.path.join(folder, f"v{CATALOG_VERSION}-{source_sha256[:16]}")
+
+
+@contextmanager
+def build_lock(folder):
+    """
+    Holds an exclusive lock on the catalog ``folder`` (created if needed), shared by all processes on the machine.
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, LOCK_FILE), "w") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def build_catalog(source, folder=None):
+    """
+    Compiles the catalog ``source`` into a version subfolder of ``folder`` (default: the source path with the
+    extension replaced by ``.catalog``) and returns the path of that subfolder. The subfolder is written
+    next to its destination and renamed into place once complete; if the same version is already installed,
+    the new build is discarded.
+
+    Every entry needs a ``"set"``, a unique ``"melody"`` id and its ``"target_pitches"``.
+    """
+    folder = folder or default_folder(source)
+    source_sha256 = hash_source(source)
+    destination = version_folder(folder, source_sha256)
+    os.makedirs(folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=".build.", dir=folder)
+    try:
+        offsets, lengths = [], []
+        sets, melody_ids = {}, {}
+        with open(os.path.join(tmp_folder, "melodies.jsonl"), "wb") as file:
+            for row, entry in enumerate(iter_source(source)):
+                if entry["melody"] in melody_ids:
+                    raise ValueError(f"Duplicate melody id in {source}: {entry['melody']}")
+                melody_ids[entry["melody"]] = row
+                sets.setdefault(entry["set"], []).append(row)
+                offsets.append(file.tell())
+                lengths.append(len(entry["target_pitches"]))
+                file.write(json.dumps(entry).encode() + b"\n")
+
+        # second pass over the compiled entries, so that the pitches are never all held in memory as lists
+        matrix = np.lib.format.open_memmap(
+            os.path.join(tmp_folder, "pitches.npy"), mode="w+", dtype=np.float64,
+            shape=(len(lengths), max(lengths, default=0)),
+        )
+        matrix[:] = np.nan
+        with open(os.path.join(tmp_folder, "melodies.jsonl"), "rb") as file:
+            for row, line in enumerate(file):
+                matrix[row, :lengths[row]] = json.loads(line)["target_pitches"]
+        matrix.flush()
+        del matrix
+        np.save(os.path.join(tmp_folder, "lengths.npy"), np.array(lengths, dtype=np.int32))
+        np.save(os.path.join(tmp_folder, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_folder, "index.json"), "w") as file:
+            json.dump(
+                {
+                    "version": CATALOG_VERSION,
+                    "source_sha256": source_sha256,
+                    "num_melodies": len(offsets),
+                    "sets": sets,
+                    "melody_ids": melody_ids,
+                },
+                file,
+            )
+
+        try:
+            os.rename(tmp_folder, destination)
+        except OSError:
+            if not os.path.exists(os.path.join(destination, "index.json")):
+                raise
+            # the same version was installed in the meantime
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    return destination
+
+
+class MelodyCatalog:
+    """
+    Read access to a catalog version folder built by ``build_catalog``. Only the index is loaded in memory:
+    the pitch matrix, the lengths and the line offsets are memory-mapped (shared between the processes that
+    read them) and entries are read from disk on demand.
+
+    Parameters
+    ----------
+
+    folder : str
+        Path of the catalog version folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "index.json")) as file:
+            self.index = json.load(file)
+        if self.index["version"] != CATALOG_VERSION:
+            raise ValueError(f"Catalog {folder} has version {self.index['version']}, expected {CATALOG_VERSION}")
+        self.pitch_matrix = np.load(os.path.join(folder, "pitches.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(folder, "lengths.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"), mmap_mode="r")
+        self.melody_ids = [None] * len(self)
+        for melody_id, row in self.index["melody_ids"].items():
+            self.melody_ids[row] = melody_id
+        self.set_of_rows = [None] * len(self)
+        for set_id, rows in self.index["sets"].items():
+            for row in rows:
+                self.set_of_rows[row] = set_id
+
+    def __len__(self):
+        return self.index["num_melodies"]
+
+    @property
+    def set_ids(self):
+        return list(self.index["sets"])
+
+    def rows(self, set_id=None):
+        """
+        Rows of all melodies, or of the melodies of ``set_id``, in catalog order.
+        """
+        if set_id is None:
+            return range(len(self))
+        return self.index["sets"][set_id]
+
+    def row(self, melody_id):
+        return self.index["melody_ids"][melody_id]
+
+    def entry(self, row):
+        """
+        Reads the entry of ``row`` as it appears in the source.
+        """
+        with open(os.path.join(self.folder, "melodies.jsonl"), "rb") as file:
+            file.seek(int(self.offsets[row]))
+            return json.loads(file.readline())
+
+    def iter_entries(self, rows=None):
+        """
+        Streams the entries of ``rows`` (default: all, in catalog order) without loading the catalog.
+        """
+        with open(os.path.join(self.folder, "melodies.jsonl"), "rb") as file:
+            if rows is None:
+                for line in file:
+                    yield json.loads(line)
+            else:
+                for row in rows:
+                    file.seek(int(self.offsets[row]))
+                    yield json.loads(file.readline())
+
+    def pitches(self, row):
+        """
+        The target pitches of ``row`` as a read-only view of the memory-mapped matrix.
+        """
+        return self.pitch_matrix[row, :self.lengths[row]]
+
+    def pitch_list(self, row):
+        """
+        The target pitches of ``row`` as in the source: a list, with whole numbers as ``int``.
+        """
+        return [int(x) if x.is_integer() else x for x in self.pitches(row).tolist()]
+
+    def melody(self, row):
+        return Melody(self.pitches(row))
+
+    def node_definition(self, row):
+        """
+        The definition of the ``StaticNode`` of ``row``, as used by the main singing task.
+        """
+        return {
+            "melody": {
+                "set_id": self.set_of_rows[row],
+                "melody_id": self.melody_ids[row],
+                "target_pitches": self.pitch_list(row),
+            }
+        }
+
+    def iter_node_definitions(self, rows=None):
+        for row in self.rows() if rows is None else rows:
+            yield self.node_definition(row)
+
+
+def open_catalog(source, folder=None):
+    """
+    Opens the catalog of the current version of ``source`` (e.g. ``melodies.json``), building it first if needed.
+    Only one process builds a given version; the others wait for it and then open the result.
+    """
+    folder = folder or default_folder(source)
+    destination = version_folder(folder, hash_source(source))
+    if not os.path.exists(os.path.join(destination, "index.json")):
+        with build_lock(folder):
+            if not os.path.exists(os.path.join(destination, "index.json")):
+                build_catalog(source, folder)
+    return MelodyCatalog(destination)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a melody catalog.")
+    parser.add_argument("source", help="melodies.json-style file or JSON Lines file with one melody per line")
+    parser.add_argument("--output", help="catalog folder (default: the source path with .catalog)")
+    args = parser.parse_args(argv)
+
+    folder = args.output or default_folder(args.source)
+    with build_lock(folder):
+        version = build_catalog(args.source, folder)
+    catalog = MelodyCatalog(version)
+    print(f"{version}: {len(catalog)} melodies in {len(catalog.set_ids)} sets")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
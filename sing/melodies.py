@@ -1,7 +1,15 @@
 import random
 import math
+import functools
+from itertools import accumulate
+from bisect import bisect_right
 import numpy as np
 
+# candidates drawn per batch by sample_interval_sequences
+MIN_BATCH_SIZE = 256
+MAX_BATCH_SIZE = 2 ** 16
+MAX_CANDIDATES = 10 ** 7
+
 
 # supporting functions for singing experiments
 def sample_interval_sequence(
@@ -41,22 +49,233 @@ def sample_interval_sequence(
 
     A list of intervals, each expressed as numbers.
     """
-    n_try = 1e5
-    counter = 0
-    while counter < n_try:
-        candidate = [
-            sample_interval(
-                max_interval_size,
-                discrete,
+    return sample_interval_sequences(
+        1,
+        n_int,
+        max_interval_size,
+        max_melody_pitch_range,
+        discrete,
+        reference_mode,
+    )[0].tolist()
+
+
+def sample_interval_sequences(
+        num_sequences,
+        n_int,
+        max_interval_size,
+        max_melody_pitch_range,
+        discrete,
+        reference_mode,
+        rng=None,
+        max_candidates=MAX_CANDIDATES,
+):
+    """
+    Generates ``num_sequences`` random interval sequences at once, with the same distribution as
+    ``sample_interval_sequence``: intervals are drawn independently and uniformly, and sequences that exceed
+    ``max_melody_pitch_range`` are rejected. Candidates are drawn and checked in batches with numpy, and the
+    batch size follows the observed acceptance rate, so that tight constraints stay fast.
+
+    Parameters
+    ----------
+    num_sequences:
+        Number of sequences to generate.
+
+    n_int, max_interval_size, max_melody_pitch_range, discrete, reference_mode:
+        See ``sample_interval_sequence``. With ``discrete=True``, intervals are integers between
+        ``-max_interval_size`` and ``max_interval_size`` and they are drawn without rejection
+        by a ``DiscreteIntervalSampler``.
+
+    rng:
+        Optional ``numpy.random.Generator``. By default a generator is seeded from the ``random`` module,
+        so that ``random.seed`` makes the output reproducible.
+
+    max_candidates:
+        Maximum number of candidates to draw before giving up.
+
+    Returns
+    -------
+
+    An array of shape ``(num_sequences, n_int)``.
+    """
+    assert max_interval_size >= 0
+    if discrete:
+        sampler = get_discrete_interval_sampler(n_int, max_interval_size, max_melody_pitch_range, reference_mode)
+        rand = random if rng is None else random.Random(int(rng.integers(2 ** 63)))
+        return np.array([sampler.sample(rand) for _ in range(num_sequences)], dtype=int).reshape(-1, n_int)
+
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+    accepted = []
+    num_accepted = 0
+    num_drawn = 0
+    acceptance_rate = 1.0
+    while num_accepted < num_sequences:
+        if num_drawn >= max_candidates:
+            raise RuntimeError(
+                "Failed to generate valid interval sequence with the following constraints"
             )
-            for _ in range(n_int)
-        ]
-        if is_valid_interval_sequence(candidate, n_int, max_interval_size, max_melody_pitch_range, reference_mode):
-            return candidate
-        counter += 1
-    raise RuntimeError(
-        "Failed to generate valid interval sequence with the following constraints"
-    )
+        remaining = num_sequences - num_accepted
+        batch_size = int(min(
+            max(math.ceil(1.2 * remaining / acceptance_rate), MIN_BATCH_SIZE),
+            MAX_BATCH_SIZE,
+            max_candidates - num_drawn,
+        ))
+        candidates = rng.uniform(-max_interval_size, max_interval_size, size=(batch_size, n_int))
+        valid = candidates[get_melody_pitch_ranges(candidates, reference_mode) <= max_melody_pitch_range]
+
+        num_drawn += batch_size
+        accepted.append(valid[:remaining])
+        num_accepted += len(accepted[-1])
+        # the acceptance rate estimate is kept away from 0 so that the next batch stays bounded
+        acceptance_rate = max(num_accepted / num_drawn, 1 / MAX_BATCH_SIZE)
+
+    return np.concatenate(accepted) if accepted else np.empty((0, n_int))
+
+
+class DiscreteIntervalSampler:
+    """
+    Samples integer interval sequences uniformly among all the sequences that satisfy ``max_interval_size``
+    and ``max_melody_pitch_range``, i.e. with the same distribution as rejection sampling but without retries.
+
+    Every valid melody is counted exactly once by its lowest note ``a`` (relative to the first note, so
+    ``-max_melody_pitch_range <= a <= 0``): its notes lie in the window ``[a, a + max_melody_pitch_range]``
+    and at least one of them equals ``a``. The lowest note is drawn in proportion to the number of melodies
+    with that lowest note, then the intervals are drawn one by one in proportion to the number of ways to
+    complete the melody.
+
+    For ``"previous_note"``, these numbers are counted by dynamic programming over the position of the
+    current note in the window and whether the lowest note has been reached. For ``"first_note"``, the notes
+    are independent and the numbers have closed forms. Counts are exact (python integers).
+    Use ``get_discrete_interval_sampler``, which caches the samplers per parameter set.
+
+    Parameters
+    ----------
+    n_int:
+        Number of intervals in the melody.
+
+    max_interval_size:
+        Maximum absolute interval; rounded down to an integer.
+
+    max_melody_pitch_range:
+        Maximum pitch range of the melody; rounded down to an integer.
+
+    reference_mode:
+        Can be ``"first_note"`` or ``"previous_note"``, see ``sample_interval_sequence``.
+    """
+
+    def __init__(self, n_int, max_interval_size, max_melody_pitch_range, reference_mode):
+        assert n_int >= 0 and max_interval_size >= 0
+        if reference_mode not in ["first_note", "previous_note"]:
+            raise ValueError(f"Unrecognized reference_mode: {reference_mode}.")
+        self.n_int = n_int
+        self.max_step = math.floor(max_interval_size)
+        self.reference_mode = reference_mode
+        reach = self.max_step * n_int if reference_mode == "previous_note" else 2 * self.max_step
+        # wider windows than the furthest reachable note do not change anything
+        self.max_range = min(math.floor(max_melody_pitch_range), reach)
+
+        if self.max_range < 0:
+            self.lowest_notes, self.cum_counts = [], []
+            return
+        if reference_mode == "previous_note":
+            self._count_walks()
+        lowest_notes = range(-self.max_range, 1)
+        self.lowest_notes = list(lowest_notes)
+        self.cum_counts = list(accumulate(self.count(a) for a in lowest_notes))
+
+    @property
+    def num_sequences(self):
+        """
+        Number of valid interval sequences.
+        """
+        return self.cum_counts[-1] if self.cum_counts else 0
+
+    def _count_walks(self):
+        # completions[k][p][hit]: number of ways to choose the intervals k + 1, ..., n_int when note k is at
+        # position p of the window (0 is the lowest note) such that the lowest note is reached;
+        # steps[k][p][hit] holds the lowest reachable position and the cumulative counts over next positions
+        n, m, width = self.n_int, self.max_step, self.max_range + 1
+        completions = [None] * (n + 1)
+        completions[n] = [[0, 1] for _ in range(width)]
+        self.steps = [None] * n
+        for k in range(n - 1, -1, -1):
+            completions[k] = [[0, 0] for _ in range(width)]
+            self.steps[k] = [[None, None] for _ in range(width)]
+            for p in range(width):
+                low, high = max(p - m, 0), min(p + m, width - 1)
+                for hit in [0, 1]:
+                    cum = list(accumulate(
+                        completions[k + 1][q][hit or q == 0] for q in range(low, high + 1)
+                    ))
+                    completions[k][p][hit] = cum[-1]
+                    self.steps[k][p][hit] = (low, cum)
+        self.completions = completions
+
+    def count(self, a):
+        """
+        Number of valid interval sequences whose lowest note is ``a`` semitones from the first note.
+        """
+        if not -self.max_range <= a <= 0:
+            return 0
+        if self.reference_mode == "previous_note":
+            return self.completions[0][-a][a == 0]
+        # first_note: every interval lies in [a, a + max_range] and, unless a == 0, one of them equals a
+        num_values = self._num_values(a)
+        if a == 0:
+            return num_values ** self.n_int
+        if a < -self.max_step:
+            return 0
+        return num_values ** self.n_int - (num_values - 1) ** self.n_int
+
+    def _num_values(self, a):
+        return min(a + self.max_range, self.max_step) - max(a, -self.max_step) + 1
+
+    def sample(self, rng=random):
+        """
+        Draws one interval sequence; ``rng`` is a ``random.Random`` instance or the ``random`` module.
+        """
+        if not self.num_sequences:
+            raise RuntimeError(
+                "Failed to generate valid interval sequence with the following constraints"
+            )
+        a = self.lowest_notes[bisect_right(self.cum_counts, rng.randrange(self.num_sequences))]
+        if self.reference_mode == "previous_note":
+            return self._sample_walk(-a, rng)
+        return self._sample_first_note(a, rng)
+
+    def _sample_walk(self, start, rng):
+        intervals = []
+        p, hit = start, int(start == 0)
+        for k in range(self.n_int):
+            low, cum = self.steps[k][p][hit]
+            q = low + bisect_right(cum, rng.randrange(cum[-1]))
+            intervals.append(q - p)
+            p, hit = q, int(hit or q == 0)
+        return intervals
+
+    def _sample_first_note(self, a, rng):
+        low = max(a, -self.max_step)
+        num_values = self._num_values(a)
+        if a == 0:
+            return [rng.randint(low, low + num_values - 1) for _ in range(self.n_int)]
+        # the first interval equal to a is at index j, with weight (num_values - 1) ** j * num_values ** (n - 1 - j)
+        n = self.n_int
+        cum = list(accumulate((num_values - 1) ** j * num_values ** (n - 1 - j) for j in range(n)))
+        j = bisect_right(cum, rng.randrange(cum[-1]))
+        return (
+            [rng.randint(a + 1, a + num_values - 1) for _ in range(j)]
+            + [a]
+            + [rng.randint(a, a + num_values - 1) for _ in range(n - 1 - j)]
+        )
+
+
+@functools.lru_cache(maxsize=64)
+def get_discrete_interval_sampler(n_int, max_interval_size, max_melody_pitch_range, reference_mode):
+    """
+    Returns the (cached) ``DiscreteIntervalSampler`` for this parameter set.
+    """
+    return DiscreteIntervalSampler(n_int, max_interval_size, max_melody_pitch_range, reference_mode)
 
 
 def sample_interval(max_interval_size, discrete):
@@ -158,7 +377,7 @@ def is_valid_pitch_range(
 
     """
     if isinstance(reference_pitch, list):
-        reference_pitch = reference_pitch.pop(0)
+        reference_pitch = reference_pitch[0]
     try:
         for pitch in pitches:
             assert abs(reference_pitch - pitch) <= max_pitch_range
@@ -238,7 +457,7 @@ def convert_intervals2reference_to_absolute_pitches(intervals2refernece, referen
     A list of absolute pitch heights
     """
     if isinstance(reference_pitch, list):
-        reference_pitch = reference_pitch.pop(0)
+        reference_pitch = reference_pitch[0]
     pitches = []
     for interval2reference in intervals2refernece:
         pitch = reference_pitch + interval2reference
@@ -300,7 +519,7 @@ def convert_absolute_pitches_to_intervals2reference(pitches, reference_pitch):
     A list of absolute pitch heights
     """
     if isinstance(reference_pitch, list):
-        reference_pitch = reference_pitch.pop(0)
+        reference_pitch = reference_pitch[0]
     intervals2reference = []
     for pitch in pitches:
         interval2reference = pitch - reference_pitch
@@ -308,6 +527,206 @@ def convert_absolute_pitches_to_intervals2reference(pitches, reference_pitch):
     return intervals2reference
 
 
+# Batch versions of the functions above, for many melodies at once: they take 2-D arrays with one melody
+# per row and return the same values as the corresponding functions applied to every row.
+
+def convert_interval_sequences_to_absolute_pitches(intervals, reference_pitches, reference_mode):
+    """
+    Batch version of ``convert_interval_sequence_to_absolute_pitches``.
+
+    Parameters
+    ----------
+
+    intervals:
+        Array of shape ``(n_melodies, n_int)``.
+
+    reference_pitches:
+        One reference pitch for all melodies or an array of shape ``(n_melodies,)``.
+
+    reference_mode:
+        Can be ``"first_note"`` or ``"previous_note"``.
+
+    Returns
+    -------
+
+    An array of shape ``(n_melodies, n_int + 1)``.
+    """
+    intervals = np.asarray(intervals, dtype=float)
+    references = np.broadcast_to(np.asarray(reference_pitches, dtype=float), intervals.shape[:1])[:, None]
+    if reference_mode == "first_note":
+        return np.concatenate([references, intervals + references], axis=1)
+    elif reference_mode == "previous_note":
+        # cumsum adds from left to right, like the loop of the single melody version
+        return np.cumsum(np.concatenate([references, intervals], axis=1), axis=1)
+    else:
+        raise ValueError(f"Unrecognized reference_mode: {reference_mode}.")
+
+
+def convert_absolute_pitches_to_interval_sequences(pitches, reference_mode):
+    """
+    Batch version of ``convert_absolute_pitches_to_interval_sequence``: takes an array of shape
+    ``(n_melodies, n_notes)`` and returns an array of shape ``(n_melodies, n_notes - 1)``.
+    """
+    pitches = np.asarray(pitches, dtype=float)
+    if reference_mode == "first_note":
+        return pitches[:, 1:] - pitches[:, :1]
+    elif reference_mode == "previous_note":
+        return np.diff(pitches, axis=1)
+    else:
+        raise ValueError(f"Invalid reference_mode: '{reference_mode}'")
+
+
+def convert_absolute_pitches_to_intervals2references(pitches, reference_pitches):
+    """
+    Batch version of ``convert_absolute_pitches_to_intervals2reference``: takes an array of shape
+    ``(n_melodies, n_notes)`` and one reference pitch or an array of shape ``(n_melodies,)``.
+    """
+    pitches = np.asarray(pitches, dtype=float)
+    references = np.broadcast_to(np.asarray(reference_pitches, dtype=float), pitches.shape[:1])
+    return pitches - references[:, None]
+
+
+def get_melody_pitch_ranges(intervals, reference_mode):
+    """
+    Batch version of ``get_melody_pitch_range``: takes an array of shape ``(n_melodies, n_int)``.
+    """
+    example_pitches = convert_interval_sequences_to_absolute_pitches(intervals, 60, reference_mode)
+    return example_pitches.max(axis=1) - example_pitches.min(axis=1)
+
+
+def are_valid_interval_sequences(
+        intervals,
+        n_int,
+        max_interval_size,
+        max_melody_pitch_range,
+        reference_mode,
+    ):
+    """
+    Batch version of ``is_valid_interval_sequence``: takes an array of shape ``(n_melodies, n_int)``
+    and returns a boolean array of shape ``(n_melodies,)``.
+    """
+    intervals = np.asarray(intervals, dtype=float)
+    if intervals.shape[1] != n_int:
+        return np.zeros(intervals.shape[0], dtype=bool)
+    return (
+        (np.abs(intervals) <= max_interval_size).all(axis=1)
+        & (get_melody_pitch_ranges(intervals, reference_mode) <= max_melody_pitch_range)
+    )
+
+
+def are_valid_pitch_ranges(reference_pitches, pitches, max_pitch_range):
+    """
+    Batch version of ``is_valid_pitch_range``: takes one reference pitch or an array of shape ``(n_melodies,)``
+    and an array of pitches of shape ``(n_melodies, n_notes)``, and returns a boolean array of shape
+    ``(n_melodies,)``.
+    """
+    pitches = np.asarray(pitches, dtype=float)
+    references = np.broadcast_to(np.asarray(reference_pitches, dtype=float), pitches.shape[:1])
+    return (np.abs(references[:, None] - pitches) <= max_pitch_range).all(axis=1)
+
+
+REGISTER_SHIFTS = dict(high=0, low=-12)  # melodies are defined in the high register
+
+
+class Melody:
+    """
+    A melody held once as an array of absolute pitches, with its other representations (intervals,
+    intervals to a reference, transpositions, pitch range, duration) computed on first use and memoised.
+    Instances are treated as immutable: the representations are returned as tuples and must not be modified.
+    Use ``get_melody`` to share one instance per pitch sequence within a process.
+
+    Parameters
+    ----------
+    pitches:
+        A list of absolute pitches, expressed as MIDI note numbers.
+    """
+    __slots__ = ("array", "pitches", "_memo")
+
+    def __init__(self, pitches):
+        self.array = np.array(pitches)
+        if self.array.ndim != 1 or self.array.dtype.kind not in "iuf":
+            raise ValueError(f"Invalid pitches: {pitches}")
+        self.array.setflags(write=False)
+        self.pitches = tuple(self.array.tolist())
+        self._memo = {}
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def __repr__(self):
+        return f"Melody({list(self.pitches)})"
+
+    def _memoise(self, key, compute):
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = compute()
+            return value
+
+    def intervals(self, reference_mode):
+        """
+        The interval sequence of the melody, see ``convert_absolute_pitches_to_interval_sequence``.
+        """
+        def compute():
+            if reference_mode == "first_note":
+                return tuple((self.array[1:] - self.array[0]).tolist())
+            elif reference_mode == "previous_note":
+                return tuple(np.diff(self.array).tolist())
+            raise ValueError(f"Invalid reference_mode: '{reference_mode}'")
+        return self._memoise(("intervals", reference_mode), compute)
+
+    def intervals2reference(self, reference_pitch):
+        """
+        The intervals of every pitch to ``reference_pitch``, see ``convert_absolute_pitches_to_intervals2reference``.
+        """
+        return self._memoise(
+            ("intervals2reference", reference_pitch),
+            lambda: tuple((self.array - reference_pitch).tolist()),
+        )
+
+    def transpose(self, semitones):
+        """
+        The melody transposed by ``semitones``, as a (memoised) ``Melody``.
+        """
+        if semitones == 0:
+            return self
+        return self._memoise(("transpose", semitones), lambda: Melody(self.array + semitones))
+
+    def in_register(self, register):
+        """
+        The melody in the singing ``register`` (``"high"`` or ``"low"``, one octave lower).
+        """
+        if register not in REGISTER_SHIFTS:
+            raise ValueError(f"Unrecognized register: {register}.")
+        return self.transpose(REGISTER_SHIFTS[register])
+
+    @property
+    def pitch_range(self):
+        return self._memoise("pitch_range", lambda: (self.array.max() - self.array.min()).item() if len(self) else 0)
+
+    def duration(self, note_duration, note_silence=0):
+        """
+        Duration in seconds when every note lasts ``note_duration`` followed by ``note_silence``.
+        """
+        return self._memoise(
+            ("duration", note_duration, note_silence),
+            lambda: len(self) * (note_duration + note_silence),
+        )
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_melody(pitches):
+    return Melody(pitches)
+
+
+def get_melody(pitches):
+    """
+    Returns the shared ``Melody`` for a list of pitches, e.g. the ``target_pitches`` of a node definition,
+    so that node definitions are compiled only once per process.
+    """
+    return _get_melody(tuple(pitches))
+
+
 def as_native_type(x):
     if type(x).__module__ == np.__name__:
         return x.item()
@@ -522,3 +941,22 @@ def freq2midi(f0):
             return 0 # get's weird log2 values otherwise...
         else:
             return exp
+
+
+def midi2freq_array(midi_numbers):
+    """
+    Vectorised ``midi2freq``: converts an array of MIDI note numbers to frequencies (Hz).
+    """
+    return (440 / 32) * (2 ** ((np.asarray(midi_numbers, dtype=float) - 9) / 12))
+
+
+def freq2midi_array(f0):
+    """
+    Vectorised ``freq2midi``: converts an array of frequencies (Hz), e.g. a pitch track, to MIDI note numbers.
+    Like ``freq2midi``, frequencies <= 0 (unvoiced frames) and frequencies below MIDI note 0 give 0,
+    and NaN stays NaN.
+    """
+    f0 = np.asarray(f0, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        midi = 12 * (np.log2(f0) - np.log2(440)) + 69
+    return np.where((f0 <= 0) | (midi < 0), 0.0, midi)
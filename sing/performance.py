@@ -0,0 +1,244 @@
+# running statistics of the singing performance test, kept in a participant variable and updated when the
+# analysis of each trial finishes, so that the end-of-test check does not have to walk the trial analyses
+#
+# The statistics include two streaming histograms (0.25 semitone bins) of the sung pitches: one of all notes,
+# for the median, and one of the median pitch of every trial, for the confidence of the register decision
+# (see ``register_estimate``), which can then be made before the end of the test.
+import math
+from statistics import NormalDist
+
+import numpy as np
+from dallinger import db
+from psynet.participant import Participant
+
+from .variables import set_vars
+
+
+SKETCH_BIN_WIDTH = 0.25  # semitones
+REGISTER_CONFIDENCE = 0.95  # confidence required to settle the register before the end of the test
+MIN_REGISTER_TRIALS = 3
+
+# sequential probability ratio test of the pass/fail decision (see ``sprt_outcome``)
+SPRT = dict(
+    p_fail=0.4,  # success rate of a participant who should fail
+    p_pass=0.85,  # success rate of a participant who should pass
+    alpha=0.05,  # accepted rate of passing a participant with p_fail
+    beta=0.05,  # accepted rate of failing a participant with p_pass
+)
+
+
+def stats_var(trial_maker_id):
+    return f"{trial_maker_id}_stats"
+
+
+def decision_var(trial_maker_id):
+    return f"{trial_maker_id}_decision"
+
+
+def lock_participant(participant_id):
+    """
+    Reloads the participant with a row lock held until the end of the transaction. Variables are stored as one
+    column, so every read-modify-write of them must hold it to keep the statistics committed by the analyses.
+    """
+    return (
+        db.session.query(Participant)
+        .filter_by(id=participant_id)
+        .populate_existing()
+        .with_for_update()
+        .one()
+    )
+
+
+def empty_stats():
+    return {
+        "trial_ids": [],
+        "score": 0,
+        "list_max_abs_interval_error": [],
+        "list_direction_accuracy": [],
+        "sung_pitches": [],
+        "pitch_sketch": {},
+        "trial_sketch": {},
+    }
+
+
+def sketch_add(sketch, value):
+    key = str(math.floor(value / SKETCH_BIN_WIDTH))
+    sketch[key] = sketch.get(key, 0) + 1
+
+
+def sketch_count(sketch):
+    return sum(sketch.values())
+
+
+def sketch_quantile(sketch, q):
+    """
+    The ``q`` quantile of the values counted in ``sketch``, interpolated linearly within the bins.
+    """
+    n = sketch_count(sketch)
+    if n == 0:
+        return None
+    target = q * n
+    cumulative = 0
+    for key in sorted(sketch, key=int):
+        count = sketch[key]
+        if cumulative + count >= target:
+            return (int(key) + (target - cumulative) / count) * SKETCH_BIN_WIDTH
+        cumulative += count
+    return (int(max(sketch, key=int)) + 1) * SKETCH_BIN_WIDTH
+
+
+def sketch_count_below(sketch, value):
+    # number of values in bins entirely below ``value``
+    edge = value / SKETCH_BIN_WIDTH
+    return sum(count for key, count in sketch.items() if int(key) + 1 <= edge)
+
+
+def add_trial(stats, trial_id, analysis):
+    """
+    Adds the analysis of trial ``trial_id`` to ``stats``; a trial that was already added is skipped,
+    so that re-running an analysis does not count it twice.
+    """
+    if trial_id in stats["trial_ids"]:
+        return stats
+    stats["trial_ids"].append(trial_id)
+    stats["list_max_abs_interval_error"].append(analysis["max_abs_interval_error"])
+    stats["list_direction_accuracy"].append(analysis["direction_accuracy"])
+    stats["sung_pitches"].extend(analysis["sung_pitches"])
+    for pitch in analysis["sung_pitches"]:
+        sketch_add(stats.setdefault("pitch_sketch", {}), pitch)
+    if analysis["sung_pitches"]:
+        sketch_add(stats.setdefault("trial_sketch", {}), float(np.median(analysis["sung_pitches"])))
+    if not analysis["failed"]:
+        stats["score"] += 1
+    return stats
+
+
+def stats_from_trials(trials):
+    # the statistics computed from the trials themselves, for participants who started before they were kept
+    stats = empty_stats()
+    for trial in trials:
+        add_trial(stats, trial.id, trial.analysis)
+    return stats
+
+
+def get_stats(participant, trial_maker_id, participant_trials):
+    """
+    The running statistics of ``participant`` in ``trial_maker_id``, or, if they do not cover all
+    ``participant_trials``, the statistics computed from the trials.
+    """
+    stats = participant.var.get(stats_var(trial_maker_id), default=None)
+    if stats is None or len(stats["trial_ids"]) != len(participant_trials):
+        return stats_from_trials(participant_trials)
+    return stats
+
+
+def predict_register(sung_pitches, roving_mean_low, roving_mean_high):
+    """
+    Returns the median sung pitch, its distances to the low and high registers and the closest register
+    (``"low"``, ``"high"`` or ``"undefined"`` if equally close).
+    """
+    median_pitch = np.median(sung_pitches)
+    distance_to_low_register = abs(median_pitch - roving_mean_low)
+    distance_to_high_register = abs(median_pitch - roving_mean_high)
+
+    if distance_to_low_register < distance_to_high_register:
+        predicted_register = "low"
+    elif distance_to_low_register > distance_to_high_register:
+        predicted_register = "high"
+    else:
+        predicted_register = "undefined"
+    return median_pitch, distance_to_low_register, distance_to_high_register, predicted_register
+
+
+def sprt_outcome(score, num_trials, p_fail, p_pass, alpha, beta):
+    """
+    Wald's sequential probability ratio test of ``p_pass`` against ``p_fail`` after ``score`` successful
+    trials out of ``num_trials``.
+
+    Returns
+    -------
+
+    ``("pass" | "fail" | None, log_likelihood_ratio)``, where ``None`` means that the test has to continue.
+    """
+    llr = score * math.log(p_pass / p_fail) + (num_trials - score) * math.log((1 - p_pass) / (1 - p_fail))
+    if llr >= math.log((1 - beta) / alpha):
+        return "pass", llr
+    if llr <= math.log(beta / (1 - alpha)):
+        return "fail", llr
+    return None, llr
+
+
+def binomial_tail(k, n):
+    # P(X >= k) for X ~ Binomial(n, 0.5)
+    return sum(math.comb(n, i) for i in range(k, n + 1)) / 2 ** n
+
+
+def wilson_interval(k, n, confidence):
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    p = k / n
+    center = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+def register_estimate(
+        stats, roving_mean_low, roving_mean_high, confidence=REGISTER_CONFIDENCE, min_trials=MIN_REGISTER_TRIALS
+):
+    """
+    Estimates the singing register from the running statistics, after any number of trials.
+
+    Every analysed trial votes for the register closest to the median of its sung pitches.
+    ``register_confidence`` is one minus the p-value of the majority under a coin flip (sign test), and
+    ``register_interval`` the Wilson interval of the share of trials closer to the high register.
+    The register is ``settled`` once ``register_confidence`` reaches ``confidence`` after at least
+    ``min_trials`` trials.
+
+    Returns
+    -------
+
+    A dictionary with ``median_pitch`` (from the note sketch, ``None`` before any note), ``predicted_register``,
+    ``register_confidence``, ``register_interval``, ``register_trials`` and ``register_settled``.
+    """
+    midpoint = (roving_mean_low + roving_mean_high) / 2
+    trial_sketch = stats.get("trial_sketch", {})
+    n = sketch_count(trial_sketch)
+    n_low = sketch_count_below(trial_sketch, midpoint)
+    n_high = n - n_low
+    median_pitch = sketch_quantile(stats.get("pitch_sketch", {}), 0.5)
+
+    if n_low > n_high:
+        predicted_register = "low"
+    elif n_high > n_low:
+        predicted_register = "high"
+    else:
+        predicted_register = "undefined"
+    register_confidence = 1 - binomial_tail(max(n_low, n_high), n) if n else 0.0
+    return {
+        "median_pitch": median_pitch,
+        "predicted_register": predicted_register,
+        "register_confidence": register_confidence,
+        "register_interval": [round(x, 4) for x in wilson_interval(n_high, n, confidence)],
+        "register_trials": n,
+        "register_settled": n >= min_trials and predicted_register != "undefined" and register_confidence >= confidence,
+    }
+
+
+class PerformanceStatsTrial:
+    """
+    Mixin for the ``AudioRecordTrial`` of the singing performance test: once the recording is analysed,
+    adds the analysis to the running statistics of the participant (see ``add_trial``).
+    The participant row is locked while it is updated, as the trials of one participant can be
+    analysed in parallel.
+    """
+    track_performance_stats = True
+
+    def async_post_trial(self):
+        super().async_post_trial()
+        if not self.track_performance_stats:
+            return
+        participant = lock_participant(self.participant_id)
+        name = stats_var(self.trial_maker_id)
+        stats = participant.var.get(name, default=None) or empty_stats()
+        set_vars(participant, **{name: add_trial(stats, self.id, self.analysis)})
@@ -0,0 +1,197 @@
+# deferred rendering of analysis plots: analyses only store what is needed to draw the plot later
+import os
+import shutil
+import tempfile
+import threading
+
+from psynet.utils import get_logger
+
+from . import analysis
+
+logger = get_logger()
+
+PLOT_FOLDER = os.path.join("analysis_cache", "plots")
+PLOT_MAX_BYTES = 512 * 1024 ** 2
+
+
+class PlotStore:
+    """
+    Folder of rendered plots, named by the content hash of the analysis they show.
+    Plots are evicted least-recently-used (by modification time, refreshed on every access)
+    once the folder exceeds ``max_bytes``.
+
+    Parameters
+    ----------
+
+    folder : str
+        Where to keep the plots; created if needed.
+
+    max_bytes : int
+        Maximum total size of the stored plots.
+    """
+
+    def __init__(self, folder: str = PLOT_FOLDER, max_bytes: int = PLOT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key: str):
+        return os.path.join(self.folder, key.replace(":", "_") + ".png")
+
+    def get(self, key: str):
+        """
+        Returns the path of the stored plot, or ``None`` if it has not been rendered yet.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, plot_file: str):
+        path = self.path(key)
+        tmp_path = path + ".tmp"
+        shutil.copyfile(plot_file, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".png"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = PlotStore()
+    return _store
+
+
+def plot_spec(audio_file, config, target_pitches=None):
+    """
+    What an analysis stores instead of a plot: the content key of the analysis (audio, parameters and
+    target pitches) and the target pitches. Together with the stored recording and the trial's analysis
+    parameters, this is all ``request_plot`` needs.
+    """
+    return {
+        "deferred": True,
+        "key": analysis.cache_key(audio_file, config, target_pitches),
+        "target_pitches": target_pitches,
+    }
+
+
+_renders = {}  # plot key -> future of the render started by request_plot in this process
+_renders_lock = threading.Lock()
+
+
+def request_plot(export_recording, config, spec, store: PlotStore = None):
+    """
+    Returns the path of the plot described by ``spec`` (see ``plot_spec``) if it is in the store. Otherwise
+    starts rendering it with ``sing.analyze`` on the analysis engine, from the recording that
+    ``export_recording(path)`` writes, and returns ``None``; the plot is added to the store once rendered.
+    The caller does not wait for the render, and a plot is rendered once at a time per process.
+    Raises ``analysis.AnalysisQueueFull`` if the engine has no free slot.
+    """
+    store = get_store() if store is None else store
+    key = spec["key"]
+    path = store.get(key)
+    if path is not None:
+        return path
+
+    with _renders_lock:
+        if key in _renders:
+            return None
+        folder = tempfile.mkdtemp()
+        try:
+            audio_file = os.path.join(folder, "recording.wav")
+            output_plot = os.path.join(folder, "plot.png")
+            export_recording(audio_file)
+            engine = analysis.get_engine()
+            future = engine.submit(
+                analysis.extract_notes,
+                audio_file,
+                config,
+                target_pitches=spec["target_pitches"],
+                output_plot=output_plot,
+                save_plot=True,
+                timeout=0,
+            )
+        except BaseException:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        _renders[key] = future
+
+    def store_plot(future):
+        try:
+            future.result()
+            store.put(key, output_plot)
+        except Exception:
+            logger.exception("Could not render the plot %s.", key)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            with _renders_lock:
+                _renders.pop(key, None)
+
+    future.add_done_callback(store_plot)
+    # an engine without workers has already rendered it
+    return store.get(key)
+
+
+class OptionalPlotTrial:
+    """
+    Mixin for recording trials whose analysis does not always render a plot: an empty plot file is deleted
+    instead of being uploaded as the analysis plot of the trial.
+
+    The analysis must not set ``"no_plot_generated"`` for this: with psynet 11.5, ``async_post_trial`` then
+    calls ``os.path.remove``, which does not exist, before the trial can be failed.
+    """
+
+    def upload_plot(self, local_path, async_):
+        if os.path.getsize(local_path) == 0:
+            os.remove(local_path)
+            return
+        super().upload_plot(local_path, async_)
+
+
+class DeferredPlotTrial(OptionalPlotTrial):
+    """
+    Mixin for recording trials whose analysis stores a ``plot_spec`` under ``"plot"``
+    instead of rendering the plot. ``analysis_config`` must hold the analysis parameters of the trial.
+    """
+    analysis_config = None
+
+    @property
+    def deferred_plot(self):
+        """
+        The ``plot_spec`` stored by the analysis of this trial, or ``None`` if its plot was not deferred.
+        """
+        spec = (self.analysis or {}).get("plot")
+        return spec if spec and spec.get("deferred") else None
+
+    def request_plot(self):
+        """
+        Returns the path of the plot for this trial's recording, or ``None`` while it is being rendered
+        (see ``request_plot``).
+        """
+        return request_plot(self.recording.export, self.analysis_config, self.deferred_plot)
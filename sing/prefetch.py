@@ -0,0 +1,90 @@
+# browser-side helpers for the listen/sing page pair: prefetching the stimulus audio of the next trial while
+# the participant is recording, and measuring the gap between two trials
+#
+# PsyNet only generates the next page once the current answer is submitted, so the page itself cannot be
+# prefetched; what can be loaded ahead is the audio it will play. The gap is measured from the moment the last
+# page of a trial is left (the singing page, or the feedback page of trials with feedback, see ``mark_trial_end``)
+# to the start of the next listening page (psynet's "trialStart", which waits for its media) and stored in the
+# metadata of the listening page response. It is only stored if the listening page directly follows the end of
+# the trial: psynet reloads the page after each response, so any other page in between (instructions, wait
+# pages) makes the trial end older than the navigation to the listening page.
+import json
+
+from markupsafe import Markup
+
+TRIAL_END_KEY = "sing.trial_end"  # sessionStorage key holding the time the last page of a trial was left
+NAVIGATION_TOLERANCE = 1000  # ms the trial end may precede the navigation to the next listening page
+
+
+def trial_end_marker():
+    # remembers when the page is left (the page's script, without <script> tags)
+    return Markup(
+        f"""
+        window.addEventListener("pagehide", function () {{
+            sessionStorage.setItem({json.dumps(TRIAL_END_KEY)}, Date.now());
+        }});
+        """
+    )
+
+
+def mark_trial_end(page):
+    """
+    Makes ``page``, shown between the singing page and the next trial (e.g. a feedback page), the end of the
+    trial for the gap measured on the next listening page.
+    """
+    page.scripts.append(trial_end_marker())
+    return page
+
+
+def trial_end_script(prefetch_urls=()):
+    """
+    Script for the singing page: remembers when the page is left and, once the recording has started,
+    prefetches ``prefetch_urls`` (the stimulus audio of the likely next trials) into the browser cache.
+    """
+    return Markup(
+        f"""
+        <script>
+        {trial_end_marker()}
+        psynet.trial.onEvent("recordStart", function () {{
+            {json.dumps(list(prefetch_urls))}.forEach(function (url) {{
+                let link = document.createElement("link");
+                link.rel = "prefetch";
+                link.as = "audio";
+                link.href = url;
+                document.head.appendChild(link);
+            }});
+        }});
+        </script>
+        """
+    )
+
+
+def trial_gap_script(audio_url=None):
+    """
+    Script for the listening page: stores the gap since the previous singing page (``inter_trial_gap``, s),
+    the server and page load times of this page and, for pre-rendered stimuli (``audio_url``), whether their
+    audio came from the browser cache (``audio_cached``) in the response metadata. Nothing is stored for
+    the first trial, nor if other pages were shown since the end of the previous trial.
+    """
+    return Markup(
+        f"""
+        <script>
+        psynet.trial.onEvent("trialStart", function () {{
+            let trialEnd = sessionStorage.getItem({json.dumps(TRIAL_END_KEY)});
+            sessionStorage.removeItem({json.dumps(TRIAL_END_KEY)});
+            if (trialEnd === null || Number(trialEnd) < performance.timeOrigin - {NAVIGATION_TOLERANCE}) {{
+                return;
+            }}
+            let navigation = performance.getEntriesByType("navigation")[0];
+            let audioUrl = {json.dumps(audio_url)};
+            let audio = audioUrl ? performance.getEntriesByName(new URL(audioUrl, location.href).href)[0] : undefined;
+            Object.assign(psynet.response.staged.metadata, {{
+                inter_trial_gap: (Date.now() - Number(trialEnd)) / 1000,
+                server_time: navigation ? (navigation.responseStart - navigation.requestStart) / 1000 : null,
+                page_load_time: navigation ? navigation.domContentLoadedEventEnd / 1000 : null,
+                audio_cached: audio ? audio.transferSize === 0 : null,
+            }});
+        }});
+        </script>
+        """
+    )
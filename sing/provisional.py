@@ -0,0 +1,155 @@
+# provisional note counts computed in the browser from the recording, shown while the server analysis runs
+#
+# The count follows sing/onsets.py (bandpass, smoothed and compressed envelope, dB threshold, gap bridging,
+# minimum duration), with Web Audio biquad filters instead of the zero-phase Butterworth filter. It is sent
+# with the response (``provisional_num_sung_pitches``) and compared with the server count in ``compare``.
+import json
+
+from markupsafe import Markup
+from psynet.utils import get_logger
+
+from .onsets import MIN_PEAK_DB
+from .variables import set_vars
+
+logger = get_logger()
+
+CONFIG_KEYS = [
+    "singing_bandpass_range",
+    "smoothing_env_window_ms",
+    "compresssion_power",
+    "db_threshold",
+    "msec_silence",
+    "minimal_segment_duration",
+    "silence_beginning_ms",
+]
+
+
+def note_count_script(config, num_target_pitches):
+    """
+    HTML for the recording page: once the recording ends, counts its notes in the browser and shows the
+    count in the page as provisional feedback, before the participant moves on to the server feedback.
+    """
+    settings = {key: config[key] for key in CONFIG_KEYS}
+    settings["min_peak_db"] = MIN_PEAK_DB
+    return Markup(
+        f"""
+        <div id="provisional-feedback" style="min-height: 1.5em;"></div>
+        <script>
+        (function () {{
+            const config = {json.dumps(settings)};
+            const numTargetPitches = {int(num_target_pitches)};
+
+            async function bandpass(decoded) {{
+                const context = new OfflineAudioContext(1, decoded.length, decoded.sampleRate);
+                const source = context.createBufferSource();
+                source.buffer = decoded;
+                let node = source;
+                const [low, high] = config.singing_bandpass_range;
+                for (const [type, frequency] of [
+                    ["highpass", low], ["highpass", low],
+                    ["lowpass", Math.min(high, 0.45 * decoded.sampleRate)],
+                    ["lowpass", Math.min(high, 0.45 * decoded.sampleRate)],
+                ]) {{
+                    const filter = context.createBiquadFilter();
+                    filter.type = type;
+                    filter.frequency.value = frequency;
+                    filter.Q.value = Math.SQRT1_2;
+                    node.connect(filter);
+                    node = filter;
+                }}
+                node.connect(context.destination);
+                source.start();
+                return (await context.startRendering()).getChannelData(0);
+            }}
+
+            function countSegments(samples, sampleRate) {{
+                const n = samples.length;
+                const window = Math.max(Math.round(config.smoothing_env_window_ms / 1000 * sampleRate), 1);
+                const cumulative = new Float64Array(n + 1);
+                for (let i = 0; i < n; i++) {{
+                    cumulative[i + 1] = cumulative[i] + Math.abs(samples[i]);
+                }}
+                const envelope = new Float64Array(n);
+                let peak = 0;
+                for (let i = 0; i < n; i++) {{
+                    const start = Math.max(i - Math.floor((window - 1) / 2), 0);
+                    const end = Math.min(start + window, n);
+                    envelope[i] = Math.pow((cumulative[end] - cumulative[start]) / window, config.compresssion_power);
+                    peak = Math.max(peak, envelope[i]);
+                }}
+                if (peak <= 0 || 20 / config.compresssion_power * Math.log10(peak) < config.min_peak_db) {{
+                    return 0;
+                }}
+                const threshold = peak * Math.pow(10, config.db_threshold * config.compresssion_power / 20);
+                const skip = Math.floor(config.silence_beginning_ms / 1000 * sampleRate);
+                const minGap = config.msec_silence / 1000 * sampleRate;
+                const minDuration = config.minimal_segment_duration / 1000 * sampleRate;
+
+                let segments = [];
+                let onset = null;
+                for (let i = skip; i <= n; i++) {{
+                    const active = i < n && envelope[i] > threshold;
+                    if (active && onset === null) {{
+                        onset = i;
+                    }} else if (!active && onset !== null) {{
+                        const last = segments[segments.length - 1];
+                        if (last && onset - last[1] < minGap) {{
+                            last[1] = i;
+                        }} else {{
+                            segments.push([onset, i]);
+                        }}
+                        onset = null;
+                    }}
+                }}
+                return segments.filter(([start, end]) => end - start >= minDuration).length;
+            }}
+
+            async function showCount(blob) {{
+                const start = performance.now();
+                try {{
+                    const context = new OfflineAudioContext(1, 1, 44100);
+                    const decoded = await context.decodeAudioData(await blob.arrayBuffer());
+                    const count = countSegments(await bandpass(decoded), decoded.sampleRate);
+                    Object.assign(psynet.response.staged.metadata, {{
+                        provisional_num_sung_pitches: count,
+                        provisional_time: (performance.now() - start) / 1000,
+                    }});
+                    document.getElementById("provisional-feedback").innerHTML = (
+                        count === numTargetPitches
+                            ? `<b>We detected ${{count}} notes in your recording.</b>`
+                            : `We detected ${{count}} notes in your recording, but we asked you to sing ${{numTargetPitches}}.`
+                    ) + " <i>(provisional, the final check follows)</i>";
+                }} catch (error) {{
+                    psynet.log.error(error.stack);
+                }}
+            }}
+
+            // recordEnd handlers run one after the other by decreasing priority: this one runs after the recorder
+            // has staged the recording, and does not hold up the following ones while the count is computed
+            psynet.trial.onEvent("recordEnd", function () {{
+                const blob = psynet.response.staged.blobs["audioRecording"];
+                if (blob) {{
+                    showCount(blob);
+                }}
+            }}, {{priority: -40}});
+        }})();
+        </script>
+        """
+    )
+
+
+def compare(trial, num_sung_pitches):
+    """
+    Stores the provisional count sent with the response of ``trial`` next to the server count
+    ``num_sung_pitches`` (trial variables ``provisional_num_sung_pitches`` and ``provisional_agrees``).
+    """
+    metadata = (trial.response.metadata if trial.response is not None else None) or {}
+    provisional = metadata.get("provisional_num_sung_pitches")
+    if provisional is None:
+        return
+    agrees = provisional == num_sung_pitches
+    set_vars(trial, provisional_num_sung_pitches=provisional, provisional_agrees=agrees)
+    logger.info(
+        "Provisional note count of trial %i: %i (server: %i, %s).",
+        trial.id, provisional, num_sung_pitches, "agree" if agrees else "disagree",
+    )
@@ -0,0 +1,305 @@
+# push notifications for the wait pages of the experiment (recording uploads and analyses to wait for)
+#
+# When an asset of a participant is deposited or the asynchronous analysis of one of their trials finishes,
+# a message for the participant is published on a redis channel once the transaction is committed.
+# Dallinger relays redis channels to the browser over its /chat websocket, so a ``NotifiedWaitPage`` can
+# continue as soon as a message for its participant arrives instead of at the end of its wait time. The wait
+# time (psynet's own polling interval) is kept as the fallback (websocket unavailable, message lost); a message
+# published before the page subscribed is caught up from the last message of the participant, kept in redis
+# (see the /sing_ready route of experiment.py).
+#
+# All participants share one channel: Dallinger keeps a listener per channel name in every process for the
+# life of the process. Every page subscribed to it therefore receives every message, so the messages only hold
+# an opaque token of the participant (random, kept in redis), which each page gets from the /sing_ready route
+# with the last message, and no participant, trial or asset ids. Any websocket client can publish on the
+# channel, so a message only makes the page submit early: psynet checks the condition of the wait again and
+# shows the wait page again if it is not met yet. The page is credited the time it actually waited.
+#
+# Metrics are stored in the response metadata: ``readiness_transport`` ("websocket", "catch_up" or "poll"),
+# ``readiness_delivery`` (s from publication to reception, subject to the clock offset of the participant)
+# and ``readiness_waited`` (s on the wait page) for the wait page, and ``notify_to_render`` (s from the
+# notification to the start of the next page) for the page shown afterwards (see ``with_render_metric``).
+import json
+import time
+import uuid
+
+from dallinger import db
+from markupsafe import Markup
+from psynet.asset import Asset
+from psynet.page import WaitPage, wait_while
+from psynet.timeline import PageMaker
+from psynet.trial.main import Trial
+from psynet.utils import NoArgumentProvided, get_logger
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = get_logger()
+
+CHANNEL = "sing_ready"  # no ":" allowed, dallinger relays messages as "<channel>:<data>"
+LAST_MESSAGE_TTL = 3600  # s
+TOKEN_TTL = 24 * 3600  # s
+NOTIFIED_KEY = "sing.readiness_notified"  # sessionStorage key holding the time of the last notification
+CONSUMED_KEY = "sing.readiness_consumed"  # sessionStorage key holding the id of the last message acted upon
+
+
+def last_message_key(participant_id):
+    return f"{CHANNEL}.last.{participant_id}"
+
+
+def token_key(participant_id):
+    return f"{CHANNEL}.token.{participant_id}"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def participant_token(participant_id):
+    """
+    The opaque token identifying the messages of the participant on the shared channel (created on first use).
+    """
+    db.redis_conn.set(token_key(participant_id), uuid.uuid4().hex, nx=True, ex=TOKEN_TTL)
+    return _decode(db.redis_conn.get(token_key(participant_id)))
+
+
+def notify(participant_id, event_name):
+    """
+    Publishes ``event_name`` for the participant once the current transaction is committed
+    (nothing is published if it is rolled back).
+    """
+    message = {"id": uuid.uuid4().hex, "event": event_name, "sent": time.time()}
+    db.session.info.setdefault("sing_ready", []).append((participant_id, message))
+
+
+def last_message(participant_id):
+    """
+    The last message published for the participant (a JSON string), or ``None``.
+    """
+    return _decode(db.redis_conn.get(last_message_key(participant_id)))
+
+
+def catch_up(participant_id):
+    """
+    What the wait pages of the participant fetch from the /sing_ready route when they subscribe: the token of
+    the participant and their last message (``None`` if there is none), as a JSON string.
+    """
+    message = last_message(participant_id)
+    return json.dumps(
+        {"token": participant_token(participant_id), "message": None if message is None else json.loads(message)}
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _publish(session):
+    for participant_id, message in session.info.pop("sing_ready", []):
+        try:
+            message = json.dumps({**message, "token": participant_token(participant_id)})
+            db.redis_conn.set(last_message_key(participant_id), message, ex=LAST_MESSAGE_TTL)
+            db.redis_conn.publish(CHANNEL, message)
+        except Exception:
+            # the wait pages fall back to polling
+            logger.exception("Could not publish the readiness notification of participant %s.", participant_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard(session, previous_transaction):
+    session.info.pop("sing_ready", None)
+
+
+@event.listens_for(Asset.deposited, "set", propagate=True)
+def _asset_deposited(target, value, oldvalue, initiator):
+    if value and oldvalue is not True and target.participant_id is not None:
+        notify(target.participant_id, "deposited")
+
+
+@event.listens_for(Trial.async_post_trial_complete, "set", propagate=True)
+@event.listens_for(Trial.async_post_trial_failed, "set", propagate=True)
+def _analysis_stored(target, value, oldvalue, initiator):
+    if value and oldvalue is not True and target.participant_id is not None:
+        notify(target.participant_id, "analysis")
+
+
+class NotifiedWaitPage(WaitPage):
+    """
+    A ``WaitPage`` that continues as soon as a notification for the participant arrives,
+    or after ``wait_time`` otherwise. The participant is credited the time actually waited
+    (``readiness_waited``, at most ``wait_time``) rather than the full ``wait_time``.
+    """
+
+    def __init__(self, wait_time: float, content=None, **kwargs):
+        super().__init__(wait_time=wait_time, content=content, scripts=[notified_wait_script(wait_time)], **kwargs)
+
+    def credited_time(self, metadata):
+        # the time reported by the page (the whole wait time without it, e.g. for bots)
+        try:
+            waited = float(metadata["readiness_waited"])
+        except (KeyError, TypeError, ValueError):
+            return self.wait_time
+        return min(max(waited, 0.0), self.wait_time)
+
+    def process_response(
+        self, raw_answer, blobs, metadata, experiment, participant, client_ip_address, answer=NoArgumentProvided
+    ):
+        response = super().process_response(
+            raw_answer=raw_answer,
+            blobs=blobs,
+            metadata=metadata,
+            experiment=experiment,
+            participant=participant,
+            client_ip_address=client_ip_address,
+            answer=answer,
+        )
+        participant.total_wait_page_time += self.credited_time(metadata or {})
+        return response
+
+    def on_complete(self, experiment, participant):
+        # skips WaitPage.on_complete, which credits the whole wait time (see process_response)
+        super(WaitPage, self).on_complete(experiment, participant)
+
+
+def notified_wait_script(wait_time):
+    # the poll fallback fires shortly before the timer of the WaitPage template, so that it can add the metadata
+    return Markup(
+        f"""
+        psynet.trial.onEvent("trialStart", function () {{
+            const start = Date.now();
+            let done = false;
+            let token = null;
+            const received = [];  // messages received before the token is known
+
+            function proceed(transport, message) {{
+                if (done) {{
+                    return;
+                }}
+                done = true;
+                const metadata = {{
+                    readiness_transport: transport,
+                    readiness_waited: (Date.now() - start) / 1000,
+                }};
+                if (message) {{
+                    sessionStorage.setItem({json.dumps(CONSUMED_KEY)}, message.id);
+                    sessionStorage.setItem({json.dumps(NOTIFIED_KEY)}, Date.now());
+                    metadata.readiness_event = message.event;
+                    metadata.readiness_delivery = Date.now() / 1000 - message.sent;
+                }}
+                psynet.nextPage(undefined, metadata);
+            }}
+
+            function isNew(message) {{
+                return (
+                    message !== null && typeof message === "object"
+                    && token !== null && message.token === token
+                    && message.id !== sessionStorage.getItem({json.dumps(CONSUMED_KEY)})
+                );
+            }}
+
+            function parse(data) {{
+                try {{
+                    return JSON.parse(data);
+                }} catch (error) {{
+                    return null;
+                }}
+            }}
+
+            setTimeout(function () {{ proceed("poll", null); }}, Math.max(1000 * {float(wait_time)} - 250, 0));
+
+            try {{
+                const socket = new WebSocket(
+                    (location.protocol === "https:" ? "wss://" : "ws://") + location.host
+                    + "/chat?channel={CHANNEL}&participant_id=" + psynet.participantId
+                );
+                socket.onmessage = function (event) {{
+                    const message = parse(String(event.data).slice(String(event.data).indexOf(":") + 1));
+                    if (token === null) {{
+                        received.push(message);
+                    }} else if (isNew(message)) {{
+                        socket.close();
+                        proceed("websocket", message);
+                    }}
+                }};
+                socket.onopen = async function () {{
+                    // the token of the participant and a message published before the subscription
+                    const response = await fetch(
+                        "/sing_ready/" + psynet.participantId + "?unique_id=" + encodeURIComponent(psynet.uniqueId)
+                    );
+                    const catchUp = response.ok ? parse(await response.text()) : null;
+                    if (catchUp === null || typeof catchUp !== "object") {{
+                        return;
+                    }}
+                    token = catchUp.token;
+                    if (isNew(catchUp.message)) {{
+                        socket.close();
+                        proceed("catch_up", catchUp.message);
+                        return;
+                    }}
+                    const message = received.find(isNew);
+                    if (message !== undefined) {{
+                        socket.close();
+                        proceed("websocket", message);
+                    }}
+                }};
+            }} catch (error) {{
+                psynet.log.error(error.stack);
+            }}
+        }});
+        """
+    )
+
+
+def render_metric_script():
+    return Markup(
+        f"""
+        psynet.trial.onEvent("trialStart", function () {{
+            const notified = sessionStorage.getItem({json.dumps(NOTIFIED_KEY)});
+            sessionStorage.removeItem({json.dumps(NOTIFIED_KEY)});
+            if (notified !== null) {{
+                psynet.response.staged.metadata.notify_to_render = (Date.now() - Number(notified)) / 1000;
+            }}
+        }});
+        """
+    )
+
+
+def with_render_metric(page):
+    """
+    Adds ``notify_to_render`` to the metadata of ``page``, the page shown after a ``NotifiedWaitPage``.
+    """
+    page.scripts.append(render_metric_script())
+    return page
+
+
+def wait_until_deposited(asset_key, expected_wait, log_message=None):
+    """
+    ``wait_while`` for the participant asset ``asset_key`` to be deposited, with a ``NotifiedWaitPage``.
+    """
+    return wait_while(
+        lambda participant: not participant.assets[asset_key].deposited,
+        expected_wait=expected_wait,
+        wait_page=NotifiedWaitPage,
+        log_message=log_message,
+    )
+
+
+class NotifiedFeedbackTrial:
+    """
+    Mixin for trials with ``wait_for_feedback``: the wait page before the feedback page is a ``NotifiedWaitPage``,
+    which continues as soon as the recording is deposited or analysed. The rest of the feedback logic is psynet's,
+    which is used unchanged if it does not contain exactly one ``WaitPage`` and one ``PageMaker``.
+    """
+
+    @classmethod
+    def _construct_feedback_logic(cls, trial_maker):
+        logic = super()._construct_feedback_logic(trial_maker)
+        wait_pages = [i for i, elt in enumerate(logic) if type(elt) is WaitPage]
+        page_makers = [elt for elt in logic if isinstance(elt, PageMaker)]
+        if len(wait_pages) != 1 or len(page_makers) != 1:
+            logger.warning("Unexpected feedback logic in psynet, the wait page of %s is not notified.", cls.__name__)
+            return logic
+
+        i = wait_pages[0]
+        logic[i] = NotifiedWaitPage(wait_time=logic[i].wait_time)
+        show_feedback = page_makers[0].function
+        page_makers[0].function = lambda experiment, participant: with_render_metric(
+            show_feedback(experiment=experiment, participant=participant)
+        )
+        return logic
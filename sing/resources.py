@@ -3,7 +3,6 @@ import os
 import shutil
 import jsonpickle
 import json
-import numpy as np
 from statistics import mean
 from flask import Markup
 from psynet.page import InfoPage
@@ -38,7 +37,11 @@ from psynet.js_synth import JSSynth, Note
 from psynet.js_synth import InstrumentTimbre, HarmonicTimbre
 # sing4me
 from . import params
+from . import performance
+from . import variables
 from . import melodies
+from . import onsets
+from . import plots
 from sing4me import singing_extract as sing
 config = params.singing_1interval  # 1 interval
 logger = get_logger()
@@ -292,10 +295,11 @@ stimulus_set_silence = StimulusSet(
 )
 
 
-class SingingRecordingTrial(AudioRecordTrial, StaticTrial):
+class SingingRecordingTrial(plots.OptionalPlotTrial, AudioRecordTrial, StaticTrial):
     __mapper_args__ = {"polymorphic_identity": "singing_recording_trial"}
 
     time_estimate = 8
+    analysis_mode = "full"  # "note_count" only counts the notes from the energy envelope (see sing/onsets.py)
 
     def show_trial(self, experiment, participant):
         return ModularPage(
@@ -327,19 +331,19 @@ class SingingRecordingTrial(AudioRecordTrial, StaticTrial):
         )
 
     def analyze_recording(self, audio_file: str, output_plot: str):
-        raw = sing.analyze(
-            audio_file,
-            config,
-            plot_options=sing.PlotOptions(
-                save=True, path=output_plot, format="png"
-            ),
-        )
-        raw = [
-            {key: melodies.as_native_type(value) for key, value in x.items()} for x in raw
-        ]
-        sung_pitches = [x["median_f0"] for x in raw]
+        if self.analysis_mode == "note_count":
+            num_sung_pitches = onsets.count_notes(audio_file, config)["num_sung_pitches"]
+        else:
+            raw = sing.analyze(
+                audio_file,
+                config,
+                plot_options=sing.PlotOptions(
+                    save=True, path=output_plot, format="png"
+                ),
+            )
+            num_sung_pitches = len(raw)
 
-        if len(sung_pitches) >= self.definition["min_num_notes_to_detect"]:
+        if num_sung_pitches >= self.definition["min_num_notes_to_detect"]:
             correct_num_notes = True
             failed = False
         else:
@@ -349,7 +353,8 @@ class SingingRecordingTrial(AudioRecordTrial, StaticTrial):
         return {
             "failed": failed,
             "correct_num_notes": correct_num_notes,
-            "num_sung_pitches": len(sung_pitches),
+            "num_sung_pitches": num_sung_pitches,
+            "analysis_mode": self.analysis_mode,
         }
 
 
@@ -624,7 +629,7 @@ class SingingRecordingTest(Module):
 
 
 # singing performance test
-class SingingPerformanceTrial(AudioRecordTrial, StaticTrial):
+class SingingPerformanceTrial(performance.PerformanceStatsTrial, AudioRecordTrial, StaticTrial):
     __mapper_args__ = {"polymorphic_identity": "singing_performance_trial"}
 
     time_estimate = 8
@@ -750,6 +755,8 @@ class SingingPerformanceTrial(AudioRecordTrial, StaticTrial):
 class SingingPerformanceFeedback(SingingPerformanceTrial):
     __mapper_args__ = {"polymorphic_identity": "singing_performance_feedback"}
 
+    track_performance_stats = False
+
     wait_for_feedback = True
 
     def gives_feedback(self, experiment, participant):
@@ -1064,43 +1071,28 @@ class SingingPerformanceTest(Module):
 
             def performance_check(self, experiment, participant, participant_trials):
                 """Should return a tuple (score: float, passed: bool)"""
-                score = 0
-                # list_max_abs_pitch_diff = []
-                list_max_abs_interval_error = []
-                list_direction_accuracy = []
-                list_sung_pitches = []
-
-                for trial in participant_trials:
-                    # list_max_abs_pitch_diff.append(trial.analysis["max_abs_pitch_error"])
-                    list_max_abs_interval_error.append(trial.analysis["max_abs_interval_error"])
-                    list_direction_accuracy.append(trial.analysis["direction_accuracy"])
-                    list_sung_pitches.append(trial.analysis["sung_pitches"])
-                    if trial.analysis["failed"] == False:
-                        score += 1
+                # running statistics updated as each analysis finished (see sing/performance.py)
+                participant = performance.lock_participant(participant.id)
+                stats = performance.get_stats(participant, self.id, participant_trials)
+                score = stats["score"]
                 passed = score >= performance_threshold
 
-                # store variables in particaipnts table
-                participant.var.set("singing_performance", score)
-                participant.var.set("list_max_abs_interval_error", list_max_abs_interval_error)
-                participant.var.set("list_direction_accuracy", list_direction_accuracy)
-
                 # determine register
-                flat_list_sung_pitches = [x for xs in list_sung_pitches for x in xs]
-                median_pitch = np.median(flat_list_sung_pitches)
-                distance_to_low_register = abs(median_pitch - roving_mean_low)
-                distance_to_high_register = abs(median_pitch - roving_mean_high)
-
-                if distance_to_low_register < distance_to_high_register:
-                    predicted_register = "low"
-                elif distance_to_low_register > distance_to_high_register:
-                    predicted_register = "high"
-                else:
-                    predicted_register = "undefined"
-
-                participant.var.set("sung_median_pitch", median_pitch)
-                participant.var.set("distance_to_low_register", distance_to_low_register)
-                participant.var.set("distance_to_high_register", distance_to_high_register)
-                participant.var.set("predicted_register", predicted_register)
+                median_pitch, distance_to_low_register, distance_to_high_register, predicted_register = (
+                    performance.predict_register(stats["sung_pitches"], roving_mean_low, roving_mean_high)
+                )
+
+                # store variables in particaipnts table, in one update (see sing/variables.py)
+                variables.set_vars(
+                    participant,
+                    singing_performance=score,
+                    list_max_abs_interval_error=stats["list_max_abs_interval_error"],
+                    list_direction_accuracy=stats["list_direction_accuracy"],
+                    sung_median_pitch=median_pitch,
+                    distance_to_low_register=distance_to_low_register,
+                    distance_to_high_register=distance_to_high_register,
+                    predicted_register=predicted_register,
+                )
 
                 
                 return {"score": score, "passed": passed}
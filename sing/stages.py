@@ -0,0 +1,47 @@
+# timings of the stages of sing.analyze, measured on a local re-implementation of them
+#
+# sing.analyze loads the recording, bandpass-filters it, tracks its pitch with Praat and segments it into notes
+# in a single call, so the timer of the analysis only sees it as "extract". ``time_stages`` runs the same steps
+# with the same settings (audio loading, the bandpass and segmentation of sing/onsets.py, Praat's
+# autocorrelation pitch tracking via parselmouth) and records each of them as a stage of the current timer,
+# which gives the breakdown of "extract" in timing_report.py. The re-implementation is not the analysis itself:
+# its timings show how the cost splits between the stages, and they add to the total time of the analysis.
+# It only runs when analyses are profiled (``profile_stages`` of sing/analysis.py).
+from . import timing
+from .audio import read_wav, to_mono
+from .melodies import midi2freq
+from .onsets import MIN_PEAK_DB, bandpass, detect_segments, filtered_envelope_db
+
+STAGES = ["profile_audio_load", "profile_bandpass", "profile_praat_pitch", "profile_segmentation"]
+
+
+def time_stages(audio_file, config):
+    """
+    Runs the stages of ``sing.analyze`` (see the top of this module) on ``audio_file`` with the sing4me ``config``,
+    recording them as the ``STAGES`` of the current ``timing.collect`` timer, if any.
+
+    Returns
+    -------
+
+    The number of segments found, which only serves as a check that the stages ran on the recording.
+    """
+    import parselmouth
+
+    with timing.stage("profile_audio_load"):
+        sample_rate, samples = read_wav(audio_file)
+        samples = to_mono(samples)
+    with timing.stage("profile_bandpass"):
+        filtered = bandpass(samples, sample_rate, config)
+    with timing.stage("profile_praat_pitch"):
+        low, high = config["pitch_range_allowed"]
+        parselmouth.Sound(filtered, sampling_frequency=sample_rate).to_pitch_ac(
+            pitch_floor=midi2freq(low),
+            pitch_ceiling=midi2freq(high),
+            silence_threshold=config["praat_silence_threshold"],
+            octave_cost=config["praat_high_frequncy_favoring_octave_cost"],
+            octave_jump_cost=config["praat_octave_jump_cost"],
+        )
+    with timing.stage("profile_segmentation"):
+        level, peak_db = filtered_envelope_db(filtered, sample_rate, config)
+        segments = [] if peak_db < MIN_PEAK_DB else detect_segments(level, sample_rate, config)
+    return len(segments)
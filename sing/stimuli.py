@@ -0,0 +1,191 @@
+# stimulus bank: the randomly generated node definitions, built once with a fixed seed into stimuli.json
+#
+# Every web worker loads the same file instead of sampling its own stimuli at import time.
+# After changing the settings below, rebuild the bank from the experiment folder with:
+#
+# python -m sing.stimuli build
+#
+# and commit stimuli.json. ``python -m sing.stimuli check`` verifies that the file matches a fresh build.
+# experiment.py and pre_screens.py take their melody settings from here, so the bank is built with the settings
+# the experiment uses.
+import argparse
+import functools
+import hashlib
+import json
+import random
+import sys
+
+from . import melodies
+
+STIMULI_PATH = "stimuli.json"
+STIMULI_VERSION = 1  # increase when the format of the node definitions changes
+SEED = 2023
+
+# reference pitches (MIDI) of the singing registers, sampled within +/- ROVING_WIDTH semitones
+ROVING_MEAN = dict(
+    default=55,
+    low=49,
+    high=61
+)
+ROVING_WIDTH = 2.5
+
+# practice melodies of the main singing task (see experiment.py)
+PRACTICE = dict(
+    num_melodies=2,
+    roving_mean=ROVING_MEAN["high"],
+    roving_width=ROVING_WIDTH,
+    max_interval2reference=5,
+    num_notes=7,
+)
+
+# singing performance test of the prescreen (see pre_screens.py)
+PERFORMANCE_TEST = dict(
+    intervals=[-1.3, -2.6, 1.3, 2.6],
+    registers=["low", "high"],
+    roving_mean=dict(low=ROVING_MEAN["low"], high=ROVING_MEAN["high"]),
+    roving_width=ROVING_WIDTH,
+)
+
+
+def generate_random_melody(mel_id, roving_mean, roving_width, max_interval2reference, num_notes):
+    # Function to generate melodies based on a reference_pitch, max_interval2reference, and number of notes
+
+    # sample reference pitch
+    reference_pitch = melodies.sample_reference_pitch(
+        roving_mean,
+        roving_width,
+    )
+    # sample pitches
+    target_pitches = melodies.sample_absolute_pitches(
+        reference_pitch=reference_pitch,
+        max_interval2reference=max_interval2reference,
+        num_pitches=num_notes
+    )
+
+    # Round each element in the target_pitches list to the nearest integer
+    target_pitches = [round(pitch) for pitch in target_pitches]
+
+    # get intervals
+    target_intervals = melodies.convert_absolute_pitches_to_interval_sequence(target_pitches, "previous_note")
+    return dict(
+        melody_id="Melody_" + str(mel_id),
+        target_pitches=target_pitches,
+        target_intervals=target_intervals,
+    )
+
+
+def generate_performance_test_definition(interval, register, spec):
+    return {
+        "interval": interval,
+        "target_pitches": melodies.convert_interval_sequence_to_absolute_pitches(
+            intervals=[interval],
+            reference_pitch=melodies.sample_reference_pitch(
+                spec["roving_mean"][register],
+                spec["roving_width"]
+            ),
+            reference_mode="previous_note",
+        ),
+    }
+
+
+def get_spec():
+    return {"practice": PRACTICE, "performance_test": PERFORMANCE_TEST}
+
+
+def build(seed=SEED):
+    """
+    Generates the node definitions of all randomly generated stimuli.
+    The global ``random`` state is seeded with ``seed`` and restored afterwards.
+
+    Returns
+    -------
+
+    A dictionary with the ``version``, ``seed`` and ``spec`` of the bank and one list of node definitions
+    per set of nodes (``practice``, ``performance_test``, ``performance_test2``).
+    """
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        practice = [
+            {
+                "melody": generate_random_melody(
+                    i,
+                    PRACTICE["roving_mean"],
+                    PRACTICE["roving_width"],
+                    PRACTICE["max_interval2reference"],
+                    PRACTICE["num_notes"],
+                )
+            }
+            for i in range(1, PRACTICE["num_melodies"] + 1)
+        ]
+        performance_tests = [
+            [
+                generate_performance_test_definition(interval, register, PERFORMANCE_TEST)
+                for interval in PERFORMANCE_TEST["intervals"]
+                for register in PERFORMANCE_TEST["registers"]
+            ]
+            for _ in range(2)
+        ]
+    finally:
+        random.setstate(state)
+
+    return {
+        "version": STIMULI_VERSION,
+        "seed": seed,
+        "spec": get_spec(),
+        "practice": practice,
+        "performance_test": performance_tests[0],
+        "performance_test2": performance_tests[1],
+    }
+
+
+def checksum(data: bytes):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def write(bank, path=STIMULI_PATH):
+    with open(path, "w") as file:
+        json.dump(bank, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+@functools.lru_cache(maxsize=4)
+def load(path=STIMULI_PATH):
+    """
+    Loads the stimulus bank (once per process) and checks that it was built with the current settings.
+    The checksum of the file is added under ``"checksum"``.
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        raise RuntimeError(f"Missing stimulus bank {path}; build it with: python -m sing.stimuli build")
+    bank = json.loads(data)
+    if bank.get("version") != STIMULI_VERSION or bank.get("spec") != json.loads(json.dumps(get_spec())):
+        raise RuntimeError(
+            f"The stimulus bank {path} does not match the settings in sing/stimuli.py; "
+            "rebuild it with: python -m sing.stimuli build"
+        )
+    bank["checksum"] = checksum(data)
+    return bank
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or check the stimulus bank.")
+    parser.add_argument("command", choices=["build", "check"])
+    parser.add_argument("--path", default=STIMULI_PATH)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        write(build(args.seed), args.path)
+    bank = load(args.path)
+    if args.command == "check":
+        rebuilt = build(bank["seed"])
+        if any(bank[key] != rebuilt[key] for key in rebuilt):
+            raise RuntimeError(f"{args.path} differs from a fresh build with seed {bank['seed']}")
+    print(f"{args.path}: version {bank['version']}, seed {bank['seed']}, {bank['checksum']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# server-side rendering of JSSynth melodies with a HarmonicTimbre, cached as audio files named by content hash
+#
+# The synthesis follows psynet's js-synthesizer (synthesis.js): every note is a harmonic complex tone whose
+# partials decay by ``roll_off`` dB/octave (normalised to unit energy, each oscillator at -17 dB), shaped by
+# a Tone.js amplitude envelope with a linear attack and exponential decay and release.
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from . import audio
+from .melodies import midi2freq_array
+
+RENDER_VERSION = 1  # increase when the synthesis changes, so that cached files are rendered again
+STIMULUS_FOLDER = "stimulus_audio"
+SAMPLE_RATE = 22050
+OSCILLATOR_GAIN = 10 ** (-17 / 20)  # Tone.Oscillator volume in synthesis.js
+FORMATS = [".mp3", ".wav"]  # preferred first; .mp3 needs ffmpeg
+
+
+def harmonic_weights(num_harmonics, roll_off):
+    # util_complex in synthesis.js
+    weights = 10 ** (-np.log2(np.arange(1, num_harmonics + 1)) * roll_off / 20)
+    return weights / np.sqrt(np.sum(weights ** 2))
+
+
+def approach(start, target, t, ramp_time):
+    # Tone.js exponentialApproachValueAtTime, used for the "exponential" decay and release curves
+    time_constant = np.log(ramp_time + 1) / np.log(200)
+    return target + (start - target) * np.exp(-t / time_constant)
+
+
+def envelope(num_samples, sample_rate, attack, decay, sustain_amp, release):
+    """
+    The amplitude envelope of one note lasting ``num_samples``, released ``release`` seconds before its end
+    as in ``ampEnv.triggerAttackRelease(duration - release, time)``.
+    """
+    t = np.arange(num_samples) / sample_rate
+    release_start = max(num_samples / sample_rate - release, 0)
+    t_decay = np.clip(t - attack, 0, None)
+    env = np.where(t < attack, t / attack if attack > 0 else 1.0, approach(1.0, sustain_amp, t_decay, decay))
+    release_level = approach(1.0, sustain_amp, max(release_start - attack, 0), decay)
+    return np.where(t < release_start, env, approach(release_level, 0.0, t - release_start, release))
+
+
+def render(target_pitches, timbre, note_duration, note_silence, sample_rate=SAMPLE_RATE):
+    """
+    Renders a melody as JSSynth plays it with ``[Note(pitch) for pitch in target_pitches]``.
+
+    Parameters
+    ----------
+
+    target_pitches : list
+        Pitches of the notes (MIDI).
+
+    timbre : dict
+        A ``HarmonicTimbre`` (``attack``, ``decay``, ``sustain_amp``, ``release``, ``num_harmonics``, ``roll_off``).
+
+    note_duration, note_silence : float
+        ``default_duration`` and ``default_silence`` of the ``JSSynth`` prompt (s).
+
+    Returns
+    -------
+
+    The samples as a float array in [-1, 1].
+    """
+    note_samples = int(round(note_duration * sample_rate))
+    step_samples = int(round((note_duration + note_silence) * sample_rate))
+    num_samples = step_samples * (len(target_pitches) - 1) + note_samples if len(target_pitches) else 0
+    out = np.zeros(num_samples)
+
+    weights = OSCILLATOR_GAIN * harmonic_weights(timbre["num_harmonics"], timbre["roll_off"])
+    harmonics = np.arange(1, len(weights) + 1)
+    env = envelope(
+        note_samples, sample_rate, timbre["attack"], timbre["decay"], timbre["sustain_amp"], timbre["release"]
+    )
+    for i, freq in enumerate(midi2freq_array(target_pitches)):
+        start = i * step_samples
+        # the oscillators run freely in the browser, so the phase follows the absolute time
+        t = (start + np.arange(note_samples)) / sample_rate
+        tone = weights @ np.sin(2 * np.pi * freq * np.outer(harmonics, t))
+        out[start:start + note_samples] += env * tone
+    return np.clip(out, -1, 1)
+
+
+def stimulus_key(target_pitches, timbre, note_duration, note_silence, sample_rate=SAMPLE_RATE):
+    spec = {
+        "version": RENDER_VERSION,
+        "target_pitches": [float(x) for x in target_pitches],
+        "timbre": dict(timbre),
+        "note_duration": note_duration,
+        "note_silence": note_silence,
+        "sample_rate": sample_rate,
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def find_stimulus(key, folder=STIMULUS_FOLDER):
+    for extension in FORMATS:
+        path = os.path.join(folder, key + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def stimulus_file(target_pitches, timbre, note_duration, note_silence, folder=STIMULUS_FOLDER):
+    """
+    Returns the file name (in ``folder``) of the rendered melody, or ``None`` if it has not been rendered yet.
+    """
+    path = find_stimulus(stimulus_key(target_pitches, timbre, note_duration, note_silence), folder)
+    return None if path is None else os.path.basename(path)
+
+
+def render_stimulus(target_pitches, timbre, note_duration, note_silence, folder=STIMULUS_FOLDER):
+    """
+    Returns the file name (in ``folder``) of the rendered melody, rendering it on first use.
+    The file is encoded as MP3 if ffmpeg is available and kept as WAV otherwise; it is written
+    under a temporary name and renamed, so that concurrent requests never serve a partial file.
+    """
+    key = stimulus_key(target_pitches, timbre, note_duration, note_silence)
+    path = find_stimulus(key, folder)
+    if path is not None:
+        return os.path.basename(path)
+
+    os.makedirs(folder, exist_ok=True)
+    samples = render(target_pitches, timbre, note_duration, note_silence)
+    with tempfile.TemporaryDirectory(dir=folder) as tmp_folder:
+        wav_path = os.path.join(tmp_folder, key + ".wav")
+        audio.write_wav(wav_path, SAMPLE_RATE, samples)
+        encoded_path = os.path.join(tmp_folder, key + FORMATS[0])
+        if audio.encode(wav_path, encoded_path):
+            path = os.path.join(folder, key + FORMATS[0])
+            os.replace(encoded_path, path)
+        else:
+            path = os.path.join(folder, key + ".wav")
+            os.replace(wav_path, path)
+    return os.path.basename(path)
@@ -0,0 +1,165 @@
+# per-stage timing of the recording analyses: wall time, CPU time and peak memory
+import contextvars
+import functools
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+PERCENTILES = [50, 95, 99]
+HISTOGRAM_EDGES = [0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60, float("inf")]  # seconds
+
+_current = contextvars.ContextVar("stage_timer", default=None)
+
+
+def max_rss_mb():
+    # peak resident memory of this process so far (Linux reports KB, macOS bytes)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class StageTimer:
+    """
+    Collects the wall time, CPU time and peak memory of the stages of one analysis.
+    Peak memory is the high-water mark of the process that ran the stage (``ru_maxrss``),
+    so it only grows over the life of a worker and mostly shows which stages push it up.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def add(self, name, wall, cpu=None, max_rss=None):
+        # repeated stages are summed
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "max_rss_mb": 0.0})
+        stage["wall"] += wall
+        stage["cpu"] += cpu or 0.0
+        stage["max_rss_mb"] = max(stage["max_rss_mb"], max_rss or 0.0)
+
+    @contextmanager
+    def stage(self, name):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, time.process_time() - start_cpu, max_rss_mb())
+
+    def as_dict(self):
+        return {
+            "total": {
+                "wall": round(time.perf_counter() - self.start, 4),
+                "cpu": round(time.process_time() - self.start_cpu, 4),
+                "max_rss_mb": round(max_rss_mb(), 1),
+            },
+            "stages": {
+                name: {key: round(value, 4 if key != "max_rss_mb" else 1) for key, value in stage.items()}
+                for name, stage in self.stages.items()
+            },
+        }
+
+
+@contextmanager
+def collect():
+    """
+    Makes a new ``StageTimer`` the current one for the duration of the block, so that
+    ``stage`` and ``add`` calls further down (``analysis.analyze``, ``onsets.count_notes``, ...) are recorded in it.
+    """
+    timer = StageTimer()
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """
+    Records the enclosed block as stage ``name`` of the current timer; does nothing outside ``collect``.
+    """
+    timer = _current.get()
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+def add(name, wall, cpu=None, max_rss=None):
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, wall, cpu, max_rss)
+
+
+def timed_call(fn, *args, **kwargs):
+    """
+    Runs ``fn(*args, **kwargs)`` and returns ``(result, {"wall": ..., "cpu": ..., "max_rss_mb": ...})``.
+    Used to time a job inside a worker process, where the caller's timer is not available.
+    """
+    start, start_cpu = time.perf_counter(), time.process_time()
+    result = fn(*args, **kwargs)
+    return result, {
+        "wall": time.perf_counter() - start,
+        "cpu": time.process_time() - start_cpu,
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def timed_analysis(fn):
+    """
+    Decorator for analysis functions returning a dictionary: stores the timings of the call under ``"timings"``.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with collect() as timer:
+            output = fn(*args, **kwargs)
+        output["timings"] = timer.as_dict()
+        return output
+    return wrapper
+
+
+def summarize(records, percentiles=PERCENTILES, edges=HISTOGRAM_EDGES):
+    """
+    Aggregates stored timings per trial maker.
+
+    Parameters
+    ----------
+
+    records :
+        Iterable of ``(trial_maker_id, timings)`` pairs, where ``timings`` is the ``"timings"`` entry of an analysis.
+
+    percentiles :
+        Percentiles of the wall time, CPU time and peak memory to report.
+
+    edges :
+        Bin edges (seconds) of the wall time histograms.
+
+    Returns
+    -------
+
+    A dictionary ``{trial_maker_id: {stage: summary}}``, with one entry per stage plus ``"total"``.
+    Each summary holds ``n``, the percentiles as ``wall_p50``, ``cpu_p95``, ``max_rss_mb_p99``, ...
+    and ``wall_histogram``, the counts per bin of ``edges``.
+    """
+    values = {}
+    for trial_maker_id, timings in records:
+        if not timings:
+            continue
+        stages = dict(timings.get("stages", {}), total=timings["total"])
+        for name, stage in stages.items():
+            for key, value in stage.items():
+                values.setdefault(trial_maker_id, {}).setdefault(name, {}).setdefault(key, []).append(value)
+
+    summary = {}
+    for trial_maker_id, stages in values.items():
+        for name, stage in stages.items():
+            result = {"n": len(stage["wall"])}
+            for key, x in stage.items():
+                for p, value in zip(percentiles, np.percentile(x, percentiles)):
+                    result[f"{key}_p{p}"] = round(float(value), 4)
+            result["wall_histogram"] = np.histogram(stage["wall"], bins=edges)[0].tolist()
+            summary.setdefault(trial_maker_id, {})[name] = result
+    return summary
@@ -0,0 +1,218 @@
+# compressed upload of the singing recordings: the browser sends a band-limited, losslessly compressed copy of
+# the recording instead of the WAV file of psynet's recorder, and the server decodes it back to WAV before the
+# recording is stored and analysed
+#
+# The browser resamples the recording to 16 kHz mono (the analysis only uses 80-6000 Hz, see
+# params.singing_2intervals), quantises it to 16 bits, takes the difference between consecutive samples,
+# splits the differences into a plane of low bytes and a plane of high bytes and gzips the result
+# (CompressionStream). The upload is about 1/6 of a 48 kHz WAV file; the stored WAV file, at 16 kHz, 1/3.
+# Browsers without CompressionStream upload the WAV file as before.
+#
+# Upload format (gzipped): b"SNG1", sample rate and number of frames (uint32 little-endian),
+# the low bytes and then the high bytes of the int16 sample differences (the first one from 0).
+#
+# Uploads come from the client: they are decompressed up to the size of a recording of the duration of the
+# control (plus UPLOAD_MARGIN), and an upload that is larger, truncated or at another sample rate is rejected
+# (the page asks the participant to record again) instead of being decoded.
+import gzip
+import io
+import json
+import struct
+import wave
+import zlib
+
+import numpy as np
+from markupsafe import Markup
+from psynet.modular_page import AudioRecordControl
+from psynet.timeline import FailedValidation
+from psynet.utils import get_logger
+from werkzeug.datastructures import FileStorage
+
+from .audio import read_wav, resample, to_mono
+
+logger = get_logger()
+
+UPLOAD_SAMPLE_RATE = 16000
+UPLOAD_MARGIN = 1.0  # s accepted beyond the duration of the control
+MAGIC = b"SNG1"
+GZIP_MAGIC = b"\x1f\x8b"
+HEADER_SIZE = 12
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+def encode(samples, sample_rate):
+    """
+    Encodes int16 ``samples`` (mono) in the upload format, as the browser does (see ``compression_script``).
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    # int16 arithmetic wraps around, which ``decode`` undoes with a wrapping cumulative sum
+    differences = np.diff(samples, prepend=np.int16(0)).astype("<i2").view(np.uint8).reshape(-1, 2)
+    header = MAGIC + struct.pack("<II", sample_rate, len(samples))
+    return gzip.compress(header + differences[:, 0].tobytes() + differences[:, 1].tobytes())
+
+
+def max_frames(duration):
+    """
+    Number of frames accepted in the upload of a recording of ``duration`` seconds.
+    """
+    return int((duration + UPLOAD_MARGIN) * UPLOAD_SAMPLE_RATE)
+
+
+def decompress(data, max_size):
+    """
+    Decompresses the gzipped ``data``, raising ``InvalidUpload`` if it is corrupt or if it would decompress to
+    more than ``max_size`` bytes (``None``: no limit). Only ``max_size + 1`` bytes are ever decompressed.
+    """
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+        if max_size is None:
+            output = decompressor.decompress(data)
+        else:
+            output = decompressor.decompress(data, max_size + 1)
+    except zlib.error as error:
+        raise InvalidUpload(f"Corrupt compressed recording: {error}")
+    if max_size is not None and (len(output) > max_size or decompressor.unconsumed_tail):
+        raise InvalidUpload(f"Compressed recording larger than {max_size} bytes.")
+    if not decompressor.eof:
+        raise InvalidUpload("Truncated compressed recording.")
+    if decompressor.unused_data:
+        raise InvalidUpload("Data after the compressed recording.")
+    return output
+
+
+def decode(data, max_frames):
+    """
+    Decodes an upload (see ``encode``) of at most ``max_frames`` frames (``None`` for trusted files of any
+    length) and returns ``(sample_rate, samples)``, with int16 ``samples``. Raises ``InvalidUpload`` if the
+    upload is corrupt, too long or not at ``UPLOAD_SAMPLE_RATE``.
+    """
+    data = decompress(data, None if max_frames is None else HEADER_SIZE + 2 * max_frames)
+    if data[:4] != MAGIC or len(data) < HEADER_SIZE:
+        raise InvalidUpload("Not a compressed recording.")
+    sample_rate, num_frames = struct.unpack("<II", data[4:HEADER_SIZE])
+    if sample_rate != UPLOAD_SAMPLE_RATE:
+        raise InvalidUpload(f"Compressed recording at {sample_rate} Hz instead of {UPLOAD_SAMPLE_RATE} Hz.")
+    if len(data) != HEADER_SIZE + 2 * num_frames:
+        raise InvalidUpload(f"Compressed recording of {len(data)} bytes, expected {HEADER_SIZE + 2 * num_frames}.")
+    planes = np.frombuffer(data[HEADER_SIZE:], dtype=np.uint8)
+    differences = np.stack([planes[:num_frames], planes[num_frames:]], axis=1).copy().view("<i2")[:, 0]
+    return sample_rate, np.cumsum(differences, dtype=np.int16)
+
+
+def to_wav(sample_rate, samples):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes(np.asarray(samples, dtype="<i2").tobytes())
+    return buffer.getvalue()
+
+
+def simulate_upload(path, sample_rate=UPLOAD_SAMPLE_RATE):
+    """
+    The upload the browser would send for the WAV file ``path`` (resampled here with ``audio.resample``).
+    """
+    source_rate, samples = read_wav(path)
+    samples = resample(to_mono(samples), source_rate, sample_rate)
+    return encode(np.round(np.clip(samples, -1, 1) * 32767).astype(np.int16), sample_rate)
+
+
+def decode_upload(blob, max_frames):
+    """
+    Returns the uploaded recording ``blob`` (a werkzeug ``FileStorage``) as a WAV file: decoded if it was
+    compressed (see ``decode``), unchanged otherwise.
+    """
+    data = blob.read()
+    blob.seek(0)
+    if data[:2] != GZIP_MAGIC:
+        return blob
+    return FileStorage(
+        io.BytesIO(to_wav(*decode(data, max_frames))), filename="audio.wav", content_type="audio/wav"
+    )
+
+
+class CompressedAudioRecordControl(AudioRecordControl):
+    """
+    ``AudioRecordControl`` accepting compressed uploads (see ``compression_script``, to be included in the page),
+    which are decoded to WAV before the recording is stored. An invalid upload is not stored: the answer holds
+    ``upload_error`` and the response fails validation, so the participant is asked to record again.
+    """
+
+    def format_answer(self, raw_answer, **kwargs):
+        try:
+            recording = decode_upload(kwargs["blobs"]["audioRecording"], max_frames(self.duration))
+        except InvalidUpload as error:
+            logger.warning("Rejected a recording upload: %s", error)
+            return {"origin": "CompressedAudioRecordControl", "upload_error": str(error)}
+        blobs = {**kwargs["blobs"], "audioRecording": recording}
+        return super().format_answer(raw_answer, **{**kwargs, "blobs": blobs})
+
+    def validate(self, response, **kwargs):
+        if isinstance(response.answer, dict) and "upload_error" in response.answer:
+            return FailedValidation("Your recording could not be uploaded. Please record it again.")
+        return super().validate(response, **kwargs)
+
+
+def compression_script(sample_rate=UPLOAD_SAMPLE_RATE):
+    """
+    Script for a page with a ``CompressedAudioRecordControl``: once the recording ends, replaces it with its
+    compressed version and stores ``recording_bytes``, ``upload_bytes`` and ``upload_encode_time`` (s) in the
+    response metadata.
+    """
+    return Markup(
+        f"""
+        <script>
+        // recordEnd handlers run one after the other by decreasing priority: this one runs once the recorder has
+        // staged the recording, and the page waits for it before the response can be submitted
+        psynet.trial.onEvent("recordEnd", async function () {{
+            const blob = psynet.response.staged.blobs["audioRecording"];
+            if (!blob || typeof CompressionStream === "undefined") {{
+                return;
+            }}
+            const start = performance.now();
+            const sampleRate = {int(sample_rate)};
+            try {{
+                const decoded = await new OfflineAudioContext(1, 1, 44100).decodeAudioData(await blob.arrayBuffer());
+                const context = new OfflineAudioContext(1, Math.max(Math.ceil(decoded.duration * sampleRate), 1), sampleRate);
+                const source = context.createBufferSource();
+                source.buffer = decoded;
+                source.connect(context.destination);
+                source.start();
+                const samples = (await context.startRendering()).getChannelData(0);
+
+                const n = samples.length;
+                const bytes = new Uint8Array(12 + 2 * n);
+                bytes.set({json.dumps(list(MAGIC))});
+                const header = new DataView(bytes.buffer);
+                header.setUint32(4, sampleRate, true);
+                header.setUint32(8, n, true);
+                let previous = 0;
+                for (let i = 0; i < n; i++) {{
+                    const sample = Math.round(Math.max(-1, Math.min(1, samples[i])) * 32767);
+                    const difference = (sample - previous) & 0xffff;
+                    bytes[12 + i] = difference & 0xff;
+                    bytes[12 + n + i] = difference >> 8;
+                    previous = sample;
+                }}
+                const compressed = await new Response(
+                    new Blob([bytes]).stream().pipeThrough(new CompressionStream("gzip"))
+                ).blob();
+
+                psynet.response.staged.blobs["audioRecording"] = compressed;
+                Object.assign(psynet.response.staged.metadata, {{
+                    recording_bytes: blob.size,
+                    upload_bytes: compressed.size,
+                    upload_encode_time: (performance.now() - start) / 1000,
+                }});
+            }} catch (error) {{
+                // the WAV file is uploaded instead
+                psynet.log.error(error.stack);
+            }}
+        }}, {{priority: -60}});
+        </script>
+        """
+    )
@@ -0,0 +1,45 @@
+# batched updates of psynet variables (participant.var, trial.var, ...) in a compact, JSON-native form
+import numpy as np
+
+COMPACT_DIGITS = 4  # decimals kept for floats (1e-4 semitones is far below the accuracy of the pitch estimates)
+
+
+def compact(value, digits=COMPACT_DIGITS):
+    """
+    Converts ``value`` to plain JSON types: numpy scalars and arrays become python numbers and lists,
+    and floats are rounded to ``digits`` decimals (NaN becomes ``None``). Dictionaries, lists and tuples
+    are converted recursively. Otherwise numpy values are stored by jsonpickle as verbose reduce objects.
+    """
+    if isinstance(value, dict):
+        return {key: compact(x, digits) for key, x in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [compact(x, digits) for x in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), digits)
+    return value
+
+
+def set_vars(owner, digits=COMPACT_DIGITS, **values):
+    """
+    Sets several variables of ``owner`` (e.g. a participant) at once, in compact form.
+    The variable dictionary is replaced once instead of being modified once per variable,
+    so SQLAlchemy registers a single change and serialises the dictionary once at the next flush.
+
+    Parameters
+    ----------
+
+    owner :
+        An object with a psynet ``vars`` column, e.g. a ``Participant``.
+
+    digits : int
+        Decimals kept for floats.
+
+    **values :
+        The variables to set.
+    """
+    owner.vars = {**(owner.vars or {}), **{name: compact(value, digits) for name, value in values.items()}}
+    return owner
@@ -0,0 +1,41 @@
+# Tests of the melody catalog (sing/catalog.py): the node definitions made from the memory-mapped pitch matrix
+# must be those of the source.
+#
+# bash docker/run pytest test_catalog.py
+
+import json
+import os
+
+import numpy as np
+
+from .sing import catalog
+
+SOURCE = os.path.join(os.path.dirname(__file__), "melodies.json")
+
+
+def test_node_definitions_match_the_source(tmp_path):
+    with open(SOURCE) as file:
+        entries = json.load(file)["melodies"]
+    melody_catalog = catalog.open_catalog(SOURCE, str(tmp_path))
+
+    assert isinstance(melody_catalog.pitch_matrix, np.memmap)
+    assert list(melody_catalog.iter_node_definitions()) == [
+        {"melody": {"set_id": entry["set"], "melody_id": entry["melody"], "target_pitches": entry["target_pitches"]}}
+        for entry in entries
+    ]
+
+
+def test_pitch_matrix_is_padded_with_nan(tmp_path):
+    source = tmp_path / "melodies.jsonl"
+    source.write_text(
+        json.dumps({"set": "a", "melody": "short", "target_pitches": [60, 61.5]}) + "\n"
+        + json.dumps({"set": "b", "melody": "long", "target_pitches": [60, 62, 64]}) + "\n"
+    )
+    melody_catalog = catalog.open_catalog(str(source))
+
+    assert melody_catalog.pitch_matrix.shape == (2, 3)
+    assert np.isnan(melody_catalog.pitch_matrix[0, 2])
+    assert melody_catalog.node_definition(0)["melody"]["target_pitches"] == [60, 61.5]
+    assert list(melody_catalog.iter_node_definitions(melody_catalog.rows("b"))) == [
+        {"melody": {"set_id": "b", "melody_id": "long", "target_pitches": [60, 62, 64]}}
+    ]
@@ -0,0 +1,118 @@
+# Property tests of the batch (2-D array) functions in sing/melodies.py: on random melodies they must return
+# the same values as the single melody functions, without modifying their inputs.
+#
+# bash docker/run pytest test_melodies.py
+
+import numpy as np
+import pytest
+
+from .sing import melodies
+
+NUM_MELODIES = 200
+REFERENCE_MODES = ["first_note", "previous_note"]
+
+
+def random_intervals(rng, n_int, discrete):
+    if discrete:
+        return rng.integers(-8, 8, size=(NUM_MELODIES, n_int), endpoint=True)
+    return rng.uniform(-8, 8, size=(NUM_MELODIES, n_int))
+
+
+@pytest.fixture(params=[(0, True), (1, False), (2, True), (6, False), (11, False)], ids=lambda x: f"{x[0]}-{x[1]}")
+def intervals(request):
+    n_int, discrete = request.param
+    return random_intervals(np.random.default_rng(n_int), n_int, discrete)
+
+
+@pytest.fixture
+def reference_pitches():
+    return np.random.default_rng(0).uniform(45, 65, size=NUM_MELODIES)
+
+
+@pytest.mark.parametrize("reference_mode", REFERENCE_MODES)
+def test_convert_interval_sequences_to_absolute_pitches(intervals, reference_pitches, reference_mode):
+    expected = [
+        melodies.convert_interval_sequence_to_absolute_pitches(list(x), r, reference_mode)
+        for x, r in zip(intervals.tolist(), reference_pitches.tolist())
+    ]
+    result = melodies.convert_interval_sequences_to_absolute_pitches(intervals, reference_pitches, reference_mode)
+    assert result.tolist() == expected
+
+    result = melodies.convert_interval_sequences_to_absolute_pitches(intervals, 60, reference_mode)
+    assert result.tolist() == [
+        melodies.convert_interval_sequence_to_absolute_pitches(x, 60, reference_mode) for x in intervals.tolist()
+    ]
+
+
+@pytest.mark.parametrize("reference_mode", REFERENCE_MODES)
+def test_convert_absolute_pitches_to_interval_sequences(intervals, reference_pitches, reference_mode):
+    pitches = melodies.convert_interval_sequences_to_absolute_pitches(intervals, reference_pitches, "previous_note")
+    expected = [melodies.convert_absolute_pitches_to_interval_sequence(x, reference_mode) for x in pitches.tolist()]
+    result = melodies.convert_absolute_pitches_to_interval_sequences(pitches, reference_mode)
+    assert result.shape == (NUM_MELODIES, intervals.shape[1])
+    assert result.tolist() == expected
+
+
+def test_convert_absolute_pitches_to_intervals2references(intervals, reference_pitches):
+    pitches = melodies.convert_interval_sequences_to_absolute_pitches(intervals, 55, "first_note")
+    references = reference_pitches.tolist()
+    expected = [
+        melodies.convert_absolute_pitches_to_intervals2reference(x, [r]) for x, r in zip(pitches.tolist(), references)
+    ]
+    result = melodies.convert_absolute_pitches_to_intervals2references(pitches, reference_pitches)
+    assert result.tolist() == expected
+    assert reference_pitches.tolist() == references
+
+
+@pytest.mark.parametrize("reference_mode", REFERENCE_MODES)
+def test_get_melody_pitch_ranges(intervals, reference_mode):
+    expected = [melodies.get_melody_pitch_range(x, reference_mode) for x in intervals.tolist()]
+    assert melodies.get_melody_pitch_ranges(intervals, reference_mode).tolist() == expected
+
+
+@pytest.mark.parametrize("reference_mode", REFERENCE_MODES)
+@pytest.mark.parametrize("max_interval_size, max_melody_pitch_range", [(8, 99), (6.5, 10), (4, 6), (8, 0)])
+def test_are_valid_interval_sequences(intervals, reference_mode, max_interval_size, max_melody_pitch_range):
+    n_int = intervals.shape[1]
+    expected = [
+        melodies.is_valid_interval_sequence(x, n_int, max_interval_size, max_melody_pitch_range, reference_mode)
+        for x in intervals.tolist()
+    ]
+    result = melodies.are_valid_interval_sequences(
+        intervals, n_int, max_interval_size, max_melody_pitch_range, reference_mode
+    )
+    assert result.tolist() == expected
+    assert not melodies.are_valid_interval_sequences(
+        intervals, n_int + 1, max_interval_size, max_melody_pitch_range, reference_mode
+    ).any()
+
+
+@pytest.mark.parametrize("max_pitch_range", [0, 2.5, 5, 9.5])
+def test_are_valid_pitch_ranges(intervals, reference_pitches, max_pitch_range):
+    pitches = melodies.convert_interval_sequences_to_absolute_pitches(intervals, reference_pitches, "first_note")
+    pitches = pitches + np.random.default_rng(1).uniform(-3, 3, size=pitches.shape)
+    expected = [
+        melodies.is_valid_pitch_range(r, x, max_pitch_range)
+        for r, x in zip(reference_pitches.tolist(), pitches.tolist())
+    ]
+    original = pitches.copy()
+    assert melodies.are_valid_pitch_ranges(reference_pitches, pitches, max_pitch_range).tolist() == expected
+    assert np.array_equal(pitches, original)
+
+
+def test_reference_pitch_lists_are_not_modified():
+    reference_pitch = [60]
+    assert melodies.is_valid_pitch_range(reference_pitch, [61, 62], 3)
+    assert melodies.convert_absolute_pitches_to_intervals2reference([61, 62], reference_pitch) == [1, 2]
+    assert melodies.convert_intervals2reference_to_absolute_pitches([1, 2], reference_pitch) == [61, 62]
+    assert reference_pitch == [60]
+
+
+@pytest.mark.parametrize("reference_mode", REFERENCE_MODES)
+@pytest.mark.parametrize("discrete", [True, False])
+def test_sampled_sequences_are_valid(reference_mode, discrete):
+    sequences = melodies.sample_interval_sequences(
+        500, 11, 4.5, 9, discrete, reference_mode, rng=np.random.default_rng(0)
+    )
+    assert sequences.shape == (500, 11)
+    assert melodies.are_valid_interval_sequences(sequences, 11, 4.5, 9, reference_mode).all()
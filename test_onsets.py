@@ -0,0 +1,28 @@
+# Agreement of the envelope note counter (sing/onsets.py, analysis_mode="note_count") with sing.analyze on the
+# recordings shipped with the repo. The counter decides the feedback and the pass/fail of the trials that use it,
+# so it must give the same count as the full analysis before a trial class is switched to it.
+#
+# bash docker/run pytest test_onsets.py
+
+import glob
+import os
+
+import pytest
+
+pytest.importorskip("sing4me")
+
+from .sing import analysis, onsets  # noqa: E402
+from .sing.params import singing_2intervals  # noqa: E402
+
+FOLDER = os.path.dirname(__file__)
+AUDIO_FILES = (
+    [os.path.join(FOLDER, "audio_5notes.wav"), os.path.join(FOLDER, "input", "silence_1s.wav")]
+    + sorted(glob.glob(os.path.join(FOLDER, "input", "melodies-mmb24", "*", "*.wav")))
+)
+
+
+@pytest.mark.parametrize("audio_file", AUDIO_FILES, ids=lambda path: os.path.relpath(path, FOLDER))
+def test_note_count_agrees_with_sing_analyze(audio_file):
+    full = len(analysis.extract_notes(audio_file, singing_2intervals))
+    note_count = onsets.count_notes(audio_file, singing_2intervals)["num_sung_pitches"]
+    assert note_count == full
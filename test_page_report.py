@@ -0,0 +1,75 @@
+# Tests of the summaries of page_report.py on metadata as the pages store it (no database needed).
+#
+# bash docker/run pytest test_page_report.py
+
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from . import page_report  # noqa: E402
+
+PERCENTILES = [50, 95, 99]
+
+
+def test_trial_gaps_are_grouped_by_cache(tmp_path, capsys, monkeypatch):
+    records = [
+        {"inter_trial_gap": 1.0, "server_time": 0.1, "page_load_time": 0.5, "audio_cached": True},
+        {"inter_trial_gap": 3.0, "server_time": 0.2, "page_load_time": None, "audio_cached": True},
+        {"inter_trial_gap": 2.0, "server_time": 0.3, "page_load_time": 0.7, "audio_cached": False},
+        {"inter_trial_gap": 4.0, "server_time": None, "page_load_time": None, "audio_cached": None},
+    ]
+    groups = page_report.group_trial_gaps(records)
+    assert groups == {
+        "audio cached": {"inter_trial_gap": [1.0, 3.0], "server_time": [0.1, 0.2], "page_load_time": [0.5]},
+        "audio not cached": {"inter_trial_gap": [2.0], "server_time": [0.3], "page_load_time": [0.7]},
+        "JSSynth": {"inter_trial_gap": [4.0]},
+    }
+
+    monkeypatch.setattr(page_report, "trial_gaps_from_database", lambda: iter(records))
+    output = tmp_path / "gaps.json"
+    page_report.main(["trial-gaps", "--json", str(output)])
+    summary = json.loads(output.read_text())
+    assert summary["audio cached"]["inter_trial_gap"] == {"n": 2, "p50": 2.0, "p95": 2.9, "p99": pytest.approx(2.98)}
+    assert "audio not cached  page_load_time" in capsys.readouterr().out
+
+
+def test_provisional_counts_honour_trial_makers(tmp_path, capsys, monkeypatch):
+    queried = []
+
+    def provisional_counts_from_database(trial_makers):
+        queried.append(trial_makers)
+        yield "sing_practice", {"provisional_num_sung_pitches": 7, "provisional_agrees": True}
+        yield "sing_practice", {"provisional_num_sung_pitches": 6, "provisional_agrees": False}
+
+    monkeypatch.setattr(page_report, "provisional_counts_from_database", provisional_counts_from_database)
+    output = tmp_path / "provisional.json"
+    page_report.main(["provisional", "--trial-maker", "sing_practice", "--json", str(output)])
+    assert queried == [["sing_practice"]]
+    assert json.loads(output.read_text()) == {"sing_practice": {"n": 2, "agree": 0.5}}
+    assert "50.0%" in capsys.readouterr().out
+
+
+def test_readiness_groups_by_transport(capsys, monkeypatch):
+    records = [
+        {"readiness_transport": "websocket", "readiness_waited": 0.4, "readiness_delivery": 0.05},
+        {"notify_to_render": 0.2},
+        {"readiness_transport": "poll", "readiness_waited": 0.75},
+    ]
+    assert page_report.group_readiness(records) == {
+        "websocket": {"readiness_waited": [0.4], "readiness_delivery": [0.05]},
+        "render": {"notify_to_render": [0.2]},
+        "poll": {"readiness_waited": [0.75]},
+    }
+    monkeypatch.setattr(page_report, "readiness_from_database", lambda: iter(records))
+    page_report.main(["readiness"])
+    assert "websocket  readiness_delivery" in capsys.readouterr().out
+
+
+def test_no_records(capsys, monkeypatch, tmp_path):
+    monkeypatch.setattr(page_report, "trial_gaps_from_database", lambda: iter([]))
+    output = tmp_path / "gaps.json"
+    page_report.main(["trial-gaps", "--json", str(output)])
+    assert capsys.readouterr().out == "No trial gaps found.\n"
+    assert not output.exists()
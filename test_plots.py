@@ -0,0 +1,96 @@
+# Tests of the analysis plots of the recording trials (sing/plots.py): psynet's async_post_trial must store the
+# analysis and fail bad recordings whether or not the analysis rendered a plot, and a deferred plot is rendered
+# in the background when it is requested.
+#
+# bash docker/run pytest test_plots.py
+
+import os
+import shutil
+import time
+
+import pytest
+
+pytest.importorskip("sing4me")
+pytest.importorskip("psynet")
+
+from psynet.trial.audio import AudioRecordTrial  # noqa: E402
+from psynet.trial.record import RecordTrial  # noqa: E402
+
+from .sing import analysis, plots  # noqa: E402
+from .sing.params import singing_2intervals  # noqa: E402
+
+AUDIO_FILE = os.path.join(os.path.dirname(__file__), "audio_5notes.wav")
+
+
+class Recording:
+    def export(self, path):
+        shutil.copyfile(AUDIO_FILE, path)
+
+
+class RecordingTrial(plots.DeferredPlotTrial, AudioRecordTrial):
+    # the database columns of a psynet trial, as far as async_post_trial uses them
+    id = 1
+    analysis = None
+    recording = Recording()
+    failed_reason = None
+
+    def __init__(self, failed, render_plot):
+        self.analysis_failed = failed
+        self.analysis_renders_plot = render_plot
+
+    def analyze_recording(self, audio_file, output_plot):
+        if self.analysis_renders_plot:
+            with open(output_plot, "wb") as file:
+                file.write(b"\x89PNG")
+            plot = None
+        else:
+            plot = {"deferred": True, "key": "test", "target_pitches": [60, 62]}
+        return {"failed": self.analysis_failed, "plot": plot}
+
+    def fail(self, reason=None):
+        self.failed_reason = reason
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploaded = []
+
+    def upload_plot(self, local_path, async_):
+        with open(local_path, "rb") as file:
+            uploaded.append(file.read())
+        os.remove(local_path)
+
+    monkeypatch.setattr(RecordTrial, "upload_plot", upload_plot)
+    return uploaded
+
+
+@pytest.mark.parametrize("failed", [False, True])
+def test_deferred_plot_is_not_uploaded(uploads, failed):
+    trial = RecordingTrial(failed=failed, render_plot=False)
+    trial.async_post_trial()
+    assert trial.analysis["plot"]["deferred"]
+    assert uploads == []
+    assert trial.failed_reason == ("analysis" if failed else None)
+
+
+def test_rendered_plot_is_uploaded(uploads):
+    trial = RecordingTrial(failed=False, render_plot=True)
+    trial.async_post_trial()
+    assert uploads == [b"\x89PNG"]
+    assert trial.failed_reason is None
+
+
+def test_plot_request_does_not_wait(tmp_path):
+    analysis.configure(num_workers=1, cache_path=None)
+    try:
+        store = plots.PlotStore(str(tmp_path))
+        spec = plots.plot_spec(AUDIO_FILE, singing_2intervals, [60, 62, 64, 65, 67])
+        export = Recording().export
+        assert plots.request_plot(export, singing_2intervals, spec, store=store) is None
+
+        deadline = time.monotonic() + 60
+        while store.get(spec["key"]) is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert plots.request_plot(export, singing_2intervals, spec, store=store) == store.path(spec["key"])
+    finally:
+        analysis.configure(num_workers=analysis.NUM_WORKERS, cache_path=analysis.CACHE_PATH)
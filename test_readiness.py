@@ -0,0 +1,110 @@
+# Tests of the notified wait pages (sing/readiness.py) against the installed psynet: the feedback logic of psynet
+# must keep its structure and polling interval, with only the wait page replaced.
+#
+# bash docker/run pytest test_readiness.py
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("psynet")
+
+from psynet.page import InfoPage, WaitPage  # noqa: E402
+from psynet.timeline import PageMaker  # noqa: E402
+from psynet.trial.main import Trial  # noqa: E402
+
+from . import page_report  # noqa: E402
+from .sing import readiness  # noqa: E402
+
+
+class FeedbackTrial(readiness.NotifiedFeedbackTrial, Trial):
+    __abstract__ = True
+
+
+def wait_pages(logic):
+    return [elt for elt in logic if isinstance(elt, WaitPage)]
+
+
+def test_feedback_logic_only_replaces_the_wait_page():
+    original = Trial._construct_feedback_logic(None)
+    logic = FeedbackTrial._construct_feedback_logic(None)
+
+    assert [type(elt) for elt in logic] == [
+        readiness.NotifiedWaitPage if type(elt) is WaitPage else type(elt) for elt in original
+    ]
+    (page,) = wait_pages(logic)
+    assert page.wait_time == wait_pages(original)[0].wait_time
+
+
+def test_feedback_page_has_render_metric():
+    logic = FeedbackTrial._construct_feedback_logic(None)
+    (page_maker,) = [elt for elt in logic if isinstance(elt, PageMaker)]
+    trial = SimpleNamespace(show_feedback=lambda experiment, participant: InfoPage("Well done!", time_estimate=1))
+    page = page_maker.function(experiment=None, participant=SimpleNamespace(current_trial=trial))
+    assert readiness.render_metric_script() in page.scripts
+
+
+def test_deposit_wait_keeps_psynet_interval():
+    (page,) = wait_pages(readiness.wait_until_deposited("recording", expected_wait=5.0))
+    assert isinstance(page, readiness.NotifiedWaitPage)
+    assert page.wait_time == 2.0
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.published = []
+
+    def set(self, key, value, nx=False, ex=None):
+        if not (nx and key in self.values):
+            self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+def test_messages_only_hold_the_token_of_the_participant(monkeypatch):
+    # all participants share the channel, so the messages carry an opaque token that only the participant's
+    # pages get (from catch_up, behind the unique id check of the /sing_ready route), and no ids
+    info = {}
+    redis = FakeRedis()
+    monkeypatch.setattr(readiness.db, "session", SimpleNamespace(info=info))
+    monkeypatch.setattr(readiness.db, "redis_conn", redis)
+    readiness.notify(12, "analysis")
+    readiness.notify(13, "deposited")
+    readiness._publish(readiness.db.session)
+
+    first, second = [json.loads(message) for channel, message in redis.published]
+    assert {channel for channel, message in redis.published} == {readiness.CHANNEL}
+    assert set(first) == {"id", "event", "sent", "token"}
+    assert first["event"] == "analysis"
+    assert first["token"] != second["token"]
+    catch_up = json.loads(readiness.catch_up(12))
+    assert catch_up == {"token": first["token"], "message": first}
+    assert "sing_ready" not in info
+
+
+@pytest.mark.parametrize(
+    "metadata, credited",
+    [({"readiness_waited": 0.5}, 0.5), ({"readiness_waited": 60}, 2.0), ({"readiness_waited": -1}, 0.0), ({}, 2.0)],
+)
+def test_wait_page_credits_the_time_waited(monkeypatch, metadata, credited):
+    page = readiness.NotifiedWaitPage(wait_time=2.0)
+    participant = SimpleNamespace(total_wait_page_time=1.0)
+    monkeypatch.setattr(
+        WaitPage, "process_response", lambda self, participant, **kwargs: self.on_complete(None, participant)
+    )
+    page.process_response(
+        raw_answer=None, blobs=None, metadata=metadata, experiment=None, participant=participant,
+        client_ip_address=None,
+    )
+    assert participant.total_wait_page_time == pytest.approx(1.0 + credited)
+
+
+def test_report_finds_the_wait_pages():
+    # page_report.py filters the responses by the page type psynet stores for them
+    assert page_report.WAIT_PAGE_TYPE == readiness.NotifiedWaitPage.__name__
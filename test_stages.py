@@ -0,0 +1,29 @@
+# The stages of sing.analyze timed on their re-implementation (sing/stages.py) are recorded in the timer of the
+# analysis, so that timing_report.py shows them.
+#
+# bash docker/run pytest test_stages.py
+
+import os
+
+import pytest
+
+pytest.importorskip("parselmouth")
+pytest.importorskip("scipy")
+
+from . import timing_report  # noqa: E402
+from .sing import onsets, stages, timing  # noqa: E402
+from .sing.params import singing_2intervals  # noqa: E402
+
+AUDIO_FILE = os.path.join(os.path.dirname(__file__), "audio_5notes.wav")
+
+
+def test_stages_are_recorded():
+    with timing.collect() as timer:
+        num_segments = stages.time_stages(AUDIO_FILE, singing_2intervals)
+
+    recorded = timer.as_dict()["stages"]
+    assert list(recorded) == stages.STAGES
+    assert all(recorded[name]["wall"] > 0 for name in stages.STAGES)
+    assert set(stages.STAGES) <= set(timing_report.STAGE_ORDER)
+    # the segmentation is the one of the note counter
+    assert num_segments == onsets.count_notes(AUDIO_FILE, singing_2intervals)["num_sung_pitches"]
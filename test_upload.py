@@ -0,0 +1,131 @@
+# Round trip of a compressed recording upload (sing/upload.py) through CompressedAudioRecordControl.format_answer
+# and psynet's AudioRecordControl down to the deposit of the Recording asset: the deposited file must be the
+# 16 kHz mono WAV file of the uploaded samples, and WAV uploads must be deposited unchanged.
+#
+# bash docker/run pytest test_upload.py
+
+import gzip
+import io
+import os
+import shutil
+import wave
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("psynet")
+
+import psynet.trial.record  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+from .sing import upload  # noqa: E402
+from .sing.audio import read_wav, resample, to_mono  # noqa: E402
+
+AUDIO_FILE = os.path.join(os.path.dirname(__file__), "audio_5notes.wav")
+
+
+@pytest.fixture
+def deposits(monkeypatch, tmp_path):
+    # the asset as psynet's AudioRecordControl creates it, deposited into tmp_path instead of the storage
+    deposited = []
+
+    class Recording:
+        default_storage = None
+
+        def __init__(self, local_key, input_path, extension, parent, personal):
+            self.id = len(deposited)
+            self.url = f"/recordings/{self.id}{extension}"
+            self.input_path = input_path
+
+        def deposit(self, async_, delete_input):
+            path = str(tmp_path / f"{self.id}.wav")
+            shutil.copyfile(self.input_path, path)
+            if delete_input:
+                os.remove(self.input_path)
+            deposited.append(path)
+
+    monkeypatch.setattr(psynet.trial.record, "Recording", Recording)
+    return deposited
+
+
+def submit(data):
+    control = upload.CompressedAudioRecordControl(duration=5)
+    control.page = SimpleNamespace(label="singing_page")
+    blob = FileStorage(io.BytesIO(data), filename="audio", content_type="application/octet-stream")
+    return control.format_answer(
+        None, blobs={"audioRecording": blob}, trial=None, participant=SimpleNamespace(), metadata={}
+    )
+
+
+def browser_gzip(data):
+    # CompressionStream("gzip") writes a gzip stream with a header of its own (no file name, mtime 0)
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_compressed_upload_is_deposited_as_16khz_wav(deposits):
+    rng = np.random.default_rng(0)
+    samples = rng.integers(-32768, 32767, size=upload.UPLOAD_SAMPLE_RATE, endpoint=True).astype(np.int16)
+    data = browser_gzip(gzip.decompress(upload.encode(samples, upload.UPLOAD_SAMPLE_RATE)))
+
+    answer = submit(data)
+
+    (path,) = deposits
+    assert answer["asset_id"] == 0
+    with wave.open(path, "rb") as file:
+        assert (file.getframerate(), file.getnchannels(), file.getsampwidth()) == (upload.UPLOAD_SAMPLE_RATE, 1, 2)
+        assert np.array_equal(np.frombuffer(file.readframes(file.getnframes()), dtype="<i2"), samples)
+
+
+def test_recording_round_trip(deposits):
+    submit(upload.simulate_upload(AUDIO_FILE))
+
+    (path,) = deposits
+    sample_rate, decoded = read_wav(path)
+    source_rate, samples = read_wav(AUDIO_FILE)
+    expected = resample(to_mono(samples), source_rate, upload.UPLOAD_SAMPLE_RATE)
+    assert sample_rate == upload.UPLOAD_SAMPLE_RATE
+    assert len(decoded) == len(expected)
+    assert np.max(np.abs(decoded - np.clip(expected, -1, 1))) <= 1 / 32767
+
+
+def test_wav_upload_is_deposited_unchanged(deposits):
+    with open(AUDIO_FILE, "rb") as file:
+        data = file.read()
+
+    submit(data)
+
+    (path,) = deposits
+    with open(path, "rb") as file:
+        assert file.read() == data
+
+
+def upload_of(header, samples=b""):
+    return browser_gzip(upload.MAGIC + header + samples)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        # decompresses to gigabytes: only the first bytes beyond the limit are ever decompressed
+        upload_of(upload.struct.pack("<II", upload.UPLOAD_SAMPLE_RATE, 10**8 // 2), bytes(10**8)),
+        upload_of(upload.struct.pack("<II", upload.UPLOAD_SAMPLE_RATE, 100), bytes(200)) + gzip.compress(bytes(10)),
+        upload_of(upload.struct.pack("<II", 44100, 100), bytes(200)),
+        upload_of(upload.struct.pack("<II", upload.UPLOAD_SAMPLE_RATE, 100), bytes(100)),
+        browser_gzip(bytes(1000))[:-20],
+        upload.GZIP_MAGIC + b"not gzip",
+    ],
+    ids=["bomb", "trailing data", "sample rate", "truncated", "truncated gzip", "corrupt"],
+)
+def test_invalid_upload_is_rejected(deposits, data):
+    with pytest.raises(upload.InvalidUpload):
+        upload.decode(data, upload.max_frames(5))
+
+    answer = submit(data)
+
+    assert not deposits
+    assert "upload_error" in answer
+    control = upload.CompressedAudioRecordControl(duration=5)
+    assert isinstance(control.validate(SimpleNamespace(answer=answer)), upload.FailedValidation)
@@ -0,0 +1,110 @@
+# Summarises the per-stage timings stored with every analysis (see sing/timing.py):
+# p50/p95/p99 of wall time, CPU time and peak memory plus a wall time histogram, per trial maker and stage.
+# The breakdown of sing.analyze (profile_* stages) is only there for analyses run with profile_stages (see
+# sing/stages.py), e.g. ``reanalyze.py --profile-stages``.
+#
+# From the database of the experiment (inside the experiment's Docker container):
+#
+# bash docker/run python timing_report.py
+#
+# From the output folder of reanalyze.py:
+#
+# python timing_report.py --reanalysis reanalysis
+
+import argparse
+import json
+import os
+import sys
+
+TRIAL_MAKERS = [
+    "main_singing",
+    "sing_practice",
+    "singing_performance_test",
+    "singing_performance_feedback",
+]
+STAGE_ORDER = [
+    "cache_lookup", "extract", "extract_with_plot", "cache_store",
+    "profile_audio_load", "profile_bandpass", "profile_praat_pitch", "profile_segmentation",
+    "read_audio", "envelope", "segmentation", "compute_stats", "plot_spec", "total",
+]
+
+
+def records_from_database(trial_makers):
+    from psynet.experiment import import_local_experiment
+    from psynet.trial.main import Trial
+    import_local_experiment()
+
+    query = (
+        Trial.query
+        .filter(Trial.trial_maker_id.in_(trial_makers))
+        .filter(Trial.complete.is_(True))
+        .order_by(Trial.id)
+    )
+    for trial in query.yield_per(500):
+        analysis = trial.analysis or {}
+        if isinstance(analysis, str):
+            analysis = json.loads(analysis)
+        yield trial.trial_maker_id, analysis.get("timings")
+
+
+def records_from_reanalysis(folder, trial_makers):
+    import pandas as pd
+
+    for part in sorted(os.listdir(folder)):
+        if not (part.startswith("part-") and part.endswith(".parquet")):
+            continue
+        df = pd.read_parquet(os.path.join(folder, part))
+        if "timings" not in df.columns:
+            continue
+        df = df[(df["status"] == "ok") & df["trial_maker_id"].isin(trial_makers)]
+        for trial_maker_id, timings in zip(df["trial_maker_id"], df["timings"]):
+            yield trial_maker_id, json.loads(timings) if isinstance(timings, str) else None
+
+
+def print_summary(summary, edges):
+    bins = [f"<{edge:g}" for edge in edges[1:-1]] + [f">={edges[-2]:g}"]
+    for trial_maker_id, stages in sorted(summary.items()):
+        n = stages["total"]["n"]
+        print(f"\n{trial_maker_id} ({n} trials)")
+        print(f"  {'stage':<18}{'n':>6}{'wall p50':>10}{'p95':>9}{'p99':>9}{'cpu p50':>10}{'p95':>9}{'p99':>9}{'rss p99':>10}")
+        names = sorted(stages, key=lambda x: STAGE_ORDER.index(x) if x in STAGE_ORDER else len(STAGE_ORDER))
+        for name in names:
+            s = stages[name]
+            print(
+                f"  {name:<18}{s['n']:>6}"
+                f"{s['wall_p50']:>10.3f}{s['wall_p95']:>9.3f}{s['wall_p99']:>9.3f}"
+                f"{s['cpu_p50']:>10.3f}{s['cpu_p95']:>9.3f}{s['cpu_p99']:>9.3f}"
+                f"{s['max_rss_mb_p99']:>8.0f}MB"
+            )
+        histogram = stages["total"]["wall_histogram"]
+        print("  total wall time (s): " + ", ".join(f"{b}: {c}" for b, c in zip(bins, histogram) if c))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise the per-stage analysis timings.")
+    parser.add_argument("--reanalysis", help="read the output folder of reanalyze.py instead of the database")
+    parser.add_argument("--trial-maker", action="append", choices=TRIAL_MAKERS, help="only these trial makers")
+    parser.add_argument("--json", help="also write the summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sing import timing
+
+    trial_makers = args.trial_maker or TRIAL_MAKERS
+    if args.reanalysis:
+        records = records_from_reanalysis(args.reanalysis, trial_makers)
+    else:
+        records = records_from_database(trial_makers)
+    summary = timing.summarize(records)
+
+    if not summary:
+        print("No timings found.")
+        return
+    print_summary(summary, timing.HISTOGRAM_EDGES)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"histogram_edges": timing.HISTOGRAM_EDGES[:-1], "summary": summary}, file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())